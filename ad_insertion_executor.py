@@ -1,7 +1,27 @@
 from models.opencv_model.ad_insertion import AdInsertion
+from models.opencv_model.buffers import BufferPool
+from models.opencv_model.config import ModelConfig
+from models.opencv_model.detection import frame_groups, interpolate_stream
+from models.opencv_model.storage import TRACKS_FILE, TrackStore
+from models.opencv_model.previews import PreviewFrames, downscale, write_preview
+from models.opencv_model.cache import DetectionCache, detection_key
+from models.opencv_model.capture import MarkedCapture, ReferenceCapture, SEEK_PREROLL, WindowCapture, \
+    digests_offset, seek_frame
+from models.opencv_model.checkpoint import Checkpoint, insertion_key
+from models.opencv_model.flow import FlowTracker
+from models.opencv_model.sweep import ParameterSweep, sweep_configs
+from frame_pipeline import FramePipeline
+from metrics import JobMetrics, TimedCapture, TimedWriter, instrumented
+import video_io
 import cv2 as cv
+import json
+import math
 import numpy as np
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 from pathlib import Path
 
 
@@ -26,75 +46,418 @@ class InfoStorage(object):
                            'frames_count': frames_count}
 
 
+def workspace_paths(workspace=None):
+    """
+    Folders of a job. Input video and logo file names are taken from the output folder, paths are used as given
+    :param workspace: job folder, the shared files and output folders are used if not given
+    :return: dictionary with input, files, output, instances and detection cache paths,
+             the detection cache is shared by all jobs
+    """
+    input_path = str(Path.cwd()) + '/output'
+    if workspace is None:
+        return {'input': input_path,
+                'files': str(Path.cwd()) + '/files',
+                'output': input_path,
+                'instances': input_path + '/instances',
+                'cache': input_path + '/cache'}
+    workspace = str(workspace)
+    return {'input': input_path,
+            'files': workspace + '/files',
+            'output': workspace,
+            'instances': workspace + '/instances',
+            'cache': input_path + '/cache'}
+
+
+def detect_frames(capture, ad_insertion, start, stop, stride, progress=None, previews=None):
+    """
+    Detections stream of the frames range
+    :param capture: video object positioned at the first frame
+    :param ad_insertion: model that searches contours of a frame
+    :param start: first frame
+    :param stop: stop frame
+    :param stride: detection frame stride
+    :param progress: optional callback called with every frame index
+    :param previews: optional PreviewFrames that keeps frames with contours
+    :return: generator of (frame index, array (k, 9) with the frame contours)
+    """
+    data = ad_insertion.data
+    cfg = ad_insertion.config
+    flow = None
+    if cfg.detection_mode == 'flow':
+        flow = FlowTracker(cfg.flow_interval, cfg.flow_max_error, cfg.scene_threshold)
+    # Frames are decoded into two reused buffers, the flow tracker keeps the previous frame
+    pool = BufferPool()
+    shape = None
+    previous = None
+    for i in range(start, stop):
+        if progress is not None:
+            progress(i)
+        if i % stride != 0:
+            # Skipped frames are only grabbed, without decoding to BGR
+            if not capture.grab():
+                break
+            continue
+        ret, frame = capture.read(pool.take(shape) if shape is not None else None)
+        if not ret:
+            break
+        shape = frame.shape
+        quads = flow.track(i, frame) if flow is not None else None
+        if quads is None:
+            ad_insertion.process_frame(frame, i)
+            if flow is not None:
+                flow.reset(i, data)
+        else:
+            data.extend([i] + quad.ravel().tolist() for quad in np.rint(quads).astype(np.int64))
+        kept = False
+        if data:
+            if previews is not None:
+                kept = previews.add(i, frame)
+            yield i, np.array(data, dtype=np.int64)
+            del data[:]
+        # Frames kept for the previews are not given back to the pool
+        release = None if kept else frame
+        if flow is not None:
+            pool.give(previous)
+            previous = release
+        else:
+            pool.give(release)
+
+
+def detect_frame_range(shard):
+    """
+    Detection worker, searches contours in the frames range with its own video capture. The frame seek
+    of some containers is a frame or two off, so the worker keeps the digests of the frames decoded from its
+    seek position and searches and decodes frames past its stop frame; the ranges are aligned by the digests
+    :param shard: tuple (video path, first frame, stop frame, video info, model config)
+    :return: array with detected contours of the range and the frames past it, dictionaries frame index -> digest
+             of the frames decoded from the first frame and of the frames decoded around the stop frame
+    """
+    video, start, stop, video_info, model_config = shard
+    stride = model_config.detection_stride
+    frames_count = video_info['frames_count']
+    search_stop = min(stop + SEEK_PREROLL, frames_count)
+    capture = cv.VideoCapture(video)
+    if start != 0:
+        capture.set(cv.CAP_PROP_POS_FRAMES, start)
+    capture = WindowCapture(capture, start, [(start, start), (max(start, stop - SEEK_PREROLL), stop)])
+
+    ad_insertion = AdInsertion(None, None, None, [], video_info)
+    ad_insertion.build_model(model_config)
+    rows = [frame_rows for _, frame_rows in detect_frames(capture, ad_insertion, start, search_stop, stride)]
+    capture.complete(frames_count)
+    capture.release()
+    head, tail = capture.digests(0), capture.digests(1)
+    return np.concatenate(rows) if rows else np.zeros((0, 9), dtype=np.int64), head, tail
+
+
 class ProcessingExecutor(object):
-    def __init__(self, video, logo, config):
+    def __init__(self, video, logo, config, workspace=None, progress=None, metrics=None):
+        """
+        :param video: video file name in the output folder or video path
+        :param logo: logo file name in the output folder or logo path
+        :param config: model configuration path
+        :param workspace: job folder, the shared files and output folders are used if not given
+        :param progress: optional function (stage, fraction) called while the job runs
+        :param metrics: JobMetrics that collects stage timings and counters, a new one if not given
+        """
         self.video = video
         self.logo = logo
         self.config = config
+        self.paths = workspace_paths(workspace)
+        self.progress = progress
+        self.metrics = metrics if metrics is not None else JobMetrics()
+        self.model_config = None
+        self.previews = None
+        self.checkpoint = None
         self.input_info = {}
 
-    def __find_contours(self, capture):
+    def __find_contours(self, capture, video):
         """
-            Model processing
+            Model processing. Contours are searched lazily, the stream is consumed by the tracker.
+            Detections of a video already searched with the same frame-level parameters are read from the cache,
+            an interrupted search resumes from its last checkpoint
             :param capture: video object
-            :return:
+            :param video: video path
+            :return: generator of (frame index, array with the frame contours)
             """
         print('Searching contours...')
-        data = []
-        for i in range(self.input_info['frames_count']):
-            ret, frame = capture.read()
-            if ret:
-
-                if i == int(self.input_info['frames_count'] * 0.25):
-                    print('25% of the movie is processed.')
-                if i == int(self.input_info['frames_count'] * 0.5):
-                    print('50% of the movie is processed.')
-                if i == int(self.input_info['frames_count'] * 0.75):
-                    print('75% of the movie is processed')
-
-                ad_insertion = AdInsertion(frame, None, i, data, self.input_info)
-                ad_insertion.build_model(self.config)
-                ad_insertion.data_preprocessed()
-            else:
+        cache = None
+        key = None
+        if self.model_config.detection_cache_mb > 0 or self.model_config.checkpoint_interval > 0:
+            key = detection_key(video, self.model_config)
+        if self.model_config.checkpoint_interval > 0:
+            self.checkpoint = Checkpoint(self.paths['files'] + '/checkpoint_detection', key)
+        if self.model_config.detection_cache_mb > 0:
+            cache = DetectionCache(self.paths['cache'], self.model_config.detection_cache_mb * 1024 ** 2)
+            cached = cache.get(key)
+            if cached is not None:
+                capture.release()
+                print('Detections are read from the cache.')
+                if self.progress is not None:
+                    self.progress('detection', 1.0)
+                return interpolate_stream(self.__measure_detections(frame_groups(cached)),
+                                          self.model_config.detection_stride, self.model_config.dst_threshold)
+
+        if self.model_config.detection_workers > 1:
+            capture.release()
+            detections = self.__find_contours_parallel(video)
+        else:
+            detections = self.__find_contours_serial(capture)
+        if cache is not None:
+            detections = self.__cache_detections(detections, cache, key)
+        return interpolate_stream(self.__measure_detections(detections), self.model_config.detection_stride,
+                                  self.model_config.dst_threshold)
+
+    def __measure_detections(self, detections):
+        """
+            Time the detections stream and count the contours. The stream time covers decoding
+            and contours search, decoding is taken out of it once the stream is consumed
+            :param detections: detections stream
+            :return: generator of (frame index, array with the frame contours)
+            """
+        metrics = self.metrics
+        iterator = iter(detections)
+        while True:
+            start = time.perf_counter()
+            item = next(iterator, None)
+            metrics.add_time('detection', time.perf_counter() - start)
+            if item is None:
                 break
-        data = np.array(data)
-        np.save('files/data.npy', data)
+            metrics.count('detections', len(item[1]))
+            yield item
+
+    @staticmethod
+    def __cache_detections(detections, cache, key):
+        """
+            Pass the detections stream through and store it in the cache once the video is searched,
+            the rows are written to the cache folder as they are searched
+            :param detections: detections stream
+            :param cache: detection cache
+            :param key: cache key
+            :return: generator of (frame index, array with the frame contours)
+            """
+        writer = cache.writer(key)
+        try:
+            for frame_idx, frame_rows in detections:
+                writer.write(frame_rows)
+                yield frame_idx, frame_rows
+            writer.commit()
+        finally:
+            writer.close()
+
+    def __report_progress(self, frame_idx):
+        """
+            Print detection progress
+            :param frame_idx: current frame index
+            :return:
+            """
+        frames_count = self.input_info['frames_count']
+        if frame_idx == int(frames_count * 0.25):
+            print('25% of the movie is processed.')
+        if frame_idx == int(frames_count * 0.5):
+            print('50% of the movie is processed.')
+        if frame_idx == int(frames_count * 0.75):
+            print('75% of the movie is processed')
+        if self.progress is not None:
+            self.progress('detection', frame_idx / frames_count)
+
+    def __resume_detections(self):
+        """
+            Detections saved by an interrupted search
+            :return: first frame to search, the list of saved detection chunks and the marker of the last
+                     decoded frame
+            """
+        state = self.checkpoint.load() if self.checkpoint is not None else None
+        if state is None:
+            return 0, [], None
+        print('Searching is resumed from frame {}.'.format(state['next_frame']))
+        return state['next_frame'], state['chunks'], state['marker']
+
+    def __save_detections(self, chunks, start, stop, rows, marker=None):
+        """
+            Save the detections of a searched frames range as a checkpoint
+            :param chunks: list of saved detection chunks, the new chunk is appended to it
+            :param start: first frame of the range
+            :param stop: stop frame of the range, the search resumes from it
+            :param rows: list of arrays with the range contours
+            :param marker: [frame index, digest] of the last decoded frame of the range, or for the parallel
+                           search a dictionary with the index shift and the [frame index, digest] pairs of the range
+            :return:
+            """
+        data = np.concatenate(rows) if rows else np.zeros((0, 9), dtype=np.int64)
+        chunks.append(self.checkpoint.write_array('detections_{}.npy'.format(start), data))
+        self.checkpoint.save({'next_frame': int(stop), 'chunks': chunks, 'marker': marker})
+
+    def __find_contours_serial(self, capture):
+        """
+            Search contours frame by frame in the current process. Detections are saved every
+            checkpoint_interval frames; the saved ones are replayed to the tracker without decoding
+            :param capture: video object
+            :return: generator of (frame index, array with the frame contours)
+            """
+        ad_insertion = AdInsertion(None, None, None, [], self.input_info)
+        ad_insertion.build_model(self.model_config)
+        frames_count = self.input_info['frames_count']
+        stride = self.model_config.detection_stride
+        interval = self.model_config.checkpoint_interval or frames_count
+        start, chunks, marker = self.__resume_detections()
+        for name in chunks:
+            yield from frame_groups(self.checkpoint.read_array(name))
+        if start != 0:
+            # A search resumed from the parallel one has no marker of a decoded frame
+            seek_frame(capture, start, marker if isinstance(marker, list) else None)
+
+        marked_capture = MarkedCapture(capture, start)
+        timed_capture = TimedCapture(marked_capture, self.metrics)
+        for chunk_start in range(start, frames_count, interval):
+            chunk_stop = min(chunk_start + interval, frames_count)
+            # The last decoded frame of the range marks the position a resumed search continues from
+            last_read = chunk_stop - 1 - (chunk_stop - 1) % stride
+            marked_capture.mark(last_read)
+            rows = []
+            for frame_idx, frame_rows in detect_frames(timed_capture, ad_insertion, chunk_start, chunk_stop,
+                                                       stride, self.__report_progress, self.previews):
+                rows.append(frame_rows)
+                yield frame_idx, frame_rows
+            if self.checkpoint is not None and chunk_stop < frames_count:
+                self.__save_detections(chunks, chunk_start, chunk_stop, rows, marked_capture.marker(last_read))
         capture.release()
         print('Searching is completed.')
 
-    def __handle_contours(self):
+    def __find_contours_parallel(self, video):
+        """
+            Split the video into frame ranges and search contours in worker processes. Ranges are not
+            longer than checkpoint_interval frames and every finished range is saved as a checkpoint.
+            The frames a range decoded past its stop frame are compared by digests with the first frames of
+            the next range, so its frame indices are shifted to the ones of a decoding from the first frame,
+            and the detections of the frames decoded by both ranges are taken once. Ranges are only searched in
+            parallel in full detection mode without a frame stride, see ModelConfig
+            :param video: video path
+            :return: generator of (frame index, array with the frame contours) in frames order
+            """
+        workers = self.model_config.detection_workers
+        stride = self.model_config.detection_stride
+        interval = self.model_config.checkpoint_interval
+        frames_count = self.input_info['frames_count']
+        start, chunks, marker = self.__resume_detections()
+        for name in chunks:
+            yield from frame_groups(self.checkpoint.read_array(name))
+        # Index shift of the previous range and its digests, restored from the checkpoint of a resumed search
+        shift, previous = 0, None
+        if isinstance(marker, dict):
+            shift, previous = marker['shift'], {frame_idx: digest for frame_idx, digest in marker['digests']}
+
+        count = workers
+        if interval > 0:
+            count = max(workers, int(math.ceil((frames_count - start) / interval)))
+        bounds = np.linspace(start, frames_count, count + 1).astype(int).tolist()
+        shards = [(video, bounds[i], bounds[i + 1], self.input_info, self.model_config)
+                  for i in range(count) if bounds[i + 1] > bounds[i]]
+
+        # Workers are spawned, forking a process that runs job threads may copy locks held by them
+        pending = None
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            # imap keeps shards order, so the stream stays sorted by frame index
+            for done, (result, head, tail) in enumerate(pool.imap(detect_frame_range, shards), 1):
+                # Frames are decoded by the workers, so decoding time is a part of detection time
+                shard_start, shard_stop = shards[done - 1][1:3]
+                self.metrics.count('frames_decoded', len(range(shard_start + (-shard_start) % stride,
+                                                               shard_stop, stride)))
+                print('{}% of the movie is processed.'.format(int(100 * shard_stop / frames_count)))
+                if self.progress is not None:
+                    self.progress('detection', shard_stop / frames_count)
+                if previous is not None:
+                    shift += digests_offset(previous, head)
+                # Frames from the cut on are taken from this range, the previous one covers the frames before it
+                cut = shard_start + shift
+                if pending is not None:
+                    pending_start, pending_shift, pending_tail, pending_rows = pending
+                    pending_rows = pending_rows[pending_rows[:, 0] < cut]
+                    if self.checkpoint is not None:
+                        self.__save_detections(chunks, pending_start, shard_start, [pending_rows],
+                                               {'shift': pending_shift,
+                                                'digests': [[frame_idx, digest] for frame_idx, digest
+                                                            in pending_tail.items() if digest is not None]})
+                    yield from frame_groups(pending_rows)
+                result[:, 0] += shift
+                pending = (shard_start, shift, tail, result[result[:, 0] >= cut])
+                previous = tail
+        if pending is not None:
+            yield from frame_groups(pending[3])
+        print('Searching is completed.')
+
+    def __handle_contours(self, detections):
         """
             Model detection method
+            :param detections: detections stream
             :return: stable contours
             """
         print('Handling contours...')
         ad_insertion = AdInsertion(None, None, None, None, self.input_info)
-        ad_insertion.build_model(self.config)
-        ad_insertion.detect_surfaces()
+        ad_insertion.build_model(self.model_config)
+        with self.metrics.stage('tracking'):
+            ad_insertion.detect_surfaces(detections, self.previews)
+        # The tracker pulls the detections stream, so detection time is taken out of tracking
+        # and decoding out of detection
+        self.metrics.add_time('tracking', -self.metrics.total('detection'))
+        self.metrics.add_time('detection', -self.metrics.total('decode'))
         instance_insertions = ad_insertion.instance_insertions
         print('Detected {} stable contours.'.format(len(instance_insertions)))
         print('Handling is completed.')
         return instance_insertions
 
+    def __preview_frames(self, video, frame_indices):
+        """
+            Preview frames kept during detection. Frames that were not kept, e.g. the ones decoded by
+            detection workers or the ones of detections read from the cache, are decoded again from the
+            first frame, as the frame seek of some containers is a few frames off
+            :param video: video path
+            :param frame_indices: frame indices
+            :return: dictionary frame index -> (preview frame, scale)
+            """
+        frames = {}
+        for frame_idx in set(frame_indices):
+            preview = self.previews.get(frame_idx) if self.previews is not None else None
+            if preview is not None:
+                frames[frame_idx] = preview
+        missing = set(frame_indices) - set(frames)
+        if missing:
+            capture = cv.VideoCapture(video)
+            for frame_idx in range(max(missing) + 1):
+                if frame_idx not in missing:
+                    # Frames without a preview are only grabbed, without decoding to BGR
+                    if not capture.grab():
+                        break
+                    continue
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                frames[frame_idx] = downscale(frame, self.model_config.preview_width)
+            capture.release()
+        return frames
+
     def __get_instances(self, video, logo, instances):
         """
-            Create instance insertions
+            Create instance insertions as downscaled JPEG previews
             :param video: video path
             :param logo: logo path
             :param instances: array with fields instances
             :return: message that describe function output
             """
         if len(instances) != 0:
-            capture = cv.VideoCapture(video)
-            ids = instances[:, 0]
-            for i, frame_index in enumerate(ids):
-                capture.set(cv.CAP_PROP_POS_FRAMES, frame_index)
-                _, frame = capture.read()
-                ad_insertion = AdInsertion(frame, logo, frame_index, None, self.input_info)
-                ad_insertion.build_model(self.config)
-                ad_insertion.insert_ad(instances)
-                cv.imwrite('output/instances/{}.png'.format(i), ad_insertion.frame)
-            capture.release()
+            ad_insertion = AdInsertion(None, logo, None, None, self.input_info)
+            ad_insertion.build_model(self.model_config)
+            ids = instances[:, 0].astype(int).tolist()
+            frames = self.__preview_frames(video, ids)
+            with self.metrics.stage('previews'), ThreadPoolExecutor(self.model_config.composite_workers) as pool:
+                tasks = [pool.submit(write_preview, '{}/{}.jpg'.format(self.paths['instances'], i),
+                                     frames[frame_idx][0], frames[frame_idx][1], instances[i], ad_insertion,
+                                     self.model_config.preview_quality)
+                         for i, frame_idx in enumerate(ids) if frame_idx in frames]
+                for done, task in enumerate(tasks, 1):
+                    task.result()
+                    if self.progress is not None:
+                        self.progress('instances', done / len(tasks))
             message = 'Insert templates are ready. Please check the templates for further actions.'
             print(message)
         else:
@@ -103,22 +466,22 @@ class ProcessingExecutor(object):
 
         return message
 
+    @instrumented('processing')
     def process_video(self):
         """
             Execute AdInsertion model for logo insertion
             :return: message that describes function output
             """
         # Creating folders for further actions
-        input_video_name = self.video.split('.')[0]
-        files_path = str(Path.cwd()) + '/files'
-        output_path = str(Path.cwd()) + '/output'
-        instances_path = output_path + '/instances'
-        Path(files_path).mkdir(parents=True, exist_ok=True)
-        Path(output_path).mkdir(parents=True, exist_ok=True)
-        Path(instances_path).mkdir(parents=True, exist_ok=True)
+        input_video_name = os.path.splitext(os.path.basename(self.video))[0]
+        input_path = self.paths['input']
+        video_path = os.path.join(input_path, self.video)
+        logo_path = os.path.join(input_path, self.logo)
+        for path in (self.paths['files'], self.paths['output'], self.paths['instances']):
+            Path(path).mkdir(parents=True, exist_ok=True)
 
-        capture = cv.VideoCapture(output_path + '/' + self.video)
-        read_logo = cv.imread(output_path + '/' + self.logo)
+        capture = cv.VideoCapture(video_path)
+        read_logo = cv.imread(logo_path)
 
         if int(capture.get(cv.CAP_PROP_FPS)) == 0 or read_logo is None:
             message = 'ERROR WHILE ENTERING LOGO OR VIDEO PATH.'
@@ -130,26 +493,51 @@ class ProcessingExecutor(object):
             info_storage.get_info()
             self.input_info = info_storage.video_info
             self.input_info['video_name'] = input_video_name
+            self.input_info['files_path'] = self.paths['files']
+            self.input_info['output_path'] = self.paths['output']
 
-            # Finding contours
-            self.__find_contours(capture)
+            # Model configuration is parsed once per job
+            self.model_config = ModelConfig.load(self.config)
+            self.previews = PreviewFrames(self.model_config.preview_width)
 
-            # Handling contours
-            instances = self.__handle_contours()
+            # Finding and handling contours, detections flow straight into the tracker
+            detections = self.__find_contours(capture, video_path)
+            instances = self.__handle_contours(detections)
 
             # Getting instances
-            message = self.__get_instances(output_path + '/' + self.video,
-                                           output_path + '/' + self.logo,
-                                           instances)
+            message = self.__get_instances(video_path, logo_path, instances)
+            if self.checkpoint is not None:
+                self.checkpoint.clear()
         return message
 
 
 class InsertionExecutor(object):
-    def __init__(self, video, logo, config):
+    def __init__(self, video, logo, config, workspace=None, progress=None, metrics=None, outputs=None):
+        """
+        :param video: video file name in the output folder or video path
+        :param logo: logo file name in the output folder or logo path
+        :param config: model configuration path
+        :param workspace: job folder, the shared files and output folders are used if not given
+        :param progress: optional function (stage, fraction) called while the job runs
+        :param metrics: JobMetrics that collects stage timings and counters, a new one if not given
+        :param outputs: optional list of output videos, every output is a logo inserted into all kept tracks
+                        or a dictionary track index -> logo, tracks without a logo are left as they are.
+                        One output with the logo if not given
+        """
         self.video = video
         self.logo = logo
         self.config = config
-        self.all_contours = []
+        self.paths = workspace_paths(workspace)
+        self.progress = progress
+        self.metrics = metrics if metrics is not None else JobMetrics()
+        self.outputs = outputs if outputs else [logo]
+        self.output_file = None
+        self.output_files = []
+        self.assignments = []
+        self.plan = None
+        self.track_ids = []
+        self.checkpoint = None
+        self.buffers = None
         self.input_info = {}
         self.folder_paths = []
 
@@ -166,26 +554,37 @@ class InsertionExecutor(object):
             insertion_idx = int(filename.split('.')[0])
             list_idx.append(insertion_idx)
 
-        stable_contours = np.load('files/all_instances.npy', allow_pickle=True)
-        for i, contour in enumerate(stable_contours):
-            if i in list_idx:
-                for frame_contour in contour:
-                    self.all_contours.append(frame_contour)
-        self.all_contours = np.array(self.all_contours)
+        # Only the kept tracks are read from the memory mapped store
+        self.track_ids = sorted(list_idx)
+        self.plan = TrackStore.open(os.path.join(self.paths['files'], TRACKS_FILE)).plan(list_idx)
 
-    def __add_audio(self, output_path, filename):
+    def __handle_outputs(self, input_path):
         """
-            Extract audio file from input video and add it to output video
-            :param output_path: output path
-            :param filename: filename
-            :return:
+            Logo of every kept track for every output
+            :param input_path: folder of the logos given by file name
+            :return: list of dictionaries track index -> logo path
+            """
+        assignments = []
+        for output in self.outputs:
+            if isinstance(output, dict):
+                assignment = {int(track): os.path.join(input_path, logo) for track, logo in output.items()}
+                assignments.append({track: logo for track, logo in assignment.items() if track in self.track_ids})
+            else:
+                assignments.append({track: os.path.join(input_path, output) for track in self.track_ids})
+        return assignments
+
+    def __output_paths(self, video_name, extension):
+        """
+            Output video paths, one per output
+            :param video_name: source video name without extension
+            :param extension: output file extension with the dot
+            :return: list of paths
             """
-        video_path = output_path + '/' + self.video
-        idx = np.random.randint(0, 10000)
-        audio_name = 'audio_{}_{}.m4a'.format(filename, idx)
-        os.system('ffmpeg -i {} -vn -acodec copy files/{}'.format(video_path, audio_name))
-        output = 'output/output_{}_{}.avi'.format(filename, idx)
-        os.system('ffmpeg -i files/result.avi -i files/{} -codec copy -shortest {}'.format(audio_name, output))
+        if len(self.assignments) == 1:
+            return ['{}/output_{}_{}{}'.format(self.paths['output'], video_name, np.random.randint(0, 10000),
+                                               extension)]
+        return ['{}/output_{}_{}_{}{}'.format(self.paths['output'], video_name, k, np.random.randint(0, 10000),
+                                              extension) for k in range(len(self.assignments))]
 
     def __clean_folders(self):
         """
@@ -203,58 +602,325 @@ class InsertionExecutor(object):
                 except Exception as e:
                     print('Failed to delete %s. Reason: %s' % (file_path, e))
 
+    def __report_progress(self, frames_written):
+        """
+            Print insertion progress
+            :param frames_written: amount of written frames
+            :return:
+            """
+        frames_count = self.input_info['frames_count']
+        if frames_written == int(frames_count * 0.25):
+            print('25% of the insertion is completed.')
+        if frames_written == int(frames_count * 0.5):
+            print('50% of the insertion is completed.')
+        if frames_written == int(frames_count * 0.75):
+            print('75% of the insertion is completed.')
+        if self.progress is not None:
+            self.progress('insertion', frames_written / frames_count)
+
+    def __composite_function(self, ad_insertion):
+        """
+            Timed compositing of one decoded frame into every output, called by the pipeline threads.
+            Outputs of the same logo share its warp cache, so a contour is transformed once per frame
+            :param ad_insertion: model used for compositing
+            :return: function (frame, frame index) -> list of composited frames, one per output
+            """
+        def copy(frame):
+            buffer = self.buffers.take(frame.shape, frame.dtype)
+            np.copyto(buffer, frame)
+            return buffer
+
+        def composite(frame, i):
+            # Compositing is in place, every output but the last one gets a copy of the decoded frame
+            frames = [ad_insertion.insert_frame(copy(frame), i, self.plan, logos)
+                      for logos in self.assignments[:-1]]
+            frames.append(ad_insertion.insert_frame(frame, i, self.plan, self.assignments[-1]))
+            return frames
+        return self.metrics.timed('composite', composite, counter='insertion_frames')
+
+    def __writer(self, paths, fps, codec, pix_fmt='yuv420p', options=(), audio_source=None):
+        """
+            Timed ffmpeg writer of every output
+            :param paths: output paths
+            :return: fan-out writer
+            """
+        return video_io.FanoutWriter([TimedWriter(video_io.FFmpegWriter(path, self.input_info['width'],
+                                                                        self.input_info['height'], fps, codec,
+                                                                        pix_fmt, options, audio_source),
+                                                  self.metrics) for path in paths])
+
+    def __finish(self, outputs):
+        """
+            Record the output videos
+            :param outputs: output paths
+            :return:
+            """
+        self.metrics.count('bytes_written', sum(os.path.getsize(output) for output in outputs))
+        self.output_files = outputs
+        self.output_file = outputs[0]
+
+    def __insert_full(self, capture, ad_insertion, model_config, video_path, video_name):
+        """
+            Re-encode the whole video in a single pass: frames are piped to one ffmpeg process per output
+            that also copies the source audio into the output
+            :param capture: video object
+            :param ad_insertion: model used for compositing
+            :param model_config: model configuration
+            :param video_path: source video path
+            :param video_name: source video name without extension
+            :return:
+            """
+        outputs = self.__output_paths(video_name, '.' + model_config.output_container)
+        if self.checkpoint is not None:
+            self.__insert_parts(capture, ad_insertion, model_config, video_path, outputs)
+            return
+        writer = self.__writer(outputs, self.input_info['fps'], model_config.output_codec,
+                               options=video_io.preset_options(model_config.output_preset),
+                               audio_source=video_path)
+        try:
+            FramePipeline(TimedCapture(capture, self.metrics), writer, self.__composite_function(ad_insertion),
+                          lambda i: i in self.plan,
+                          self.input_info['frames_count'],
+                          queue_depth=model_config.pipeline_queue_depth,
+                          workers=model_config.composite_workers,
+                          pool=self.buffers,
+                          progress=self.__report_progress).run()
+        finally:
+            writer.release()
+        self.__finish(outputs)
+
+    def __insert_parts(self, capture, ad_insertion, model_config, video_path, outputs):
+        """
+            Re-encode the whole video as parts of insertion_checkpoint_interval frames, every finished part is saved
+            as a checkpoint. An interrupted insertion resumes from the first unfinished part, then the parts
+            of every output are joined and the source audio is copied into the output
+            :param capture: video object
+            :param ad_insertion: model used for compositing
+            :param model_config: model configuration
+            :param video_path: source video path
+            :param outputs: output video paths
+            :return:
+            """
+        frames_count = self.input_info['frames_count']
+        state = self.checkpoint.load() or {'next_frame': 0, 'parts': [], 'marker': None}
+        start, parts = state['next_frame'], state['parts']
+        Path(self.checkpoint.root).mkdir(parents=True, exist_ok=True)
+        if start != 0:
+            seek_frame(capture, start, state['marker'])
+            print('Insertion is resumed from frame {}.'.format(start))
+
+        marked_capture = MarkedCapture(capture, start)
+        timed_capture = TimedCapture(marked_capture, self.metrics)
+        interval = model_config.insertion_checkpoint_interval
+        for part_start in range(start, frames_count, interval):
+            part_stop = min(part_start + interval, frames_count)
+            marked_capture.mark(part_stop - 1)
+            names = ['part_{}_{}.{}'.format(part_start, k, model_config.output_container)
+                     for k in range(len(outputs))]
+            writer = self.__writer([self.checkpoint.path(name) for name in names], self.input_info['fps'],
+                                   model_config.output_codec,
+                                   options=video_io.preset_options(model_config.output_preset))
+            try:
+                written = FramePipeline(timed_capture, writer, self.__composite_function(ad_insertion),
+                                        lambda i: i in self.plan,
+                                        part_stop - part_start,
+                                        queue_depth=model_config.pipeline_queue_depth,
+                                        workers=model_config.composite_workers,
+                                        pool=self.buffers,
+                                        progress=lambda frames, offset=part_start: self.__report_progress(
+                                            offset + frames),
+                                        start=part_start).run()
+            finally:
+                writer.release()
+            if written == 0:
+                # The video is shorter than its frames count
+                break
+            parts.append(names)
+            self.checkpoint.save({'next_frame': part_stop, 'parts': parts,
+                                  'marker': marked_capture.marker(part_stop - 1)})
+
+        with self.metrics.stage('mux'):
+            for k, output in enumerate(outputs):
+                video_io.concat_parts(video_path, [(self.checkpoint.path(names[k]), None, None) for names in parts],
+                                      output, self.checkpoint.path('parts_{}.txt'.format(k)))
+        self.__finish(outputs)
+
+    def __insert_segments(self, capture, ad_insertion, model_config, video_path, video_name):
+        """
+            Re-encode only the groups of pictures with insertions and stream copy the rest of the source.
+            Segments are encoded with the profile, level, pixel format, aspect ratio and colours of the source;
+            if the stream headers of the first segment still differ from the source ones, the joined stream
+            would not decode, so the whole video is re-encoded in the full mode instead
+            :param capture: video object
+            :param ad_insertion: model used for compositing
+            :param model_config: model configuration
+            :param video_path: source video path
+            :param video_name: source video name without extension
+            :return:
+            """
+        fps = self.input_info['fps']
+        frames_count = self.input_info['frames_count']
+        width, height = self.input_info['width'], self.input_info['height']
+        stream = video_io.probe_video(video_path)
+        if stream['codec_name'] not in video_io.ENCODERS:
+            raise ValueError('Segments output mode does not support {} video.'.format(stream['codec_name']))
+
+        keyframes, keyframes_dts = video_io.keyframes(video_path, fps, stream['start_time'])
+        segments = video_io.insertion_segments(self.plan.frames, keyframes, frames_count)
+        extension = os.path.splitext(self.video)[1]
+        outputs = self.__output_paths(video_name, extension)
+
+        # Stream copied ranges start at a keyframe presentation time and end before the decoding time of the next one
+        start_times = {i: stream['start_time'] + i / fps for i in keyframes.tolist()}
+        cut_times = dict(zip(keyframes.tolist(), keyframes_dts.tolist()))
+        parts = [[] for _ in outputs]
+        prev_stop = 0
+        state = self.checkpoint.load() if self.checkpoint is not None else None
+        done = state['segments'] if state is not None else 0
+        if done != 0:
+            print('Insertion is resumed from segment {} of {}.'.format(done + 1, len(segments)))
+        options = video_io.preset_options(model_config.output_preset) + video_io.stream_options(stream)
+        checked = done != 0
+        # The source is read in order, the frames between the segments are decoded without conversion
+        reader = ReferenceCapture(capture)
+        for k, (start, stop) in enumerate(segments):
+            if start > prev_stop:
+                for output_parts in parts:
+                    output_parts.append((video_path, start_times.get(prev_stop), cut_times[start]))
+            segment_paths = ['{}/segment_{}_{}{}'.format(self.paths['files'], k, o, extension)
+                             for o in range(len(outputs))]
+            for output_parts, segment_path in zip(parts, segment_paths):
+                output_parts.append((segment_path, None, None))
+            prev_stop = stop
+            if k < done:
+                continue
+            writer = self.__writer(segment_paths, fps, video_io.ENCODERS[stream['codec_name']], stream['pix_fmt'],
+                                   options)
+            # Segment starts are keyframes, decoded exactly by ffmpeg and found among the frames read in order
+            position = reader.seek(start, video_io.read_frame(video_path, start, fps, width, height))
+            try:
+                FramePipeline(TimedCapture(reader, self.metrics), writer, self.__composite_function(ad_insertion),
+                              lambda i: i in self.plan,
+                              stop - start,
+                              queue_depth=model_config.pipeline_queue_depth,
+                              workers=model_config.composite_workers,
+                              pool=self.buffers,
+                              start=position).run()
+            finally:
+                writer.release()
+            if not checked:
+                checked = True
+                if video_io.stream_extradata(segment_paths[0]) != video_io.stream_extradata(video_path):
+                    print('Re-encoded segments do not match the source stream headers, '
+                          'the whole video is re-encoded.')
+                    self.__insert_fallback(ad_insertion, model_config, video_path, video_name,
+                                           [path for output_parts in parts for path, _, _ in output_parts
+                                            if path != video_path])
+                    return
+            if self.checkpoint is not None:
+                self.checkpoint.save({'segments': k + 1})
+            print('Segment {} of {} is re-encoded.'.format(k + 1, len(segments)))
+            if self.progress is not None:
+                self.progress('insertion', (k + 1) / len(segments))
+        if prev_stop < frames_count:
+            for output_parts in parts:
+                output_parts.append((video_path, start_times.get(prev_stop), None))
+
+        with self.metrics.stage('mux'):
+            for o, output in enumerate(outputs):
+                video_io.concat_parts(video_path, parts[o], output,
+                                      '{}/segments_{}.txt'.format(self.paths['files'], o))
+        self.__finish(outputs)
+
+    def __insert_fallback(self, ad_insertion, model_config, video_path, video_name, segment_paths):
+        """
+            Re-encode the whole video in the full mode after the segments mode is given up
+            :param ad_insertion: model used for compositing
+            :param model_config: model configuration
+            :param video_path: source video path
+            :param video_name: source video name without extension
+            :param segment_paths: segment files written so far
+            :return:
+            """
+        for path in segment_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
+            self.checkpoint = None
+        capture = cv.VideoCapture(video_path)
+        try:
+            self.__insert_full(capture, ad_insertion, model_config, video_path, video_name)
+        finally:
+            capture.release()
+
+    @instrumented('insertion')
     def insert_ads(self):
         """
             Model insertion method
             :return: message that describes insertion result
             """
-        video_name = self.video.split('.')[0]
-        output_path = str(Path.cwd()) + '/output'
-        files_path = str(Path.cwd()) + '/files'
-        instances_path = output_path + '/instances'
+        video_name = os.path.splitext(os.path.basename(self.video))[0]
+        input_path = self.paths['input']
+        files_path = self.paths['files']
+        instances_path = self.paths['instances']
+        video_path = os.path.join(input_path, self.video)
+        logo_path = os.path.join(input_path, self.logo)
 
-        if len(os.listdir(files_path)) != 0:
+        if os.path.isdir(files_path) and len(os.listdir(files_path)) != 0:
 
             self.__handle_instances(instances_path)
+            self.assignments = self.__handle_outputs(input_path)
+            logos = sorted({logo for assignment in self.assignments for logo in assignment.values()})
+
+            if any(cv.imread(logo) is None for logo in logos):
+                message = 'ERROR WHILE ENTERING LOGO PATH.'
+                print(message)
 
-            if len(self.all_contours) != 0:
+            elif len(self.plan) != 0:
                 print('Insertion is running...')
-                capture = cv.VideoCapture(output_path + '/' + self.video)
-                read_logo = cv.imread(output_path + '/' + self.logo)
+                if len(self.assignments) > 1:
+                    print('{} output videos are rendered in one pass.'.format(len(self.assignments)))
+                capture = cv.VideoCapture(video_path)
+                read_logo = cv.imread(logo_path)
 
                 info_storage = InfoStorage(capture, read_logo)
                 info_storage.get_info()
                 self.input_info = info_storage.video_info
                 self.input_info['video_name'] = video_name
+                self.input_info['files_path'] = files_path
+                self.input_info['output_path'] = self.paths['output']
 
-                four_cc = cv.VideoWriter_fourcc(*'FMP4')
-                out_name = 'files/result.avi'
-                out = cv.VideoWriter(out_name, four_cc, self.input_info['fps'],
-                                     (self.input_info['width'], self.input_info['height']), True)
-
-                for i in range(self.input_info['frames_count']):
-                    ret, frame = capture.read()
-                    if ret:
-
-                        if i == int(self.input_info['frames_count'] * 0.25):
-                            print('25% of the insertion is completed.')
-                        if i == int(self.input_info['frames_count'] * 0.5):
-                            print('50% of the insertion is completed.')
-                        if i == int(self.input_info['frames_count'] * 0.75):
-                            print('75% of the insertion is completed.')
-                        if i in self.all_contours[:, 0]:
-                            ad_insertion = AdInsertion(frame, output_path + '/' + self.logo,
-                                                       i, None, self.input_info)
-                            ad_insertion.build_model(self.config)
-                            ad_insertion.insert_ad(self.all_contours)
-                            out.write(ad_insertion.frame)
-                        else:
-                            out.write(frame)
-                    else:
-                        break
-                self.__add_audio(output_path, video_name)
+                model_config = ModelConfig.load(self.config)
+                # Decoded frames and their copies for the other outputs are reused, the pool keeps
+                # as many frames as the pipeline queues and compositing threads hold
+                self.buffers = BufferPool((2 * model_config.pipeline_queue_depth + model_config.composite_workers + 2)
+                                          * len(self.assignments))
+                ad_insertion = AdInsertion(None, logo_path,
+                                           None, None, self.input_info)
+                ad_insertion.build_model(model_config)
+                ad_insertion.add_logos(logos)
+                # Segments are checkpointed as they are encoded. The full mode is encoded in parts only on demand,
+                # since the parts and their concatenation cost more than a single pass
+                if model_config.output_mode == 'segments':
+                    checkpoint_interval = model_config.checkpoint_interval
+                else:
+                    checkpoint_interval = model_config.insertion_checkpoint_interval
+                if checkpoint_interval > 0:
+                    key = insertion_key(video_path, os.path.join(files_path, TRACKS_FILE), self.track_ids,
+                                        self.assignments, model_config)
+                    self.checkpoint = Checkpoint(files_path + '/checkpoint_insertion', key)
+
+                if model_config.output_mode == 'segments':
+                    self.__insert_segments(capture, ad_insertion, model_config, video_path, video_name)
+                else:
+                    self.__insert_full(capture, ad_insertion, model_config, video_path, video_name)
                 capture.release()
-                out.release()
+                self.buffers.clear()
+                warp_stats = ad_insertion.warp_stats()
+                self.metrics.count('warp_cache_hits', warp_stats['hits'])
+                self.metrics.count('warp_cache_misses', warp_stats['misses'])
+                print('Warp cache: {} hits, {} misses.'.format(warp_stats['hits'], warp_stats['misses']))
                 print('Insertion completed.')
                 message = 'Video file has been processed.'
                 print(message)
@@ -270,3 +936,101 @@ class InsertionExecutor(object):
             print(message)
 
         return message
+
+
+class SweepExecutor(object):
+    def __init__(self, video, config, overrides, workspace=None, progress=None, metrics=None):
+        """
+        :param video: video file name in the output folder
+        :param config: model configuration path, the base of every swept configuration
+        :param overrides: list of dictionaries with parameters to change in the base configuration
+        :param workspace: job folder, the shared files and output folders are used if not given
+        :param progress: optional function (stage, fraction) called while the job runs
+        :param metrics: JobMetrics that collects stage timings and counters, a new one if not given
+        """
+        self.video = video
+        self.config = config
+        self.overrides = overrides
+        self.paths = workspace_paths(workspace)
+        self.progress = progress
+        self.metrics = metrics if metrics is not None else JobMetrics()
+        self.output_file = None
+
+    def __decode(self, capture, sweep, frames_count, stride):
+        """
+            Decode every frame once and search its contours with all configurations
+            :param capture: video object
+            :param sweep: parameter sweep
+            :param frames_count: video frames amount
+            :param stride: detection frame stride
+            :return:
+            """
+        capture = TimedCapture(capture, self.metrics)
+        frame = None
+        for i in range(frames_count):
+            if i % stride != 0:
+                if not capture.grab():
+                    break
+                continue
+            # Every frame is decoded into the buffer of the previous one
+            ret, frame = capture.read(frame)
+            if not ret:
+                break
+            with self.metrics.stage('detection'):
+                sweep.process_frame(frame, i)
+            if self.progress is not None:
+                self.progress('detection', (i + 1) / frames_count)
+
+    @instrumented('sweep')
+    def run_sweep(self):
+        """
+            Search contours with every configuration in one decoding pass and link their stable tracks.
+            Detections are also stored in the detection cache, so processing with a chosen configuration
+            does not decode the video again
+            :return: message that describes function output
+            """
+        video_path = os.path.join(self.paths['input'], self.video)
+        Path(self.paths['output']).mkdir(parents=True, exist_ok=True)
+        capture = cv.VideoCapture(video_path)
+        fps = capture.get(cv.CAP_PROP_FPS)
+        if int(fps) == 0:
+            message = 'ERROR WHILE ENTERING VIDEO PATH.'
+            print(message)
+            return message
+
+        base = ModelConfig.load(self.config)
+        configs = sweep_configs(base, self.overrides)
+        frames_count = int(capture.get(cv.CAP_PROP_FRAME_COUNT))
+        print('Sweeping {} configurations...'.format(len(configs)))
+        sweep = ParameterSweep(configs, self.paths['files'])
+        try:
+            try:
+                self.__decode(capture, sweep, frames_count, base.detection_stride)
+            finally:
+                capture.release()
+            sweep.finish()
+
+            results = []
+            for i, (values, config) in enumerate(zip(self.overrides, configs)):
+                detections = sweep.detections(i)
+                with self.metrics.stage('tracking'):
+                    tracks = sweep.tracks(i, fps)
+                self.metrics.count('detections', len(detections))
+                results.append({'parameters': values,
+                                'detections': len(detections),
+                                'detected_frames': len(np.unique(detections[:, 0])),
+                                'tracks': len(tracks),
+                                'track_frames': sum(len(track) for track in tracks),
+                                'track_ranges': [[int(track[0, 0]), int(track[-1, 0])] for track in tracks]})
+                if config.detection_cache_mb > 0:
+                    cache = DetectionCache(self.paths['cache'], config.detection_cache_mb * 1024 ** 2)
+                    cache.put(detection_key(video_path, config), detections)
+        finally:
+            sweep.close()
+
+        self.output_file = os.path.join(self.paths['output'], 'sweep_{}.json'.format(self.video.split('.')[0]))
+        with open(self.output_file, 'w') as file:
+            json.dump({'video': self.video, 'frames_count': frames_count, 'results': results}, file, indent=2)
+        message = 'Sweep of {} configurations is completed.'.format(len(configs))
+        print(message)
+        return message
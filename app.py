@@ -1,3 +1,6 @@
+import logging
+import os
+
 import yaml
 
 from flask import Flask
@@ -6,6 +9,7 @@ from flask_restx import Api
 from pathlib import Path
 
 from src import settings
+from src.jobs import JobQueue
 
 
 class AdvApp(Flask):
@@ -19,6 +23,8 @@ class AdvApp(Flask):
 
         self.config['model_config'] = self.load_conf()
 
+        self.jobs = JobQueue(self.root_path / settings.jobs_path, self.conf_path, settings.job_workers)
+
     def load_conf(self) -> dict:
         path = self.default_conf_path if not self.conf_path.is_file() else self.conf_path
 
@@ -30,6 +36,9 @@ class AdvApp(Flask):
             return yaml.dump(self.config['model_config'], file)
 
 
+# Job records are logged as JSON lines next to the print based progress
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+
 app = AdvApp(__name__)
 app.secret_key = b'_5#y2L"F4Q8z\n\xec]/'
 api = Api(app, title='Advertisement REST API', validate=True)
@@ -37,4 +46,7 @@ api = Api(app, title='Advertisement REST API', validate=True)
 from src.views import *
 
 if __name__ == '__main__':
+    # The debug reloader serves from a child process, the watching parent must not run the restored jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        app.jobs.restore()
     app.run(debug=True, host='0.0.0.0', port=80)
@@ -0,0 +1,208 @@
+"""
+Per-frame allocations of the decoding, contours search and compositing steps with new arrays
+for every frame against the buffer pool: Python traced bytes allocated while a frame is handled,
+minor page faults, garbage collections, time per frame and the resident memory growth over the
+run. The moving surface changes its position and size on every frame, as tracked surfaces do.
+
+Run from the repository root:
+    python -m benchmarks.allocations --width 1920 --height 1080 --frames 200
+    python -m benchmarks.allocations --video output/video.mp4 --scale 0.5
+"""
+import argparse
+import gc
+import os
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import cv2 as cv
+import numpy as np
+
+from benchmarks.compositing import make_logo
+from benchmarks.synthetic import write_video
+from models.opencv_model import compositing
+from models.opencv_model.buffers import BufferPool
+from models.opencv_model.detection import scaled_gray, scaled_kernel, threshold_contours
+
+WARMUP_FRAMES = 3
+
+
+def decode_step(video, pool):
+    """
+    :return: function that decodes the next frame, into a pool buffer if a pool is given
+    """
+    capture = cv.VideoCapture(video)
+    state = {'shape': None}
+
+    def step(i):
+        buffer = pool.take(state['shape']) if pool is not None and state['shape'] is not None else None
+        ret, frame = capture.read(buffer)
+        if not ret:
+            capture.set(cv.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = capture.read(buffer)
+        state['shape'] = frame.shape
+        if pool is not None:
+            pool.give(frame)
+    return step
+
+
+def detection_step(frames, scale, kernel, pool):
+    """
+    :return: function that searches contours of the next frame
+    """
+    kernel = scaled_kernel(kernel, scale)
+
+    def step(i):
+        gray = scaled_gray(frames[i % len(frames)], scale, pool)
+        threshold_contours(gray, kernel, pool)
+        if pool is not None:
+            pool.give(gray)
+    return step
+
+
+def resident_mb():
+    """
+    :return: current resident memory in megabytes, the peak one where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm', 'r') as file:
+            return int(file.read().split()[1]) * resource.getpagesize() / 1024 ** 2
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def moving_step(frames, logo, feather, pool):
+    """
+    :return: function that blends the logo into a surface that moves and scales on every frame
+    """
+    frame_h, frame_w = frames[0].shape[:2]
+    cache = compositing.WarpCache(logo, feather)
+
+    def step(i):
+        frame = frames[i % len(frames)]
+        scale = 0.5 + 0.5 * abs(np.sin(i / 37))
+        surface_w, surface_h = int(frame_w / 3 * scale), int(frame_h / 4 * scale)
+        cx = (frame_w - surface_w - 20) * (i % 97) // 97 + 10
+        cy = (frame_h - surface_h - 20) * (i % 89) // 89 + 10
+        quad = [[cx, cy], [cx + 3, cy + surface_h], [cx + surface_w, cy + surface_h + 5], [cx + surface_w - 2, cy]]
+        warped_logo, roi, mask = cache.get(quad, frame_w, frame_h)
+        compositing.blend(frame, warped_logo, roi, mask, feather, pool)
+    return step
+
+
+def compositing_step(frames, logo, feather, pool):
+    """
+    :return: function that blends cached logo warps into two surfaces of the next frame
+    """
+    frame_h, frame_w = frames[0].shape[:2]
+    cache = compositing.WarpCache(logo, feather)
+    quads = []
+    for cx, cy in ((frame_w // 5, frame_h // 5), (frame_w // 2, frame_h // 2)):
+        quads.append([[cx, cy], [cx + 5, cy + frame_h // 5], [cx + frame_w // 5, cy + frame_h // 5 + 10],
+                      [cx + frame_w // 5 - 5, cy - 10]])
+
+    def step(i):
+        frame = frames[i % len(frames)]
+        for quad in quads:
+            warped_logo, roi, mask = cache.get(quad, frame_w, frame_h)
+            compositing.blend(frame, warped_logo, roi, mask, feather, pool)
+    return step
+
+
+def measure(make_step, frames_count):
+    """
+    Run the step over the frames twice: timed with page faults and collections, then traced
+    :param make_step: function () -> step function (frame number)
+    :param frames_count: amount of frames
+    :return: dictionary with per-frame figures
+    """
+    step = make_step()
+    for i in range(WARMUP_FRAMES):
+        step(i)
+    gc.collect()
+    resident = resident_mb()
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+    collections = sum(stats['collections'] for stats in gc.get_stats())
+    start = time.perf_counter()
+    for i in range(frames_count):
+        step(i)
+    seconds = time.perf_counter() - start
+    faults = resource.getrusage(resource.RUSAGE_SELF).ru_minflt - faults
+    collections = sum(stats['collections'] for stats in gc.get_stats()) - collections
+    resident = resident_mb() - resident
+
+    # Tracing restarts for every frame, so the peak is the memory allocated while the frame is handled
+    step = make_step()
+    for i in range(WARMUP_FRAMES):
+        step(i)
+    traced = []
+    for i in range(frames_count):
+        tracemalloc.start()
+        step(i)
+        traced.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {'ms': seconds / frames_count * 1e3,
+            'traced_kb': np.mean(traced) / 1024,
+            'page_faults': faults / frames_count,
+            'collections': collections,
+            'resident_mb': resident}
+
+
+def read_frames(video, count):
+    capture = cv.VideoCapture(video)
+    frames = []
+    while len(frames) < count:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--video', help='video to decode, a synthetic video is written if not given')
+    parser.add_argument('--width', type=int, default=1920, help='synthetic video width')
+    parser.add_argument('--height', type=int, default=1080, help='synthetic video height')
+    parser.add_argument('--frames', type=int, default=200, help='frames measured in every step')
+    parser.add_argument('--scale', type=float, default=1.0, help='detection scale')
+    parser.add_argument('--kernel', type=int, default=5)
+    parser.add_argument('--feather', type=int, default=4)
+    args = parser.parse_args()
+
+    work = None
+    video = args.video
+    if video is None:
+        work = tempfile.mkdtemp(prefix='allocations_benchmark_')
+        video = os.path.join(work, 'synthetic.mkv')
+        write_video(video, args.width, args.height, min(args.frames, 100))
+    try:
+        frames = read_frames(video, 25)
+        bgr, bgra = make_logo(3), make_logo(4)
+        steps = [('decode', lambda pool: decode_step(video, pool)),
+                 ('contours search', lambda pool: detection_step(frames, args.scale, args.kernel, pool)),
+                 ('BGR compositing', lambda pool: compositing_step(frames, bgr, 0, pool)),
+                 ('BGRA compositing', lambda pool: compositing_step(frames, bgra, 0, pool)),
+                 ('feathered compositing', lambda pool: compositing_step(frames, bgra, args.feather, pool)),
+                 ('moving BGRA', lambda pool: moving_step(frames, bgra, 0, pool)),
+                 ('moving feathered', lambda pool: moving_step(frames, bgra, args.feather, pool))]
+        frame_h, frame_w = frames[0].shape[:2]
+        print('{}x{}, {} frames per step, per-frame figures'.format(frame_w, frame_h, args.frames))
+        print('{:<22} {:<8} {:>9} {:>12} {:>12} {:>12} {:>12}'.format('step', 'buffers', 'ms', 'traced KB',
+                                                                      'page faults', 'collections', 'RSS +MB'))
+        for name, make_step in steps:
+            for label, pooled in (('new', False), ('pool', True)):
+                result = measure(lambda: make_step(BufferPool() if pooled else None), args.frames)
+                print('{:<22} {:<8} {:9.2f} {:12.1f} {:12.1f} {:12d} {:12.1f}'.format(
+                    name, label, result['ms'], result['traced_kb'], result['page_faults'], result['collections'],
+                    result['resident_mb']))
+    finally:
+        if work is not None:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Stable contours detection on a synthetic detections table: the former per-row
+implementation against the incremental linkers the tracker runs, fed frame by frame
+through update and finish. The former implementation is quadratic in video length,
+so it runs on the first --legacy-rows rows only, where its result is also compared
+with the chain linker. Both linkers, the chain one and the KD-tree multi-surface
+one, run on the whole table as well.
+
+Run from the repository root:
+    python -m benchmarks.clean_data --rows 1000000
+"""
+import argparse
+import time
+
+import cv2 as cv
+import numpy as np
+from scipy.spatial import distance
+
+from models.opencv_model.detection import frame_groups
+from models.opencv_model.tracking import build_linker
+
+FPS = 25.0
+FIELD_THRESHOLD = 60
+CONTOURS_THRESHOLD = 1.5
+DST_THRESHOLD = 10
+MAX_GAP = 5
+
+
+def synthetic_table(rows, seed=0):
+    """
+    Detections of slowly moving surfaces with clutter and detection gaps
+    :param rows: approximate amount of rows
+    :param seed: random seed
+    :return: detections table (n, 9) sorted by frame and frames amount
+    """
+    rng = np.random.RandomState(seed)
+    frames_count = rows // 2
+    per_frame = rng.choice([0, 1, 2, 3, 4], size=frames_count, p=[0.02, 0.3, 0.3, 0.2, 0.18])
+    # Occasional long gaps split the video into fields
+    for start in rng.randint(0, frames_count, frames_count // 2000):
+        per_frame[start:start + rng.randint(1, 120)] = 0
+
+    frames = np.repeat(np.arange(frames_count), per_frame)
+    slot = np.concatenate([np.arange(count) for count in per_frame]) if len(frames) else frames
+    base_x = 100 + 300 * slot + (frames // 50) % 40
+    base_y = 100 + 150 * slot + rng.randint(-1, 2, len(frames))
+    size = 120 + 10 * slot
+    quads = np.stack([base_x, base_y,
+                      base_x, base_y + size,
+                      base_x + 2 * size, base_y + size,
+                      base_x + 2 * size, base_y], axis=1)
+    quads += rng.randint(-2, 3, quads.shape)
+    return np.column_stack([frames, quads]).astype(np.int64), frames_count
+
+
+def legacy_clean_data(data, frames_count, fps, field_threshold, contours_threshold, dst_threshold):
+    """
+    Former AdInsertion.__clean_data
+    """
+    stable_contours = []
+    unique_idx = np.unique(data[:, 0])
+    expected = [i if i in unique_idx else 'X' for i in range(frames_count)]
+    x_ids = [i for i, j in enumerate(expected) if j == 'X']
+    intervals = [[x_ids[i] + 1, x_ids[i + 1] - 1] for i in range(len(x_ids) - 1)
+                 if (x_ids[i + 1] - x_ids[i]) > field_threshold]
+
+    if x_ids[0] > field_threshold:
+        intervals.insert(0, [0, x_ids[0]])
+
+    if frames_count - x_ids[-1] > field_threshold:
+        intervals.append([x_ids[-1] + 1, frames_count])
+
+    for interval in intervals:
+        condition = np.logical_and(data[:, 0] >= interval[0], data[:, 0] <= interval[1])
+        stable = data[condition]
+
+        prev_cnt = stable[0, :]
+        prev_contour = np.array([[prev_cnt[1], prev_cnt[2]], [prev_cnt[3], prev_cnt[4]],
+                                 [prev_cnt[5], prev_cnt[6]], [prev_cnt[7], prev_cnt[8]]], dtype=np.int32)
+        prev_m = cv.moments(prev_contour)
+        prev_cx = int(prev_m['m10'] / prev_m['m00'])
+        prev_cy = int(prev_m['m01'] / prev_m['m00'])
+        stable_contour = []
+        for i, row in enumerate(stable):
+            if row[0] - prev_cnt[0] == 0:
+                continue
+            elif row[0] - prev_cnt[0] == 1:
+                contour = np.array([[row[1], row[2]], [row[3], row[4]],
+                                    [row[5], row[6]], [row[7], row[8]]], dtype=np.int32)
+                m = cv.moments(contour)
+                base_cx = int(m['m10'] / m['m00'])
+                base_cy = int(m['m01'] / m['m00'])
+
+                dist = distance.euclidean([base_cx, base_cy], [prev_cx, prev_cy])
+                if dist < dst_threshold:
+                    stable_contour.append(row)
+                    prev_cnt = row
+                    prev_cx = base_cx
+                    prev_cy = base_cy
+
+        if len(stable_contour) >= int(fps) * contours_threshold:
+            stable_contours.append(np.array(stable_contour))
+    return stable_contours
+
+
+def run(function, data, frames_count):
+    start = time.perf_counter()
+    result = function(data, frames_count, FPS, FIELD_THRESHOLD, CONTOURS_THRESHOLD, DST_THRESHOLD)
+    return result, time.perf_counter() - start
+
+
+def run_linker(tracker, data):
+    """
+    Feed the detections table to the incremental linker frame by frame, as the tracker is fed during detection
+    :param tracker: kdtree or chain
+    :param data: detections table (n, 9) sorted by frame
+    :return: stable tracks ordered by their first frame and the linking time
+    """
+    start = time.perf_counter()
+    linker = build_linker(tracker, FPS, FIELD_THRESHOLD, CONTOURS_THRESHOLD, DST_THRESHOLD, MAX_GAP)
+    tracks = []
+    for frame_idx, rows in frame_groups(data):
+        tracks.extend(linker.update(frame_idx, rows))
+    tracks.extend(linker.finish())
+    tracks.sort(key=lambda track: track[0, 0])
+    return tracks, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--legacy-rows', type=int, default=50000)
+    args = parser.parse_args()
+
+    data, frames_count = synthetic_table(args.rows)
+    small_frames = int(data[min(args.legacy_rows, len(data)) - 1, 0]) + 1
+    small = data[data[:, 0] < small_frames]
+
+    legacy, legacy_time = run(legacy_clean_data, small, small_frames)
+    current, current_small_time = run_linker('chain', small)
+    identical = len(legacy) == len(current) and all(np.array_equal(a, b) for a, b in zip(legacy, current))
+    print('{} rows, {} frames: former {:.2f}s, chain linker {:.3f}s, identical: {}'.format(
+        len(small), small_frames, legacy_time, current_small_time, identical))
+
+    current, current_time = run_linker('chain', data)
+    print('{} rows, {} frames: chain linker {:.3f}s, {} stable contours'.format(
+        len(data), frames_count, current_time, len(current)))
+
+    tracks, tracks_time = run_linker('kdtree', data)
+    print('{} rows, {} frames: KD-tree linker {:.3f}s, {} stable tracks, {} rows in tracks'.format(
+        len(data), frames_count, tracks_time, len(tracks), sum(len(track) for track in tracks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Compositing micro-benchmark: per-frame cost of inserting BGR and BGRA logos,
+with and without feathered edges, plus the former per-pixel copy loop for BGR logos
+and the warp cache on a surface that moves by a pixel every few frames.
+
+Run from the repository root:
+    python -m benchmarks.compositing --width 1920 --height 1080
+"""
+import argparse
+import time
+
+import cv2 as cv
+import numpy as np
+
+from models.opencv_model import compositing
+
+
+def make_logo(channels):
+    logo = np.zeros((200, 400, channels), np.uint8)
+    logo[:, :, 0] = np.linspace(0, 255, 400)[None]
+    cv.putText(logo, 'BRAND', (20, 140), cv.FONT_HERSHEY_SIMPLEX, 4, (255,) * channels, 12)
+    if channels == 4:
+        logo[:, :, 3] = np.where(logo[:, :, 1] > 0, 255, 0)
+    return logo
+
+
+def per_pixel_copy(frame, warped_logo, roi, quad):
+    """
+    Former BGR insertion: float mask and a Python loop over the contour pixels
+    """
+    x0, y0, x1, y1 = roi
+    mask = np.zeros((y1 - y0, x1 - x0))
+    cv.drawContours(mask, [np.array(quad)], -1, 1, -1, offset=(-x0, -y0))
+    for i, j in np.argwhere(mask == 1):
+        frame[y0 + i, x0 + j] = warped_logo[i, j, 0:3]
+    return frame
+
+
+def run(frame, logo, quad, repeats, feather=0, insert=None):
+    frame_h, frame_w = frame.shape[:2]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        warped_logo, roi = compositing.transform_logo(logo, quad, frame_w, frame_h)
+        if insert is None:
+            compositing.composite(frame, warped_logo, roi, quad, feather)
+        else:
+            insert(frame, warped_logo, roi, quad)
+    return (time.perf_counter() - start) / repeats * 1e3
+
+
+def run_cached(frame, logo, quad, repeats, still, feather=0):
+    """
+    Insertion through the warp cache. Smoothed tracks have integer corners, the surface stays still
+    for a few frames and then moves by a pixel
+    :return: milliseconds per frame and cache statistics
+    """
+    frame_h, frame_w = frame.shape[:2]
+    cache = compositing.WarpCache(logo, feather)
+    quad = np.float32(quad)
+    start = time.perf_counter()
+    for i in range(repeats):
+        warped_logo, roi, mask = cache.get(quad + np.float32(i // still), frame_w, frame_h)
+        compositing.blend(frame, warped_logo, roi, mask, feather)
+    return (time.perf_counter() - start) / repeats * 1e3, cache.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--feather', type=int, default=4)
+    parser.add_argument('--still', type=int, default=5, help='frames the surface stays still for the warp cache')
+    args = parser.parse_args()
+
+    frame = np.full((args.height, args.width, 3), 90, np.uint8)
+    cx, cy = args.width // 3, args.height // 3
+    quad = [[cx, cy], [cx + 5, cy + 200], [cx + 405, cy + 210], [cx + 400, cy - 10]]
+    bgr, bgra = make_logo(3), make_logo(4)
+
+    print('frame {}x{}, surface ~400x200, ms per frame'.format(args.width, args.height))
+    print('BGR per-pixel loop:   {:8.2f}'.format(run(frame, bgr, quad, max(1, args.repeats // 10),
+                                                     insert=per_pixel_copy)))
+    print('BGR:                  {:8.2f}'.format(run(frame, bgr, quad, args.repeats)))
+    print('BGRA:                 {:8.2f}'.format(run(frame, bgra, quad, args.repeats)))
+    print('BGR feathered:        {:8.2f}'.format(run(frame, bgr, quad, args.repeats, args.feather)))
+    print('BGRA feathered:       {:8.2f}'.format(run(frame, bgra, quad, args.repeats, args.feather)))
+    for name, logo, feather in (('BGR', bgr, 0), ('BGRA', bgra, 0), ('BGRA feathered', bgra, args.feather)):
+        seconds, stats = run_cached(frame, logo, quad, args.repeats, args.still, feather)
+        print('{:<27}{:8.2f}  {} hits, {} misses'.format(name + ' warp cache:', seconds, stats['hits'],
+                                                         stats['misses']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Per-frame model setup overhead: building AdInsertion and parsing the
+configuration for every frame versus one reusable model per job.
+
+Run from the repository root:
+    python -m benchmarks.config_overhead --frames 2000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from models.opencv_model.ad_insertion import AdInsertion
+from models.opencv_model.config import ModelConfig
+from src import settings
+
+VIDEO_INFO = {'fps': 25.0, 'video_name': 'benchmark', 'logo_ratio': 1.0, 'frames_count': 0}
+
+
+def per_frame_model(frames, conf_path):
+    data = []
+    start = time.perf_counter()
+    for i, frame in enumerate(frames):
+        ad_insertion = AdInsertion(frame, None, i, data, VIDEO_INFO)
+        ad_insertion.build_model(conf_path)
+        ad_insertion.data_preprocessed()
+    return time.perf_counter() - start
+
+
+def reused_model(frames, conf_path):
+    data = []
+    start = time.perf_counter()
+    ad_insertion = AdInsertion(None, None, None, data, VIDEO_INFO)
+    ad_insertion.build_model(ModelConfig.load(conf_path))
+    for i, frame in enumerate(frames):
+        ad_insertion.process_frame(frame, i)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=16, help='frame side, small frames isolate the overhead')
+    parser.add_argument('--conf', default=str(settings.default_conf_path))
+    args = parser.parse_args()
+
+    frames = [np.zeros((args.size, args.size, 3), np.uint8) for _ in range(args.frames)]
+    before = per_frame_model(frames, args.conf)
+    after = reused_model(frames, args.conf)
+
+    print('frames: {}, frame size: {}x{}'.format(args.frames, args.size, args.size))
+    print('per-frame model:  {:.1f} us/frame'.format(before / args.frames * 1e6))
+    print('reused model:     {:.1f} us/frame'.format(after / args.frames * 1e6))
+    print('speedup:          {:.1f}x'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
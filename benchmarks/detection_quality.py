@@ -0,0 +1,82 @@
+"""
+Reduced-resolution, frame-stride and optical-flow detection quality: runs the detection
+pass at native resolution and with the given scale/stride/mode, then reports timings,
+the corner error of the reduced detection against the native one and the corner jitter
+(mean absolute second difference of the corners along stable tracks) of both.
+
+Run from the repository root:
+    python -m benchmarks.detection_quality --video output/video.mp4 --scale 0.5 --stride 2
+    python -m benchmarks.detection_quality --video output/video.mp4 --scale 1 --mode flow
+"""
+import argparse
+import dataclasses
+import json
+import time
+
+import cv2 as cv
+import numpy as np
+
+from ad_insertion_executor import detect_frame_range
+from models.opencv_model.config import ModelConfig
+from models.opencv_model.detection import corner_error, frame_groups, interpolate_skipped_frames
+from models.opencv_model.tracking import build_linker, orient_corners
+from src import settings
+
+
+def run_detection(video, video_info, model_config):
+    start = time.perf_counter()
+    data, _, _ = detect_frame_range((video, 0, video_info['frames_count'], video_info, model_config))
+    data = interpolate_skipped_frames(data, model_config.detection_stride, model_config.dst_threshold)
+    return data, time.perf_counter() - start
+
+
+def corner_jitter(data, video_info, model_config):
+    linker = build_linker(model_config.tracker, video_info['fps'], model_config.field_threshold,
+                          model_config.contour_threshold, model_config.dst_threshold, model_config.max_gap)
+    tracks = []
+    for frame_idx, rows in frame_groups(data):
+        tracks.extend(linker.update(frame_idx, rows))
+    tracks.extend(linker.finish())
+    jitter = [np.abs(np.diff(orient_corners(track)[:, 1:], n=2, axis=0)).ravel()
+              for track in tracks if len(track) > 2]
+    return float(np.concatenate(jitter).mean()) if jitter else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--video', required=True)
+    parser.add_argument('--scale', type=float, default=0.5)
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--mode', choices=('full', 'flow'), default='full')
+    parser.add_argument('--conf', default=str(settings.default_conf_path))
+    args = parser.parse_args()
+
+    capture = cv.VideoCapture(args.video)
+    video_info = {'fps': capture.get(cv.CAP_PROP_FPS), 'video_name': 'benchmark', 'logo_ratio': 1.0,
+                  'frames_count': int(capture.get(cv.CAP_PROP_FRAME_COUNT))}
+    capture.release()
+
+    model_config = ModelConfig.load(args.conf)
+    native_config = dataclasses.replace(model_config, detection_scale=1.0, detection_stride=1,
+                                        detection_mode='full')
+    reduced_config = dataclasses.replace(model_config, detection_scale=args.scale, detection_stride=args.stride,
+                                         detection_mode=args.mode)
+
+    native, native_time = run_detection(args.video, video_info, native_config)
+    reduced, reduced_time = run_detection(args.video, video_info, reduced_config)
+
+    report = corner_error(native, reduced, model_config.dst_threshold)
+    report.update({'frames': video_info['frames_count'],
+                   'scale': args.scale,
+                   'stride': args.stride,
+                   'mode': args.mode,
+                   'native_fps': video_info['frames_count'] / native_time,
+                   'reduced_fps': video_info['frames_count'] / reduced_time,
+                   'reduced_contours': len(reduced),
+                   'native_jitter': corner_jitter(native, video_info, model_config),
+                   'reduced_jitter': corner_jitter(reduced, video_info, model_config)})
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+The memory mapped TrackStore against the pickled object array of stable contours:
+save time, load time (including selection of the kept tracks into an InsertionPlan)
+and file size, and the per-frame lookup cost of the plan.
+
+Run from the repository root:
+    python -m benchmarks.insertion_plan --frames 180000 --tracks 300
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from models.opencv_model.insertion_plan import InsertionPlan
+from models.opencv_model.storage import TRACKS_FILE, TrackStore
+
+
+def make_tracks(frames_count, tracks_count, seed=0):
+    rng = np.random.RandomState(seed)
+    tracks = []
+    for _ in range(tracks_count):
+        length = rng.randint(40, 2000)
+        start = rng.randint(0, frames_count - length)
+        corners = rng.randint(0, 1000, 8) + np.cumsum(rng.randint(-1, 2, (length, 8)), axis=0)
+        tracks.append(np.column_stack([np.arange(start, start + length), corners]))
+    return tracks
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def load_pickled(filename, kept):
+    """
+    Former InsertionExecutor instances handling: pickled load and row by row selection
+    """
+    all_contours = []
+    stable_contours = np.load(filename, allow_pickle=True)
+    for i, contour in enumerate(stable_contours):
+        if i in kept:
+            for frame_contour in contour:
+                all_contours.append(frame_contour)
+    return np.array(all_contours)
+
+
+def load_store(filename, kept):
+    return TrackStore.open(filename).plan(kept)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, default=180000)
+    parser.add_argument('--tracks', type=int, default=300)
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    tracks = make_tracks(args.frames, args.tracks)
+    plan = InsertionPlan.from_tracks(tracks, args.frames)
+    lookups = np.random.RandomState(1).randint(0, args.frames, args.lookups)
+
+    with tempfile.TemporaryDirectory() as folder:
+        pickled_path = os.path.join(folder, 'all_instances.npy')
+        store_path = os.path.join(folder, TRACKS_FILE)
+
+        objects = np.empty(len(tracks), dtype=object)
+        objects[:] = tracks
+        kept = list(range(0, args.tracks, 2))
+        _, pickled_save = timed(np.save, pickled_path, objects)
+        _, pickled_load = timed(load_pickled, pickled_path, kept)
+        _, store_save = timed(TrackStore.save, store_path, tracks, args.frames)
+        stored, store_load = timed(load_store, store_path, kept)
+        assert np.array_equal(stored.quads, plan.select(kept).quads)
+
+        print('rows: {}, tracks: {}, kept tracks: {}'.format(len(plan), args.tracks, len(kept)))
+        print('pickled npy: save {:.3f}s load {:.3f}s size {:.1f} MB'.format(
+            pickled_save, pickled_load, os.path.getsize(pickled_path) / 2 ** 20))
+        print('track store: save {:.3f}s load {:.3f}s size {:.1f} MB'.format(
+            store_save, store_load, os.path.getsize(store_path) / 2 ** 20))
+
+    all_contours = np.concatenate(tracks)
+    _, scan = timed(lambda: [i in all_contours[:, 0] for i in lookups])
+    _, indexed = timed(lambda: [plan.quads_for(i) for i in lookups if i in plan])
+    print('per-frame lookup: array scan {:.1f} us, plan {:.1f} us'.format(
+        scan / args.lookups * 1e6, indexed / args.lookups * 1e6))
+
+
+if __name__ == '__main__':
+    main()
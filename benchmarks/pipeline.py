@@ -0,0 +1,270 @@
+"""
+Pipeline benchmark suite on synthetic videos: every stage is timed separately
+(decode, contours search, stable contours linking, orientation, smoothing, logo
+insertion, encoding and audio muxing) and reported with its frames per second,
+the peak RSS of the run so far and, with --tracemalloc, the traced peak memory and
+the live memory blocks left by the stage. Results are printed and saved as JSON,
+so runs can be compared over time.
+
+Run from the repository root:
+    python -m benchmarks.pipeline --sizes 640x360,1920x1080 --frames 300 --json output/pipeline.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import cv2 as cv
+import numpy as np
+
+import video_io
+from benchmarks.compositing import make_logo
+from benchmarks.synthetic import write_video
+from models.opencv_model.ad_insertion import AdInsertion
+from models.opencv_model.config import ModelConfig
+from models.opencv_model.insertion_plan import InsertionPlan
+from models.opencv_model.tracking import build_linker, orient_corners, smooth_corners
+from src import settings
+
+
+class StageTimer(object):
+    """
+    Collects duration, peak RSS and optional tracemalloc figures of the pipeline stages. The stages run in one
+    process, so the peak RSS after a stage is the peak of the run up to its end, not the peak of the stage alone
+    """
+    def __init__(self, trace_allocations):
+        self.trace_allocations = trace_allocations
+        self.stages = {}
+
+    def run(self, name, frames, function, *args):
+        """
+        Run and measure one stage
+        :param name: stage name
+        :param frames: amount of frames the stage handles
+        :param function: stage function
+        :param args: stage function arguments
+        :return: stage function result
+        """
+        if self.trace_allocations:
+            tracemalloc.start()
+        start = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start
+        stage = {'seconds': seconds,
+                 'frames': frames,
+                 'fps': frames / seconds if seconds > 0 else None,
+                 'cumulative_peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF),
+                 'cumulative_peak_child_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+        if self.trace_allocations:
+            snapshot = tracemalloc.take_snapshot()
+            stage['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+            # Memory blocks allocated by the stage and still alive at its end, not the amount of allocations
+            stage['live_blocks'] = sum(stat.count for stat in snapshot.statistics('filename'))
+            tracemalloc.stop()
+        self.stages[name] = stage
+        return result
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is given in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def read_frames(video):
+    capture = cv.VideoCapture(video)
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        yield frame
+    capture.release()
+
+
+def decode(video):
+    return sum(1 for _ in read_frames(video))
+
+
+def find_contours(video, ad_insertion):
+    """
+    Contours search of every frame, decoding time is excluded
+    :return: list of (frame index, array (k, 9) with the frame contours) and the search time
+    """
+    detections = []
+    data = ad_insertion.data
+    seconds = 0.0
+    for frame_idx, frame in enumerate(read_frames(video)):
+        start = time.perf_counter()
+        ad_insertion.process_frame(frame, frame_idx)
+        if data:
+            detections.append((frame_idx, np.array(data, dtype=np.int64)))
+            del data[:]
+        seconds += time.perf_counter() - start
+    return detections, seconds
+
+
+def clean_data(detections, config, fps):
+    """
+    Same linking as AdInsertion.__clean_data
+    :return: stable tracks
+    """
+    linker = build_linker(config.tracker, fps, config.field_threshold, config.contour_threshold,
+                          config.dst_threshold, config.max_gap)
+    tracks = []
+    for frame_idx, rows in detections:
+        tracks.extend(linker.update(frame_idx, rows))
+    tracks.extend(linker.finish())
+    tracks.sort(key=lambda track: track[0, 0])
+    return tracks
+
+
+def insert_logos(video, ad_insertion, plan):
+    """
+    Logo insertion into the frames of the plan, decoding time is excluded
+    :return: composited frames amount and the insertion time
+    """
+    frames = 0
+    seconds = 0.0
+    for frame_idx, frame in enumerate(read_frames(video)):
+        if frame_idx in plan:
+            start = time.perf_counter()
+            ad_insertion.insert_frame(frame, frame_idx, plan)
+            seconds += time.perf_counter() - start
+            frames += 1
+    return frames, seconds
+
+
+def encode(video, output, width, height, fps, config):
+    """
+    Encode the decoded frames without audio, decoding time is excluded
+    :return: encoding time
+    """
+    writer = video_io.FFmpegWriter(output, width, height, fps, config.output_codec,
+                                   options=video_io.preset_options(config.output_preset))
+    seconds = 0.0
+    for frame in read_frames(video):
+        start = time.perf_counter()
+        writer.write(frame)
+        seconds += time.perf_counter() - start
+    start = time.perf_counter()
+    writer.release()
+    return seconds + time.perf_counter() - start
+
+
+def mux_audio(video, audio_source, output):
+    subprocess.run([video_io.FFMPEG, '-y', '-v', 'error', '-i', video, '-i', audio_source,
+                    '-map', '0:v:0', '-map', '1:a?', '-c', 'copy', output], check=True)
+
+
+def run_size(width, height, frames_count, fps, config, logo, work, trace_allocations):
+    """
+    Benchmark every stage on one synthetic video
+    :return: dictionary with the video parameters and stage figures
+    """
+    video = os.path.join(work, 'synthetic_{}x{}.mkv'.format(width, height))
+    write_video(video, width, height, frames_count, fps)
+    video_info = {'fps': fps, 'video_name': 'benchmark', 'logo_ratio': logo.shape[0] / logo.shape[1],
+                  'frames_count': frames_count, 'width': width, 'height': height,
+                  'files_path': work, 'output_path': work}
+    logo_path = os.path.join(work, 'logo.png')
+    cv.imwrite(logo_path, logo)
+
+    timer = StageTimer(trace_allocations)
+    timer.run('decode', frames_count, decode, video)
+
+    ad_insertion = AdInsertion(None, logo_path, None, [], video_info)
+    ad_insertion.build_model(config)
+    detections, seconds = timer.run('find_contours', frames_count, find_contours, video, ad_insertion)
+    # Decoding is excluded from the stages that need frames
+    timer.stages['find_contours'].update({'seconds': seconds, 'fps': frames_count / seconds})
+
+    tracks = timer.run('clean_data', frames_count, clean_data, detections, config, fps)
+    tracks = timer.run('orientation', sum(len(track) for track in tracks),
+                       lambda: [orient_corners(track) for track in tracks])
+    tracks = timer.run('smoothing', sum(len(track) for track in tracks),
+                       lambda: [smooth_corners(track, config.window, config.poly_order) for track in tracks])
+
+    plan = InsertionPlan.from_tracks(tracks, frames_count)
+    inserted, seconds = timer.run('insert_ad', frames_count, insert_logos, video, ad_insertion, plan)
+    timer.stages['insert_ad'].update({'seconds': seconds, 'frames': inserted,
+                                      'fps': inserted / seconds if seconds > 0 else None})
+
+    encoded = os.path.join(work, 'encoded.' + config.output_container)
+    seconds = timer.run('encode', frames_count, encode, video, encoded, width, height, fps, config)
+    timer.stages['encode'].update({'seconds': seconds, 'fps': frames_count / seconds})
+    timer.run('audio_mux', frames_count, mux_audio, encoded, video,
+              os.path.join(work, 'muxed.' + config.output_container))
+
+    return {'width': width,
+            'height': height,
+            'frames': frames_count,
+            'detections': int(sum(len(rows) for _, rows in detections)),
+            'tracks': len(tracks),
+            'stages': timer.stages}
+
+
+def git_commit():
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return None
+    return output.stdout.decode().strip() or None
+
+
+def print_report(result):
+    print('{}x{}, {} frames, {} detections, {} tracks'.format(result['width'], result['height'], result['frames'],
+                                                              result['detections'], result['tracks']))
+    for name, stage in result['stages'].items():
+        line = '  {:<14} {:8.3f} s {:>10} fps  cumulative peak RSS {:7.1f} MB'.format(
+            name, stage['seconds'], '{:.1f}'.format(stage['fps']) if stage['fps'] else '-',
+            stage['cumulative_peak_rss_mb'])
+        if 'live_blocks' in stage:
+            line += '  traced peak {:6.1f} MB, {} live blocks'.format(stage['traced_peak_mb'], stage['live_blocks'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='640x360,1280x720', help='comma separated WIDTHxHEIGHT list')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--fps', type=float, default=25.0)
+    parser.add_argument('--conf', default=str(settings.default_conf_path))
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='also report traced Python memory, stages run slower while tracing')
+    parser.add_argument('--json', help='file to save the results to')
+    args = parser.parse_args()
+
+    config = ModelConfig.load(args.conf)
+    logo = make_logo(3)
+    results = {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'commit': git_commit(),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'opencv': cv.__version__,
+               'tracemalloc': args.tracemalloc,
+               'config': config.to_dict(),
+               'runs': []}
+    work = tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    try:
+        for size in args.sizes.split(','):
+            width, height = (int(value) for value in size.lower().split('x'))
+            result = run_size(width, height, args.frames, args.fps, config, logo, work, args.tracemalloc)
+            print_report(result)
+            results['runs'].append(result)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+        print('Results are saved to {}.'.format(args.json))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Detection parameters sweep: searches contours with a grid of configurations (kernel,
+contour area and perimeter thresholds) in one decoding pass and compares it with one
+detection pass per configuration. Detections of both must be the same.
+
+Run from the repository root:
+    python -m benchmarks.sweep --frames 300
+    python -m benchmarks.sweep --video output/video.mp4 --kernels 3,5,7 --areas 2000,4000 --perimeters 0.02,0.035
+"""
+import argparse
+import dataclasses
+import itertools
+import os
+import shutil
+import tempfile
+import time
+
+import cv2 as cv
+import numpy as np
+
+from ad_insertion_executor import detect_frame_range
+from benchmarks.synthetic import write_video
+from models.opencv_model.config import ModelConfig
+from models.opencv_model.sweep import ParameterSweep, sweep_configs
+from src import settings
+
+
+def run_sweep(video, configs, folder):
+    """
+    One decoding pass for all configurations
+    :return: parameter sweep and its time
+    """
+    start = time.perf_counter()
+    sweep = ParameterSweep(configs, folder)
+    capture = cv.VideoCapture(video)
+    frame_idx = 0
+    while True:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        sweep.process_frame(frame, frame_idx)
+        frame_idx += 1
+    capture.release()
+    sweep.finish()
+    return sweep, time.perf_counter() - start
+
+
+def run_separately(video, video_info, configs):
+    """
+    One decoding pass per configuration
+    :return: list of detections arrays and their time
+    """
+    start = time.perf_counter()
+    detections = [detect_frame_range((video, 0, video_info['frames_count'], video_info, config))[0]
+                  for config in configs]
+    return detections, time.perf_counter() - start
+
+
+def parse_list(text, cast):
+    return [cast(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--video', help='video to sweep, a synthetic 640x360 video is written if not given')
+    parser.add_argument('--frames', type=int, default=300, help='synthetic video length')
+    parser.add_argument('--kernels', default='3,5,7,9')
+    parser.add_argument('--areas', default='2000,4000', help='min_area_threshold values')
+    parser.add_argument('--perimeters', default='0.02,0.035,0.05', help='perimeter_threshold values')
+    parser.add_argument('--conf', default=str(settings.default_conf_path))
+    args = parser.parse_args()
+
+    # Detections of the sweep are written to the temporary folder too
+    work = tempfile.mkdtemp(prefix='sweep_benchmark_')
+    video = args.video
+    try:
+        if video is None:
+            video = os.path.join(work, 'synthetic.mkv')
+            write_video(video, 640, 360, args.frames, quads=4)
+        capture = cv.VideoCapture(video)
+        video_info = {'fps': capture.get(cv.CAP_PROP_FPS), 'video_name': 'benchmark', 'logo_ratio': 1.0,
+                      'frames_count': int(capture.get(cv.CAP_PROP_FRAME_COUNT))}
+        capture.release()
+
+        # Detection always runs on every frame in full mode, so both sides decode the same frames
+        base = ModelConfig.load(args.conf)
+        base = dataclasses.replace(base, detection_stride=1, detection_mode='full')
+        overrides = [{'kernel': kernel, 'min_area_threshold': area, 'perimeter_threshold': perimeter}
+                     for kernel, area, perimeter in itertools.product(parse_list(args.kernels, int),
+                                                                      parse_list(args.areas, int),
+                                                                      parse_list(args.perimeters, float))]
+        configs = sweep_configs(base, overrides)
+
+        sweep, sweep_seconds = run_sweep(video, configs, work)
+        detections, separate_seconds = run_separately(video, video_info, configs)
+
+        frames = video_info['frames_count']
+        print('{} configurations, {} frames'.format(len(configs), frames))
+        print('{:<24} {:8.3f} s {:8.1f} fps'.format('one pass per config', separate_seconds,
+                                                    len(configs) * frames / separate_seconds))
+        print('{:<24} {:8.3f} s {:8.1f} fps'.format('one pass sweep', sweep_seconds,
+                                                    len(configs) * frames / sweep_seconds))
+        print('Speedup: {:.2f}x'.format(separate_seconds / sweep_seconds))
+        for i, (values, rows) in enumerate(zip(overrides, detections)):
+            swept = sweep.detections(i)
+            print('  {}: {} detections, {}'.format(values, len(swept),
+                                                   'same' if np.array_equal(swept, rows) else 'DIFFERENT'))
+        sweep.close()
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
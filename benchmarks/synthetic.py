@@ -0,0 +1,164 @@
+"""
+Deterministic synthetic test video: moving, scaling and occluded quadrilaterals
+over a textured, slowly panning background, with a sine tone audio track.
+
+Run from the repository root to write a video:
+    python -m benchmarks.synthetic --output output/synthetic.mkv --width 1280 --height 720 --frames 500
+"""
+import argparse
+import math
+import os
+import wave
+
+import cv2 as cv
+import numpy as np
+
+import video_io
+
+SAMPLE_RATE = 44100
+
+
+class SyntheticVideo(object):
+    """
+    Frames generator. The same parameters and seed always give the same frames
+    """
+    def __init__(self, width, height, frames_count, quads=3, seed=0):
+        """
+        :param width: frame width
+        :param height: frame height
+        :param frames_count: video length in frames
+        :param quads: amount of quadrilaterals
+        :param seed: random seed
+        """
+        self.width = width
+        self.height = height
+        self.frames_count = frames_count
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+
+        # Coarse noise upscaled to a smooth texture, kept dark enough for the quads to stand out
+        coarse = rng.randint(0, 256, (max(2, height // 16), max(2, width // 16), 3)).astype(np.uint8)
+        texture = cv.resize(coarse, (width + frames_count // 4 + 1, height), interpolation=cv.INTER_CUBIC)
+        self.texture = (40 + texture.astype(np.uint16) * 100 // 255).astype(np.uint8)
+
+        # Every quad moves around the center of its own grid cell, so quads never overlap. Their side
+        # is relative to the cell, capped to stay within the default contour area thresholds
+        cols = int(math.ceil(math.sqrt(quads)))
+        rows = int(math.ceil(quads / cols)) if quads else 1
+        cell = np.array([width / cols, height / rows])
+        side = min(0.6 * cell[0], cell[1], 0.2 * width, 260.0)
+        self.quads = []
+        for i in range(quads):
+            start = int(rng.randint(0, max(1, frames_count // 3)))
+            center = (np.array([i % cols, i // cols]) + 0.5 + rng.uniform(-0.1, 0.1, 2)) * cell
+            self.quads.append({'start': start,
+                               'stop': int(rng.randint(start + max(1, frames_count // 3), frames_count + 1)),
+                               'center': center,
+                               'velocity': rng.uniform(-1.0, 1.0, 2),
+                               'period': rng.uniform(40, 120),
+                               'size': np.array([side, side * 0.6]) * rng.uniform(0.85, 1.0),
+                               'skew': rng.uniform(-0.1, 0.1, 4),
+                               'color': tuple(int(c) for c in rng.randint(220, 256, 3))})
+        self.occluder_width = max(4, width // 20)
+        self.noise = np.random.RandomState(seed + 1)
+
+    def quad_corners(self, quad, frame_idx):
+        """
+        Corners of the quad in the frame
+        :param quad: quad parameters
+        :param frame_idx: frame index
+        :return: array (4, 2) with corners
+        """
+        t = frame_idx - quad['start']
+        center = quad['center'] + quad['velocity'] * 20 * math.sin(2 * math.pi * t / quad['period'])
+        scale = 1 + 0.2 * math.sin(2 * math.pi * t / (2 * quad['period']))
+        w, h = quad['size'] * scale / 2
+        skew = quad['skew'] * h
+        return np.array([[center[0] - w, center[1] - h + skew[0]],
+                         [center[0] - w, center[1] + h + skew[1]],
+                         [center[0] + w, center[1] + h + skew[2]],
+                         [center[0] + w, center[1] - h + skew[3]]])
+
+    def frame(self, frame_idx):
+        """
+        :param frame_idx: frame index
+        :return: BGR frame
+        """
+        shift = frame_idx // 4
+        frame = self.texture[:, shift:shift + self.width].copy()
+        for quad in self.quads:
+            if quad['start'] <= frame_idx < quad['stop']:
+                corners = np.rint(self.quad_corners(quad, frame_idx)).astype(np.int32)
+                cv.fillConvexPoly(frame, corners, quad['color'])
+
+        # Occluder bar sweeps across the frame and splits the tracks it crosses
+        x = int((frame_idx * 7) % (self.width + self.occluder_width)) - self.occluder_width
+        frame[:, max(0, x):max(0, x + self.occluder_width)] = 20
+
+        noise = self.noise.randint(-3, 4, frame.shape[:2], dtype=np.int16)[:, :, None]
+        return np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+    def __iter__(self):
+        for frame_idx in range(self.frames_count):
+            yield self.frame(frame_idx)
+
+
+def write_tone(filename, seconds, frequency=440.0):
+    """
+    Write a mono 16 bit sine tone wav file
+    :param filename: file path
+    :param seconds: duration
+    :param frequency: tone frequency
+    :return:
+    """
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    samples = (0.3 * 32767 * np.sin(2 * math.pi * frequency * t)).astype('<i2')
+    with wave.open(filename, 'wb') as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(SAMPLE_RATE)
+        file.writeframes(samples.tobytes())
+
+
+def write_video(filename, width, height, frames_count, fps=25.0, quads=3, seed=0, codec='libx264'):
+    """
+    Encode a synthetic video with a tone audio track
+    :param filename: output video path
+    :param width: frame width
+    :param height: frame height
+    :param frames_count: video length in frames
+    :param fps: video frames per second
+    :param quads: amount of quadrilaterals
+    :param seed: random seed
+    :param codec: ffmpeg encoder name
+    :return: synthetic video generator
+    """
+    video = SyntheticVideo(width, height, frames_count, quads, seed)
+    tone = os.path.splitext(filename)[0] + '_tone.wav'
+    write_tone(tone, frames_count / fps)
+    writer = video_io.FFmpegWriter(filename, width, height, fps, codec,
+                                   options=video_io.preset_options('veryfast'), audio_source=tone)
+    try:
+        for frame in video:
+            writer.write(frame)
+    finally:
+        writer.release()
+        os.remove(tone)
+    return video
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--frames', type=int, default=500)
+    parser.add_argument('--fps', type=float, default=25.0)
+    parser.add_argument('--quads', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_video(args.output, args.width, args.height, args.frames, args.fps, args.quads, args.seed)
+
+
+if __name__ == '__main__':
+    main()
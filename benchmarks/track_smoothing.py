@@ -0,0 +1,112 @@
+"""
+Corner orientation and Savitzky-Golay smoothing of stable tracks: the former
+per-row orientation and per-column filtering against the batched versions.
+Results are compared on tracks that are at least window long, shorter tracks
+are handled by the batched version only. Smoothed corners are truncated to integers,
+so the edge polynomial fit of the 2-D filter may move a corner by 1 px.
+
+Run from the repository root:
+    python -m benchmarks.track_smoothing --tracks 3000
+"""
+import argparse
+import time
+
+import numpy as np
+from scipy.signal import savgol_filter
+
+from models.opencv_model.tracking import orient_corners, smooth_corners
+
+WINDOW = 25
+POLY_ORDER = 4
+
+
+def make_tracks(tracks_count, seed=0):
+    """
+    Slowly moving quads with randomly rotated corners order
+    :param tracks_count: amount of tracks
+    :param seed: random seed
+    :return: list of arrays (m, 9)
+    """
+    rng = np.random.RandomState(seed)
+    tracks = []
+    for _ in range(tracks_count):
+        length = rng.randint(WINDOW, 600)
+        x, y = rng.randint(0, 1500), rng.randint(0, 800)
+        w, h = rng.randint(80, 400), rng.randint(40, 200)
+        quad = np.array([[x, y], [x, y + h], [x + w, y + h], [x + w, y]])
+        walk = np.cumsum(rng.randint(-1, 2, (length, 1, 2)), axis=0)
+        quads = quad[None] + walk + rng.randint(-2, 3, (length, 4, 2))
+        for i, shift in enumerate(rng.randint(0, 4, length)):
+            quads[i] = np.roll(quads[i], shift, axis=0)
+        tracks.append(np.column_stack([np.arange(length), quads.reshape(-1, 8)]).astype(np.int64))
+    return tracks
+
+
+def legacy_orientation(field):
+    """
+    Former AdInsertion.__define_contour_orientation for one field
+    """
+    for i in range(len(field)):
+        contour = np.reshape(field[i][1:], (4, 2))
+        contour = contour[contour[:, 0].argsort(kind='stable')]
+
+        left_side = contour[:2]
+        right_side = contour[2:]
+
+        left_idx_max = np.ravel(np.argmax(left_side, axis=0))[1]
+        left_idx_min = np.ravel(np.argmin(left_side, axis=0))[1]
+        right_idx_max = np.ravel(np.argmax(right_side, axis=0))[1]
+        right_idx_min = np.ravel(np.argmin(right_side, axis=0))[1]
+
+        top_left = left_side[left_idx_min]
+        bot_left = left_side[left_idx_max]
+        top_right = right_side[right_idx_min]
+        bot_right = right_side[right_idx_max]
+
+        field[i] = np.array([field[i][0], top_left[0], top_left[1],
+                             bot_left[0], bot_left[1], bot_right[0],
+                             bot_right[1], top_right[0], top_right[1]])
+    return field
+
+
+def legacy_smoothing(field):
+    """
+    Former AdInsertion.__smooth_coordinates for one field
+    """
+    for i in range(1, 9):
+        field[:, i] = savgol_filter(field[:, i], WINDOW, POLY_ORDER)
+    return field
+
+
+def timed(function, tracks):
+    start = time.perf_counter()
+    result = [function(track) for track in tracks]
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tracks', type=int, default=3000)
+    args = parser.parse_args()
+
+    tracks = make_tracks(args.tracks)
+    rows = sum(len(track) for track in tracks)
+
+    legacy_oriented, legacy_orient_time = timed(legacy_orientation, [track.copy() for track in tracks])
+    oriented, orient_time = timed(orient_corners, tracks)
+    legacy_smoothed, legacy_smooth_time = timed(legacy_smoothing, [track.copy() for track in legacy_oriented])
+    smoothed, smooth_time = timed(lambda track: smooth_corners(track, WINDOW, POLY_ORDER), oriented)
+
+    print('{} tracks, {} rows'.format(len(tracks), rows))
+    print('orientation: former {:.2f}s, batched {:.3f}s, identical: {}'.format(
+        legacy_orient_time, orient_time, all(np.array_equal(a, b) for a, b in zip(legacy_oriented, oriented))))
+    print('smoothing:   former {:.2f}s, batched {:.3f}s, max difference: {} px'.format(
+        legacy_smooth_time, smooth_time, max(np.abs(a - b).max() for a, b in zip(legacy_smoothed, smoothed))))
+
+    short = [track[:length] for track, length in zip(tracks, range(1, WINDOW))]
+    smoothed_short = [smooth_corners(orient_corners(track), WINDOW, POLY_ORDER) for track in short]
+    print('tracks of 1..{} rows smoothed without errors: {}'.format(WINDOW - 1, len(smoothed_short)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Headless batch insertion: processes every video of the given folders or files and renders one
+output video per logo, and one per track assignment, in a single decoding pass per video.
+Every video gets its own workspace folder, so the instances can be reviewed between the steps.
+
+Run from the repository root:
+    python cli.py --videos videos/ --logos logos/
+    python cli.py --videos videos/match.mp4 --logos logos/a.png logos/b.png --assignment '{"0": "a.png", "2": "b.png"}'
+    python cli.py --videos videos/ --logos logos/ --step processing
+    python cli.py --videos videos/ --logos logos/ --step insertion
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import traceback
+from pathlib import Path
+
+from ad_insertion_executor import ProcessingExecutor, InsertionExecutor
+from metrics import JobMetrics
+from src import settings
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv', '.avi', '.mov', '.webm')
+LOGO_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+def collect_files(paths, extensions):
+    """
+    Files of the given folders and the given files
+    :param paths: list of folder or file paths
+    :param extensions: file extensions taken from the folders
+    :return: sorted list of absolute file paths
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name) for name in os.listdir(path)
+                         if os.path.splitext(name)[1].lower() in extensions)
+        else:
+            files.append(path)
+    return sorted(os.path.abspath(path) for path in files)
+
+
+def parse_assignment(text, logos):
+    """
+    Track assignment of one output
+    :param text: JSON object track index -> logo, or path of a JSON file with it. Logos are file names
+                 of the given logos or logo paths
+    :param logos: logo paths
+    :return: dictionary track index -> logo path
+    """
+    if os.path.isfile(text):
+        with open(text, 'r') as file:
+            assignment = json.load(file)
+    else:
+        assignment = json.loads(text)
+    names = {os.path.basename(logo): logo for logo in logos}
+    return {int(track): names.get(logo, os.path.abspath(logo)) for track, logo in assignment.items()}
+
+
+def run_video(video, logos, outputs, conf, workspace, step):
+    """
+    Processing and insertion of one video
+    :param video: video path
+    :param logos: logo paths, the first one is used for the instances previews
+    :param outputs: list of output videos for InsertionExecutor
+    :param conf: model configuration path
+    :param workspace: video workspace folder
+    :param step: all, processing or insertion
+    :return: list of output video paths
+    """
+    metrics = JobMetrics(Path(workspace).name)
+    if step in ('all', 'processing'):
+        executor = ProcessingExecutor(video, logos[0], conf, workspace=workspace, metrics=metrics)
+        executor.process_video()
+        if step == 'processing':
+            return []
+    # All instances are kept, instances removed from the workspace before the insertion step are skipped
+    executor = InsertionExecutor(video, logos[0], conf, workspace=workspace, metrics=metrics, outputs=outputs)
+    executor.insert_ads()
+    return executor.output_files
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--videos', nargs='+', required=True, help='video folders or files')
+    parser.add_argument('--logos', nargs='+', required=True,
+                        help='logo folders or files, one output video per logo')
+    parser.add_argument('--assignment', action='append', default=[],
+                        help='extra output with a logo per track, JSON object track index -> logo name or a '
+                             'JSON file with it, can be repeated')
+    parser.add_argument('--conf', default=str(settings.default_conf_path), help='model configuration path')
+    parser.add_argument('--output', default='output/batch', help='folder for the videos workspaces')
+    parser.add_argument('--step', choices=('all', 'processing', 'insertion'), default='all')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    videos = collect_files(args.videos, VIDEO_EXTENSIONS)
+    logos = collect_files(args.logos, LOGO_EXTENSIONS)
+    if not videos or not logos:
+        parser.error('no videos or logos are found')
+    outputs = logos + [parse_assignment(text, logos) for text in args.assignment]
+    conf = os.path.abspath(args.conf)
+
+    failed = []
+    for video in videos:
+        workspace = Path(args.output).resolve() / os.path.splitext(os.path.basename(video))[0]
+        print('Video {}: {} output videos.'.format(video, len(outputs)))
+        try:
+            results = run_video(video, logos, outputs, conf, workspace, args.step)
+        except Exception:
+            traceback.print_exc()
+            failed.append(video)
+            continue
+        for result in results:
+            print('  {}'.format(result))
+
+    print('{} of {} videos are done.'.format(len(videos) - len(failed), len(videos)))
+    for video in failed:
+        print('Failed: {}'.format(video))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
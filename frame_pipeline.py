@@ -0,0 +1,120 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+import queue
+import threading
+
+_END = object()
+
+
+class FramePipeline(object):
+    """
+    Bounded decode / composite / encode pipeline. A decoder thread fills the frames queue,
+    a thread pool composites frames that need it and a writer thread writes results
+    in frames order. Queues depth caps the amount of frames kept in memory.
+    """
+    def __init__(self, capture, writer, composite, needs_composite, frames_count, queue_depth=32, workers=4,
+                 progress=None, start=0, pool=None):
+        """
+        :param capture: video object to read frames from
+        :param writer: object with write(frame) method
+        :param composite: function (frame, frame_idx) -> composited frame
+        :param needs_composite: function (frame_idx) -> whether the frame has insertions
+        :param frames_count: amount of frames to process
+        :param queue_depth: maximum amount of frames in each queue
+        :param workers: amount of compositing threads
+        :param progress: function (frames written) called by the writer thread
+        :param start: index of the first frame the capture returns
+        :param pool: optional BufferPool, frames are decoded into its buffers and given back once written
+        """
+        self.capture = capture
+        self.writer = writer
+        self.composite = composite
+        self.needs_composite = needs_composite
+        self.frames_count = frames_count
+        self.queue_depth = queue_depth
+        self.workers = workers
+        self.progress = progress
+        self.start = start
+        self.pool = pool
+        self.frames_written = 0
+        self.__decoded = queue.Queue(maxsize=queue_depth)
+        self.__ordered = queue.Queue(maxsize=queue_depth)
+        self.__stop = threading.Event()
+        self.__errors = []
+
+    def __decode(self):
+        """
+        Decoder thread, reads frames into the decoded queue
+        :return:
+        """
+        try:
+            shape = None
+            for i in range(self.start, self.start + self.frames_count):
+                if self.__stop.is_set():
+                    break
+                buffer = self.pool.take(shape) if self.pool is not None and shape is not None else None
+                ret, frame = self.capture.read(buffer)
+                if not ret:
+                    break
+                shape = frame.shape
+                self.__decoded.put((i, frame))
+        except Exception as e:
+            self.__errors.append(e)
+        finally:
+            self.__decoded.put(_END)
+
+    def __write(self):
+        """
+        Writer thread, drains composited frames in order. After a failure it keeps
+        draining without writing, so the other stages never block on a full queue
+        :return:
+        """
+        while True:
+            future = self.__ordered.get()
+            if future is _END:
+                break
+            try:
+                frame = future.result()
+                if not self.__stop.is_set():
+                    self.writer.write(frame)
+                    self.frames_written += 1
+                    if self.progress is not None:
+                        self.progress(self.frames_written)
+                if self.pool is not None:
+                    # A composite function may return several frames, the same frame is given back once
+                    for buffer in frame if isinstance(frame, list) else [frame]:
+                        self.pool.give(buffer)
+            except Exception as e:
+                self.__errors.append(e)
+                self.__stop.set()
+
+    def run(self):
+        """
+        Run the pipeline until all frames are written
+        :return: amount of written frames
+        """
+        decoder = threading.Thread(target=self.__decode, name='pipeline-decoder', daemon=True)
+        writer = threading.Thread(target=self.__write, name='pipeline-writer', daemon=True)
+        decoder.start()
+        writer.start()
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='pipeline-composite') as pool:
+            while True:
+                item = self.__decoded.get()
+                if item is _END:
+                    break
+                i, frame = item
+                if self.__stop.is_set():
+                    continue
+                if self.needs_composite(i):
+                    future = pool.submit(self.composite, frame, i)
+                else:
+                    future = Future()
+                    future.set_result(frame)
+                self.__ordered.put(future)
+            self.__ordered.put(_END)
+            writer.join()
+        decoder.join()
+
+        if self.__errors:
+            raise self.__errors[0]
+        return self.frames_written
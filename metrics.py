@@ -0,0 +1,218 @@
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('ad_insertion.jobs')
+
+PREFIX = 'ad_insertion_'
+
+
+class Registry(object):
+    """
+    Process wide counters and gauges, rendered in the Prometheus text exposition format
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.kinds = {}
+        self.values = {}
+
+    def describe(self, name, kind, text):
+        """
+        Declare a metric
+        :param name: metric name without the common prefix
+        :param kind: counter or gauge
+        :param text: help text
+        :return:
+        """
+        self.kinds[name] = (kind, text)
+
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = value
+
+    def render(self):
+        """
+        :return: metrics in the Prometheus text format
+        """
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = []
+        for name, (kind, text) in sorted(self.kinds.items()):
+            lines.append('# HELP {}{} {}'.format(PREFIX, name, text))
+            lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+            for (value_name, labels), value in values:
+                if value_name == name:
+                    label_text = ','.join('{}="{}"'.format(key, label) for key, label in labels)
+                    lines.append('{}{}{} {}'.format(PREFIX, name, '{' + label_text + '}' if labels else '',
+                                                    float(value)))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REGISTRY.describe('steps_total', 'counter', 'Finished executor steps by status.')
+REGISTRY.describe('step_seconds_total', 'counter', 'Wall time of executor steps.')
+REGISTRY.describe('stage_seconds_total', 'counter', 'Time spent in pipeline stages, summed over threads.')
+REGISTRY.describe('frames_decoded_total', 'counter', 'Decoded video frames.')
+REGISTRY.describe('detections_total', 'counter', 'Contours found by the detection pass.')
+REGISTRY.describe('insertion_frames_total', 'counter', 'Frames the logo was inserted into.')
+REGISTRY.describe('bytes_written_total', 'counter', 'Bytes of the written output videos.')
+REGISTRY.describe('warp_cache_hits_total', 'counter', 'Logo insertions that reused a cached transformed logo.')
+REGISTRY.describe('warp_cache_misses_total', 'counter', 'Logo insertions that transformed the logo.')
+REGISTRY.describe('last_step_fps', 'gauge', 'Decoded frames per second of the last finished step.')
+REGISTRY.describe('last_detections_per_frame', 'gauge', 'Contours per decoded frame of the last processing step.')
+
+
+class JobMetrics(object):
+    """
+    Stage timers and counters of one executor run. Values stay in the object while the
+    step runs and are published to the registry and the job log once it ends
+    """
+    def __init__(self, job_id=None, registry=REGISTRY):
+        """
+        :param job_id: job identifier for the log records
+        :param registry: registry to publish to
+        """
+        self.job_id = job_id
+        self.registry = registry
+        self.lock = threading.Lock()
+        self.seconds = {}
+        self.counters = {}
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def total(self, *stages):
+        with self.lock:
+            return sum(self.seconds.get(stage, 0.0) for stage in stages)
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time the enclosed block as a pipeline stage
+        :param name: stage name
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def timed(self, stage, function, counter=None):
+        """
+        Wrap a function so that its calls are timed as a stage
+        :param stage: stage name
+        :param function: function to wrap
+        :param counter: optional counter increased by every call
+        :return: wrapped function
+        """
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add_time(stage, time.perf_counter() - start)
+                if counter is not None:
+                    self.count(counter)
+        return wrapper
+
+    def publish(self, step, status, seconds):
+        """
+        Add the step figures to the registry and write the job log record
+        :param step: executor step, processing or insertion
+        :param status: done or failed
+        :param seconds: step wall time
+        :return: log record
+        """
+        with self.lock:
+            stages = dict(self.seconds)
+            counters = dict(self.counters)
+            self.seconds.clear()
+            self.counters.clear()
+
+        registry = self.registry
+        registry.add('steps_total', 1, step=step, status=status)
+        registry.add('step_seconds_total', seconds, step=step)
+        for stage, stage_seconds in stages.items():
+            registry.add('stage_seconds_total', stage_seconds, step=step, stage=stage)
+        for name, value in counters.items():
+            registry.add(name + '_total', value, step=step)
+
+        frames = counters.get('frames_decoded', 0)
+        record = {'event': 'step_finished', 'job': self.job_id, 'step': step, 'status': status,
+                  'seconds': round(seconds, 4), 'stages': {stage: round(value, 4) for stage, value in stages.items()},
+                  'counters': counters, 'fps': round(frames / seconds, 2) if seconds > 0 else None}
+        if frames and seconds > 0:
+            registry.set('last_step_fps', frames / seconds, step=step)
+        if frames and 'detections' in counters:
+            record['detections_per_frame'] = round(counters['detections'] / frames, 4)
+            registry.set('last_detections_per_frame', counters['detections'] / frames)
+        logger.info(json.dumps(record))
+        return record
+
+
+def instrumented(step):
+    """
+    Decorator of executor step methods: the step is timed and the metrics of the executor
+    are published when it ends, also when it fails
+    :param step: step name
+    :return: decorator
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            status = 'failed'
+            try:
+                result = method(self, *args, **kwargs)
+                status = 'done'
+                return result
+            finally:
+                self.metrics.publish(step, status, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class TimedCapture(object):
+    """
+    Video capture proxy that times frame decoding and counts decoded frames
+    """
+    def __init__(self, capture, metrics):
+        self.capture = capture
+        self.metrics = metrics
+
+    def read(self, image=None):
+        start = time.perf_counter()
+        result = self.capture.read(image)
+        self.metrics.add_time('decode', time.perf_counter() - start)
+        if result[0]:
+            self.metrics.count('frames_decoded')
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+class TimedWriter(object):
+    """
+    Video writer proxy that times frames encoding, including the wait for the encoder to finish
+    """
+    def __init__(self, writer, metrics):
+        self.writer = writer
+        self.metrics = metrics
+        self.write = metrics.timed('encode', writer.write)
+        self.release = metrics.timed('encode', writer.release)
@@ -2,9 +2,14 @@ import cv2 as cv
 import numpy as np
 import math
 from models.AbstractAdInsertion import AbstractAdInsertion
-from scipy.spatial import distance
-from scipy.signal import savgol_filter
-import yaml
+from models.opencv_model.config import ModelConfig
+from models.opencv_model import compositing
+from models.opencv_model.buffers import BufferPool
+from models.opencv_model.insertion_plan import InsertionPlan
+from models.opencv_model.storage import TRACKS_FILE, TrackStore
+from models.opencv_model.detection import (scaled_gray, scaled_kernel, threshold_contours,
+                                           filter_contours, polygon_rows)
+from models.opencv_model.tracking import build_linker, orient_corners, smooth_corners
 
 
 class AdInsertion(AbstractAdInsertion):
@@ -14,19 +19,27 @@ class AdInsertion(AbstractAdInsertion):
     def __init__(self, frame, logo, frame_idx, data, video_info):
         self.frame = frame
         self.logo = logo
+        self.logo_image = None
         self.fps = video_info['fps']
         self.contours = []
-        self.single_cnt = []
         self.stable_contours = []
         self.data = data
         self.frame_idx = frame_idx
         self.video_name = video_info['video_name']
         self.logo_ratio = video_info['logo_ratio']
         self.frames_count = video_info['frames_count']
+        # Job folders for intermediate files and reports
+        self.files_path = video_info.get('files_path', 'files')
+        self.output_path = video_info.get('output_path', 'output')
         self.instance_insertions = []
-        self.config = {}
-
-    def __find_contours(self, kernel, min_area, max_area, corners_count, perimeter_threshold):
+        self.config = None
+        # Warp caches of the logos, the main logo and the logos of other outputs, they share the contour transforms
+        self.warp_caches = {}
+        self.homographies = compositing.HomographyCache()
+        # Intermediate images of detection and compositing are reused between frames
+        self.buffers = BufferPool()
+
+    def __find_contours(self, kernel, min_area, max_area, corners_count, perimeter_threshold, scale=1.0):
         """
         Contours detection in the frame
         :param kernel: parameter for frame bluring
@@ -34,121 +47,56 @@ class AdInsertion(AbstractAdInsertion):
         :param max_area: maximum area threshold
         :param corners_count: contour corners amount
         :param perimeter_threshold: contour approximation threshold
+        :param scale: detection runs on the frame resized with this factor
         :return:
         """
-        gray = cv.cvtColor(self.frame, cv.COLOR_BGR2GRAY)
-        blur_gray = cv.GaussianBlur(gray, (kernel, kernel), 0)
-
-        _, th = cv.threshold(blur_gray, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
-        _, contours, __ = cv.findContours(th, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
-
-        drop_list = [i for i in range(len(contours))
-                     if cv.contourArea(contours[i]) < min_area
-                     or cv.contourArea(contours[i]) > max_area]
-        contours = [i for j, i in enumerate(contours) if j not in drop_list]
-
-        for cnt in contours:
-            epsilon = perimeter_threshold * cv.arcLength(cnt, True)
-            approx = cv.approxPolyDP(cnt, epsilon, True)
-            corners = len(approx)
-            convexity = cv.isContourConvex(approx)
-
-            if convexity and corners == corners_count:
-                self.contours.append(approx.tolist())
+        gray = scaled_gray(self.frame, scale, self.buffers)
+        contours = threshold_contours(gray, scaled_kernel(kernel, scale), self.buffers)
+        self.buffers.give(gray)
+        self.contours.extend(filter_contours(contours, min_area, max_area, corners_count, perimeter_threshold, scale))
 
     def __create_data_structures(self):
         """
         Writing contours to array
         :return:
         """
+        self.data.extend(polygon_rows(self.frame_idx, self.contours))
 
-        if self.contours != 0:
-            for i, v in enumerate(self.contours):
-                self.data.append([self.frame_idx,
-                                  v[0][0][0], v[0][0][1], v[1][0][0], v[1][0][1],
-                                  v[2][0][0], v[2][0][1], v[3][0][0], v[3][0][1]])
-
-    def __clean_data(self, field_threshold, contours_threshold, dst_threshold):
+    def __clean_data(self, detections, field_threshold, contours_threshold, dst_threshold, tracker='kdtree',
+                     max_gap=0, previews=None):
         """
-        Stable fields and contours detection
-        :param field_threshold: minimum field duration threshold
+        Stable fields and contours detection. Detections are consumed as a stream, the linker
+        emits every track as soon as it is finished
+        :param detections: iterable of (frame index, array (k, 9) with the frame contours) in frames order
+        :param field_threshold: minimum field duration threshold, used by the chain tracker
         :param contours_threshold: minimum contours duration threshold
         :param dst_threshold: distance between contours centers
+        :param tracker: kdtree for multi-surface tracks, chain for one chain per field
+        :param max_gap: maximum amount of frames without detection inside a kdtree track
+        :param previews: optional PreviewFrames, frames where no stable track starts are dropped from it
         :return:
         """
-        data = np.load('files/data.npy')
-        unique_idx = np.unique(data[:, 0])
-        expected = [i if i in unique_idx else 'X' for i in range(self.frames_count)]
-        x_ids = [i for i, j in enumerate(expected) if j == 'X']
-        intervals = [[x_ids[i] + 1, x_ids[i + 1] - 1] for i in range(len(x_ids) - 1)
-                     if (x_ids[i + 1] - x_ids[i]) > field_threshold]
-
-        if x_ids[0] > field_threshold:
-            intervals.insert(0, [0, x_ids[0]])
-
-        if self.frames_count - x_ids[-1] > field_threshold:
-            intervals.append([x_ids[-1] + 1, self.frames_count])
-
-        for interval in intervals:
-            condition = np.logical_and(data[:, 0] >= interval[0], data[:, 0] <= interval[1])
-            stable = data[condition]
-
-            prev_cnt = stable[0, :]
-            prev_contour = np.array([[prev_cnt[1], prev_cnt[2]], [prev_cnt[3], prev_cnt[4]],
-                                     [prev_cnt[5], prev_cnt[6]], [prev_cnt[7], prev_cnt[8]]])
-            prev_m = cv.moments(prev_contour)
-            prev_cx = int(prev_m['m10'] / prev_m['m00'])
-            prev_cy = int(prev_m['m01'] / prev_m['m00'])
-            stable_contour = []
-            for i, row in enumerate(stable):
-
-                if row[0] - prev_cnt[0] == 0:
-                    continue
+        linker = build_linker(tracker, self.fps, field_threshold, contours_threshold, dst_threshold, max_gap)
 
-                elif row[0] - prev_cnt[0] == 1:
-                    contour = np.array([[row[1], row[2]], [row[3], row[4]],
-                                        [row[5], row[6]], [row[7], row[8]]])
-
-                    m = cv.moments(contour)
-                    base_cx = int(m['m10'] / m['m00'])
-                    base_cy = int(m['m01'] / m['m00'])
-
-                    dist = distance.euclidean([base_cx, base_cy], [prev_cx, prev_cy])
-                    if dist < dst_threshold:
-                        stable_contour.append(row)
-                        prev_cnt = row
-                        prev_cx = base_cx
-                        prev_cy = base_cy
-
-            if len(stable_contour) >= int(self.fps) * contours_threshold:
-                self.stable_contours.append(np.array(stable_contour))
+        self.stable_contours = []
+        starts = set()
+        for frame_idx, rows in detections:
+            finished = linker.update(frame_idx, rows)
+            self.stable_contours.extend(finished)
+            if previews is not None and len(previews) != 0:
+                starts.update(int(track[0, 0]) for track in finished)
+                previews.retain(frame_idx, starts, linker.first_frames())
+        self.stable_contours.extend(linker.finish())
+        if previews is not None:
+            previews.retain(float('inf'), {int(track[0, 0]) for track in self.stable_contours})
+        self.stable_contours.sort(key=lambda track: track[0, 0])
 
     def __define_contour_orientation(self):
         """
         Find contour corners orientation
         :return:
         """
-        for field in self.stable_contours:
-            for i in range(len(field)):
-                contour = np.reshape(field[i][1:], (4, 2))
-                contour = contour[contour[:, 0].argsort()]
-
-                left_side = contour[:2]
-                right_side = contour[2:]
-
-                left_idx_max = np.ravel(np.argmax(left_side, axis=0))[1]
-                left_idx_min = np.ravel(np.argmin(left_side, axis=0))[1]
-                right_idx_max = np.ravel(np.argmax(right_side, axis=0))[1]
-                right_idx_min = np.ravel(np.argmin(right_side, axis=0))[1]
-
-                top_left = left_side[left_idx_min]
-                bot_left = left_side[left_idx_max]
-                top_right = right_side[right_idx_min]
-                bot_right = right_side[right_idx_max]
-
-                field[i] = np.array([field[i][0], top_left[0], top_left[1],
-                                    bot_left[0], bot_left[1], bot_right[0],
-                                    bot_right[1], top_right[0], top_right[1]])
+        self.stable_contours = [orient_corners(field) for field in self.stable_contours]
 
     def __find_insertion_time_period(self):
         """
@@ -157,7 +105,7 @@ class AdInsertion(AbstractAdInsertion):
         """
 
         if len(self.stable_contours) != 0:
-            with open('output/report_{}.txt'.format(self.video_name), 'w') as report:
+            with open('{}/report_{}.txt'.format(self.output_path, self.video_name), 'w') as report:
                 report.write('Total amount of insertions: {} \n'.format(len(self.stable_contours)))
                 for i, contour in enumerate(self.stable_contours):
                     report.write('Period {}: \n'.format(i + 1))
@@ -177,45 +125,86 @@ class AdInsertion(AbstractAdInsertion):
         :param poly_order: the order of the polynomial used to fit the samples
         :return: stable contours amount
         """
-        for field in self.stable_contours:
-            for i in range(1, 9):
-                field[:, i] = savgol_filter(field[:, i], window, poly_order)
+        self.stable_contours = [smooth_corners(field, window, poly_order) for field in self.stable_contours]
 
         for field in self.stable_contours:
             self.instance_insertions.append(field[0])
         self.instance_insertions = np.array(self.instance_insertions)
 
-        self.stable_contours = np.array(self.stable_contours)
-        np.save('files/all_instances.npy', self.stable_contours)
+        TrackStore.save('{}/{}'.format(self.files_path, TRACKS_FILE), self.stable_contours, self.frames_count)
 
-    def __transform_logo(self, contours):
+    def __read_logo(self):
         """
-        Transform logo according to frame shape
-        :param contours: contours coordinates for logo transformation
-        :return:
+        Decode the logo once, it is shared by all frames
+        :return: logo image
         """
-        self.logo = cv.imread(self.logo, cv.IMREAD_UNCHANGED)
-        row = contours[contours[:, 0] == self.frame_idx]
-        self.single_cnt = [[row[0][1], row[0][2]], [row[0][3], row[0][4]],
-                           [row[0][5], row[0][6]], [row[0][7], row[0][8]]]
-        frame_h, frame_w, _ = self.frame.shape
-        h, w, _ = self.logo.shape
+        if self.logo_image is None:
+            self.logo_image = cv.imread(self.logo, cv.IMREAD_UNCHANGED)
+        return self.logo_image
 
-        pts1 = np.float32([(0, 0), (0, (h - 1)), ((w - 1), (h - 1)), ((w - 1), 0)])
-        pts2 = np.float32([self.single_cnt[0], self.single_cnt[1], self.single_cnt[2], self.single_cnt[3]])
+    def __insert_logo(self, frame, frame_idx, contours, logos=None):
+        """
+        Insert logo into every contour of the frame. The method keeps no per-frame state in the model,
+        so the same model can composite several frames concurrently. Transformed logos are reused
+        through the warp caches
+        :param frame: video frame
+        :param frame_idx: frame index
+        :param contours: InsertionPlan or array with frame index and contour corners rows
+        :param logos: optional dictionary track index -> logo path, contours of other tracks are skipped,
+                      the model logo is inserted into all contours if not given
+        :return: frame with inserted logo
+        """
+        if isinstance(contours, InsertionPlan):
+            quads = contours.quads_for(frame_idx)
+            tracks = contours.tracks_for(frame_idx)
+        else:
+            quads = contours[contours[:, 0] == frame_idx][:, 1:9].reshape(-1, 4, 2)
+            tracks = None
+        frame_h, frame_w, _ = frame.shape
+
+        for k, single_cnt in enumerate(quads):
+            logo = self.logo if logos is None else logos.get(int(tracks[k]))
+            if logo is None:
+                continue
+            warped_logo, roi, mask = self.warp_caches[logo].get(single_cnt, frame_w, frame_h)
+            if warped_logo is not None:
+                frame = compositing.blend(frame, warped_logo, roi, mask, self.config.feather, self.buffers)
+        return frame
+
+    def add_logos(self, logos):
+        """
+        Prepare other logos for insertion, every logo is decoded once and gets its own warp cache, as the cache
+        keeps the warped logo pixels. The caches share the unit square transform of every contour, it is composed
+        with the scale of every logo
+        :param logos: logo paths
+        :return:
+        """
+        for logo in logos:
+            if logo not in self.warp_caches:
+                self.warp_caches[logo] = compositing.WarpCache(cv.imread(logo, cv.IMREAD_UNCHANGED),
+                                                               self.config.feather, homographies=self.homographies)
 
-        matrix = cv.getPerspectiveTransform(pts1, pts2)
-        self.logo = cv.warpPerspective(self.logo, matrix, (frame_w, frame_h), borderMode=0)
+    def warp_stats(self):
+        """
+        :return: dictionary with hits and misses of all warp caches
+        """
+        stats = [cache.stats() for cache in self.warp_caches.values()]
+        return {'hits': sum(item['hits'] for item in stats), 'misses': sum(item['misses'] for item in stats)}
 
     def build_model(self, filename):
         """
         Setting the required parameters for model building
 
-        :param filename: file that contains required parameters for model tuning
+        :param filename: file that contains required parameters for model tuning or loaded ModelConfig
         :return:
         """
-        with open(filename, 'r') as stream:
-            self.config = yaml.safe_load(stream)
+        if isinstance(filename, ModelConfig):
+            self.config = filename
+        else:
+            self.config = ModelConfig.load(filename)
+        if self.logo is not None:
+            self.warp_caches[self.logo] = compositing.WarpCache(self.__read_logo(), self.config.feather,
+                                                                homographies=self.homographies)
 
     def data_preprocessed(self):
         """
@@ -223,45 +212,52 @@ class AdInsertion(AbstractAdInsertion):
         :return:
         """
         cfg = self.config
-        self.__find_contours(cfg['kernel'], cfg['min_area_threshold'],
-                             cfg['max_area_threshold'], cfg['corners_count'],
-                             cfg['perimeter_threshold'])
+        self.__find_contours(cfg.kernel, cfg.min_area_threshold,
+                             cfg.max_area_threshold, cfg.corners_count,
+                             cfg.perimeter_threshold, cfg.detection_scale)
         self.__create_data_structures()
 
-    def detect_surfaces(self):
+    def process_frame(self, frame, frame_idx):
+        """
+        Run data preparation on the next frame, the model is reused between frames
+        :param frame: video frame
+        :param frame_idx: frame index
+        :return:
+        """
+        self.frame = frame
+        self.frame_idx = frame_idx
+        self.contours = []
+        self.data_preprocessed()
+
+    def detect_surfaces(self, detections, previews=None):
         """
         Surface detection in the frame
+        :param detections: iterable of (frame index, array (k, 9) with the frame contours)
+        :param previews: optional PreviewFrames filled while the detections are produced
         :return: contours quantity
         """
         cfg = self.config
-        self.__clean_data(cfg['field_threshold'], cfg['contour_threshold'],
-                          cfg['dst_threshold'])
+        self.__clean_data(detections, cfg.field_threshold, cfg.contour_threshold,
+                          cfg.dst_threshold, cfg.tracker, cfg.max_gap, previews)
         self.__define_contour_orientation()
         self.__find_insertion_time_period()
-        self.__smooth_coordinates(cfg['window'], cfg['poly_order'])
+        self.__smooth_coordinates(cfg.window, cfg.poly_order)
 
     def insert_ad(self, contours):
         """
         Insert ad into the frame
-        :param contours: contour for logo insertion
+        :param contours: InsertionPlan or array with contours for logo insertion
         :return:
         """
-        frame_h, frame_w, _ = self.frame.shape
-        self.__transform_logo(contours)
-        if self.logo.shape[2] == 4:
-            png_mask = self.logo[:, :, 3]
-            bgr_logo = self.logo[:, :, 0:3]
+        self.frame = self.__insert_logo(self.frame, self.frame_idx, contours)
 
-            logo_roi = cv.bitwise_and(bgr_logo, bgr_logo, mask=png_mask)
-
-            mask_inv = cv.bitwise_not(png_mask)
-            frame_roi = cv.bitwise_and(self.frame, self.frame, mask=mask_inv)
-            self.frame = cv.add(frame_roi, logo_roi)
-        else:
-            self.single_cnt = np.array(self.single_cnt)
-            mask = np.zeros((frame_h, frame_w))
-            cv.drawContours(mask, [self.single_cnt], -1, 1, -1)
-
-            points = np.argwhere(mask == 1)
-            for i, j in points:
-                self.frame[i, j] = self.logo[i, j]
+    def insert_frame(self, frame, frame_idx, contours, logos=None):
+        """
+        Insert ad into the next frame, the model is reused between frames and threads
+        :param frame: video frame
+        :param frame_idx: frame index
+        :param contours: InsertionPlan or array with contours for logo insertion
+        :param logos: optional dictionary track index -> logo path added with add_logos, used with InsertionPlan
+        :return: frame with inserted ad
+        """
+        return self.__insert_logo(frame, frame_idx, contours, logos)
@@ -0,0 +1,107 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Free buffers kept for every shape, enough for the frames queues of the insertion pipeline
+POOL_LIMIT = 96
+# Free buffers memory kept by a pool, buffers of the least recently used shapes are dropped over it
+POOL_BYTES = 512 * 1024 ** 2
+
+
+class BufferPool(object):
+    """
+    Preallocated arrays keyed by shape and type. A buffer is taken for a frame, or an image derived
+    from it, and given back once nothing references it, so the frames of a video reuse the same
+    memory instead of allocating new full-size arrays. The pool is shared by the pipeline threads.
+    Images of changing sizes take views of frame-size buffers (see take_view), so the amount of
+    shapes stays small, and the free buffers never take more than max_bytes
+    """
+    def __init__(self, limit=POOL_LIMIT, max_bytes=POOL_BYTES):
+        """
+        :param limit: maximum amount of free buffers kept for every shape
+        :param max_bytes: maximum memory of all free buffers
+        """
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.free = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.allocations = 0
+
+    def take(self, shape, dtype=np.uint8):
+        """
+        Free buffer of the shape, a new one if there is none. The content is not defined
+        :param shape: array shape
+        :param dtype: array type
+        :return: array
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self.lock:
+            buffers = self.free.get(key)
+            if buffers:
+                self.free.move_to_end(key)
+                buffer = buffers.pop()
+                self.bytes -= buffer.nbytes
+                return buffer
+            self.allocations += 1
+        return np.empty(shape, dtype)
+
+    def give(self, buffer):
+        """
+        Return the buffer to the pool, it must not be used by the caller any more. Buffers of the least
+        recently used shapes are dropped when the pool grows over max_bytes
+        :param buffer: array taken from the pool or allocated elsewhere, views and None are ignored
+        :return:
+        """
+        if buffer is None or buffer.base is not None or not buffer.flags.c_contiguous:
+            return
+        key = (buffer.shape, buffer.dtype.str)
+        with self.lock:
+            buffers = self.free.setdefault(key, [])
+            self.free.move_to_end(key)
+            if len(buffers) >= self.limit or any(item is buffer for item in buffers):
+                return
+            while self.bytes + buffer.nbytes > self.max_bytes and next(iter(self.free)) != key:
+                _, dropped = self.free.popitem(last=False)
+                self.bytes -= sum(item.nbytes for item in dropped)
+            if self.bytes + buffer.nbytes <= self.max_bytes:
+                buffers.append(buffer)
+                self.bytes += buffer.nbytes
+
+    def clear(self):
+        with self.lock:
+            self.free = OrderedDict()
+            self.bytes = 0
+
+
+def take(pool, shape, dtype=np.uint8):
+    """
+    :param pool: buffer pool or None
+    :return: buffer of the pool, None without a pool, so OpenCV allocates the result
+    """
+    return pool.take(shape, dtype) if pool is not None else None
+
+
+def take_view(pool, shape, rows, cols, dtype=np.uint8):
+    """
+    Scratch image of a changing size, a contiguous view of the beginning of a buffer of the fixed shape,
+    so numpy and OpenCV handle it as a whole image
+    :param pool: buffer pool or None
+    :param shape: shape of the buffer, the frame size
+    :param rows: image height, not greater than the buffer height
+    :param cols: image width, not greater than the buffer width
+    :param dtype: image type
+    :return: buffer to give back and its view of the image size, None and None without a pool
+    """
+    if pool is None:
+        return None, None
+    buffer = pool.take(shape, dtype)
+    image_shape = (rows, cols) + tuple(shape[2:])
+    return buffer, buffer.reshape(-1)[:int(np.prod(image_shape))].reshape(image_shape)
+
+
+def give(pool, *buffers):
+    if pool is not None:
+        for buffer in buffers:
+            pool.give(buffer)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# Parameters that change the contours found in a single frame, the tracker settings are not among them
+FRAME_PARAMETERS = ('kernel', 'min_area_threshold', 'max_area_threshold', 'perimeter_threshold',
+                    'corners_count', 'detection_scale', 'detection_stride', 'detection_mode',
+                    'flow_interval', 'flow_max_error', 'scene_threshold')
+
+
+def content_hash(video, samples=16, sample_size=1 << 16):
+    """
+    Fast video fingerprint: file size and evenly spaced samples of its content, so
+    gigabyte files are hashed by reading about one megabyte
+    :param video: video path
+    :param samples: amount of sampled blocks
+    :param sample_size: sampled block size in bytes
+    :return: hex digest
+    """
+    size = os.path.getsize(video)
+    digest = hashlib.sha1(str(size).encode())
+    with open(video, 'rb') as file:
+        if size <= samples * sample_size:
+            digest.update(file.read())
+        else:
+            for offset in np.linspace(0, size - sample_size, samples).astype(np.int64).tolist():
+                file.seek(offset)
+                digest.update(file.read(sample_size))
+    return digest.hexdigest()
+
+
+def detection_key(video, config):
+    """
+    Cache key of the video detections
+    :param video: video path
+    :param config: model configuration
+    :return: hex digest of the video content hash and the frame-level parameters
+    """
+    values = config.to_dict()
+    parameters = json.dumps({name: values[name] for name in FRAME_PARAMETERS}, sort_keys=True)
+    return hashlib.sha1((content_hash(video) + parameters).encode()).hexdigest()
+
+
+class DetectionCache(object):
+    """
+    Persistent cache of per-frame detections, one npy file per key. Least recently
+    used files are evicted when the cache grows over its size limit
+    """
+    def __init__(self, root, max_bytes):
+        """
+        :param root: cache folder
+        :param max_bytes: maximum cache size in bytes
+        """
+        self.root = str(root)
+        self.max_bytes = max_bytes
+
+    def __path(self, key):
+        return os.path.join(self.root, key + '.npy')
+
+    def get(self, key):
+        """
+        Read cached detections
+        :param key: cache key
+        :return: array (n, 9) with frame index and contour corners or None if there is no entry
+        """
+        path = self.__path(key)
+        try:
+            data = np.load(path, allow_pickle=False)
+        except (OSError, ValueError):
+            return None
+        # Access time is kept in mtime, as atime is often not updated by the file system
+        os.utime(path)
+        return data
+
+    def put(self, key, data):
+        """
+        Store detections and evict the least recently used entries over the size limit
+        :param key: cache key
+        :param data: array (n, 9) with frame index and contour corners
+        :return:
+        """
+        data = np.asarray(data, dtype=np.int64).reshape(-1, 9)
+        if data.nbytes > self.max_bytes:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        path = self.__path(key)
+        # Jobs are threads of one process, so the temporary file is unique per call, not per process
+        fd, temp_path = tempfile.mkstemp(suffix='.npy.tmp', dir=self.root)
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, data, allow_pickle=False)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def writer(self, key):
+        """
+        Writer that stores detections while they are searched
+        :param key: cache key
+        :return: cache writer
+        """
+        return CacheWriter(self, self.__path(key))
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits its size limit
+        :return:
+        """
+        entries = []
+        for filename in os.listdir(self.root):
+            if filename.endswith('.npy'):
+                stat = os.stat(os.path.join(self.root, filename))
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        total = sum(size for _, size, _ in entries)
+        for _, size, filename in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.root, filename))
+            except OSError:
+                continue
+            total -= size
+
+
+class CacheWriter(object):
+    """
+    Detections stored while the video is searched: rows are appended to a temporary file of the cache
+    folder, so the whole video is never kept in memory, and the entry is published by an atomic rename
+    once the search is finished. Detections larger than the cache are dropped
+    """
+    def __init__(self, cache, path):
+        """
+        :param cache: detection cache
+        :param path: entry path
+        """
+        self.cache = cache
+        self.path = path
+        self.count = 0
+        os.makedirs(cache.root, exist_ok=True)
+        fd, self.rows_path = tempfile.mkstemp(suffix='.rows.tmp', dir=cache.root)
+        self.file = os.fdopen(fd, 'wb')
+
+    def write(self, rows):
+        """
+        Append the detections of a frame
+        :param rows: array (k, 9) with frame index and contour corners
+        :return:
+        """
+        if self.file is None:
+            return
+        rows = np.ascontiguousarray(rows, dtype=np.int64).reshape(-1, 9)
+        if (self.count + len(rows)) * rows.itemsize * 9 > self.cache.max_bytes:
+            self.close()
+            return
+        self.file.write(rows.tobytes())
+        self.count += len(rows)
+
+    def commit(self):
+        """
+        Publish the written detections as the cache entry and evict the least recently used entries
+        :return:
+        """
+        if self.file is None:
+            return
+        self.file.close()
+        fd, temp_path = tempfile.mkstemp(suffix='.npy.tmp', dir=self.cache.root)
+        try:
+            with os.fdopen(fd, 'wb') as file, open(self.rows_path, 'rb') as rows:
+                np.lib.format.write_array_header_1_0(file, {'descr': np.dtype(np.int64).str,
+                                                            'fortran_order': False,
+                                                            'shape': (self.count, 9)})
+                shutil.copyfileobj(rows, file)
+            os.replace(temp_path, self.path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        finally:
+            self.close()
+        self.cache.evict()
+
+    def close(self):
+        """
+        Remove the temporary file, detections that are not committed are dropped
+        :return:
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if os.path.exists(self.rows_path):
+            os.remove(self.rows_path)
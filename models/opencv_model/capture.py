@@ -0,0 +1,235 @@
+import hashlib
+
+import cv2 as cv
+import numpy as np
+
+# Frames read around the marked frame when a pass resumes, the frame seek of some containers is a few frames off
+SEEK_PREROLL = 8
+
+
+def frame_digest(frame):
+    return hashlib.sha1(frame.tobytes()).hexdigest()
+
+
+class WindowCapture(object):
+    """
+    Video capture proxy that keeps digests of the frames decoded around range boundaries, so two passes
+    over a boundary from different seek positions are aligned by them (see digests_offset). The frames of
+    a window are digested from its first frame until a change of the picture at least 2 * SEEK_PREROLL frames
+    past the boundary is decoded, and 2 * SEEK_PREROLL frames after it, so the passes share a change to be
+    aligned by, even if the boundary is in a still scene
+    """
+    def __init__(self, capture, position, windows):
+        """
+        :param capture: video object
+        :param position: index of the frame the capture returns next
+        :param windows: list of (first frame, boundary frame) of the windows
+        """
+        self.capture = capture
+        self.position = position
+        self.windows = [(first, boundary, {}) for first, boundary in windows]
+        self.changes = [None] * len(windows)
+
+    def digests(self, window):
+        """
+        :param window: index of the window
+        :return: dictionary frame index -> digest of the window frames
+        """
+        return self.windows[window][2]
+
+    def __open(self):
+        return [i for i, (first, boundary, _) in enumerate(self.windows) if first <= self.position and
+                (self.changes[i] is None or self.position <= self.changes[i] + 2 * SEEK_PREROLL)]
+
+    def read(self, image=None):
+        result = self.capture.read(image)
+        if result[0]:
+            digest = None
+            for i in self.__open():
+                _, boundary, digests = self.windows[i]
+                digest = digest or frame_digest(result[1])
+                digests[self.position] = digest
+                if self.changes[i] is None and self.position >= boundary + 2 * SEEK_PREROLL and \
+                        digests.get(self.position - 1) not in (None, digest):
+                    self.changes[i] = self.position
+        self.position += 1
+        return result
+
+    def grab(self):
+        if self.__open():
+            # Window frames are decoded to keep their digests, even if they are only grabbed
+            return self.read()[0]
+        self.position += 1
+        return self.capture.grab()
+
+    def complete(self, frames_count):
+        """
+        Read the frames until all windows are complete
+        :param frames_count: amount of frames of the video
+        :return:
+        """
+        while self.position < frames_count and self.__open():
+            if not self.read()[0]:
+                break
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+def digests_offset(previous, current, limit=SEEK_PREROLL):
+    """
+    Offset between the frame numbering of two passes that decoded the same frames from their own seek
+    positions, such as consecutive detection ranges. Offsets under which all the frames decoded by both
+    passes have equal digests fit; in a still scene many of them do, so the offsets under which a change
+    of the picture is decoded by both passes are preferred. The smallest fitting offset is taken
+    :param previous: dictionary frame index -> digest of the first pass
+    :param current: dictionary frame index -> digest of the second pass
+    :param limit: maximum offset
+    :return: offset d, frame j of the second pass is frame j + d of the first one; 0 if no offset fits
+    """
+    fitting, changes = [], []
+    for offset in range(-limit, limit + 1):
+        pairs = [(frame_idx, digest) for frame_idx, digest in current.items()
+                 if digest is not None and previous.get(frame_idx + offset) is not None]
+        if not pairs or any(digest != previous[frame_idx + offset] for frame_idx, digest in pairs):
+            continue
+        fitting.append(offset)
+        if any(current.get(frame_idx - 1) not in (None, digest) and previous.get(frame_idx + offset - 1) is not None
+               for frame_idx, digest in pairs):
+            changes.append(offset)
+    offsets = changes or fitting
+    return min(offsets, key=abs) if offsets else 0
+
+
+class MarkedCapture(object):
+    """
+    Video capture proxy that counts frames and keeps digests of the frames marked in advance,
+    so a resumed pass can check it continues from the right frame
+    """
+    def __init__(self, capture, position=0):
+        """
+        :param capture: video object
+        :param position: index of the frame the capture returns next
+        """
+        self.capture = capture
+        self.position = position
+        self.digests = {}
+
+    def mark(self, frame_idx):
+        self.digests[frame_idx] = None
+
+    def marker(self, frame_idx):
+        """
+        :param frame_idx: marked frame index
+        :return: list [frame index, digest] or None if the frame was not decoded
+        """
+        digest = self.digests.pop(frame_idx, None)
+        return [frame_idx, digest] if digest is not None else None
+
+    def read(self, image=None):
+        result = self.capture.read(image)
+        if result[0] and self.position in self.digests:
+            self.digests[self.position] = frame_digest(result[1])
+        self.position += 1
+        return result
+
+    def grab(self):
+        self.position += 1
+        return self.capture.grab()
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
+
+
+def seek_frame(capture, frame_idx, marker=None):
+    """
+    Position the capture at the frame. With a marker the capture is set a few frames before the marked
+    frame and the frame decoded with the same digest, the nearest one to the expected position, is taken
+    as the marked one. Without a marker, or if no frame matches, the capture is set to the frame index
+    :param capture: video object
+    :param frame_idx: index of the frame to read next
+    :param marker: [frame index, digest] of a frame before frame_idx decoded by the interrupted pass
+    :return:
+    """
+    if marker is not None:
+        marked_idx, digest = marker
+        start = max(0, marked_idx - SEEK_PREROLL)
+        capture.set(cv.CAP_PROP_POS_FRAMES, start)
+        matches = []
+        for offset in range(marked_idx - start + SEEK_PREROLL + 1):
+            ret, frame = capture.read()
+            if not ret:
+                break
+            if frame_digest(frame) == digest:
+                matches.append(offset)
+        if matches:
+            # The seek gives the same frames every time, so the capture is set again and moved to the match
+            offset = min(matches, key=lambda value: abs(value - (marked_idx - start)))
+            capture.set(cv.CAP_PROP_POS_FRAMES, start)
+            for _ in range(offset + frame_idx - marked_idx):
+                capture.grab()
+            return
+    capture.set(cv.CAP_PROP_POS_FRAMES, frame_idx)
+
+
+class ReferenceCapture(object):
+    """
+    Video capture proxy that is read forward without seeking, so its frame indices are the ones of the
+    decoding pass that searched the detections; the frame seek of some containers is a frame or two off
+    them. A frame given as decoded by another decoder is found among the frames around its expected index,
+    and the frames read to find it are returned again
+    """
+    def __init__(self, capture):
+        """
+        :param capture: video object at its first frame
+        """
+        self.capture = capture
+        self.position = 0
+        self.replay = []
+
+    def seek(self, frame_idx, reference=None):
+        """
+        Move forward to the frame. With a reference the frame nearest to it is taken, digests are not
+        compared as the color conversion of the decoders may differ slightly
+        :param frame_idx: expected index of the frame, from the stream timestamps
+        :param reference: BGR image of the frame or None
+        :return: index of the frame the capture returns next
+        """
+        start = max(self.position, frame_idx - SEEK_PREROLL) if reference is not None else frame_idx
+        while self.position < start:
+            self.grab()
+        if reference is None:
+            return self.position
+        frames = []
+        for _ in range(max(0, frame_idx + SEEK_PREROLL + 1 - start)):
+            ret, frame = self.read()
+            if not ret or frame.shape != reference.shape:
+                break
+            frames.append(frame)
+        if frames:
+            # Equal frames of a static scene are resolved by the distance to the expected index
+            errors = [cv.norm(frame, reference, cv.NORM_L1) for frame in frames]
+            offset = min(range(len(frames)), key=lambda value: (errors[value], abs(start + value - frame_idx)))
+            self.replay = frames[offset:] + self.replay
+            self.position = start + offset
+        return self.position
+
+    def read(self, image=None):
+        self.position += 1
+        if self.replay:
+            frame = self.replay.pop(0)
+            if image is not None and image.shape == frame.shape:
+                np.copyto(image, frame)
+                frame = image
+            return True, frame
+        return self.capture.read(image)
+
+    def grab(self):
+        self.position += 1
+        if self.replay:
+            self.replay.pop(0)
+            return True
+        return self.capture.grab()
+
+    def __getattr__(self, name):
+        return getattr(self.capture, name)
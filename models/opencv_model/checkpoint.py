@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from models.opencv_model.cache import content_hash
+
+MANIFEST = 'checkpoint.json'
+
+# Parameters that change the output video besides the tracks
+OUTPUT_PARAMETERS = ('feather', 'output_mode', 'output_codec', 'output_preset', 'output_container',
+                     'checkpoint_interval')
+
+
+def insertion_key(video, tracks, track_ids, outputs, config):
+    """
+    Checkpoint key of the insertion pass
+    :param video: video path
+    :param tracks: track store path
+    :param track_ids: kept track indices
+    :param outputs: list of dictionaries track index -> logo path, one per output video
+    :param config: model configuration
+    :return: hex digest of the input files content hashes, the kept tracks, the logos of every output
+             and the output parameters
+    """
+    values = config.to_dict()
+    parameters = {name: values[name] for name in OUTPUT_PARAMETERS}
+    parameters['tracks'] = sorted(track_ids)
+    logos = {logo: content_hash(logo) for assignment in outputs for logo in assignment.values()}
+    parameters['outputs'] = [{str(track): logos[logo] for track, logo in assignment.items()}
+                             for assignment in outputs]
+    digest = hashlib.sha1(json.dumps(parameters, sort_keys=True).encode())
+    for path in (video, tracks):
+        digest.update(content_hash(path).encode())
+    return digest.hexdigest()
+
+
+class Checkpoint(object):
+    """
+    Saved progress of a detection or insertion pass: a JSON manifest and the files it refers to,
+    kept in one folder of the job. The manifest is replaced atomically, so a pass interrupted at
+    any moment resumes from the last complete checkpoint. A checkpoint saved for other inputs
+    (a different key) is discarded
+    """
+    def __init__(self, root, key):
+        """
+        :param root: checkpoint folder
+        :param key: digest of the pass inputs, the video content and the parameters
+        """
+        self.root = str(root)
+        self.key = key
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def load(self):
+        """
+        Read the saved progress
+        :return: dictionary with the pass state or None if there is no checkpoint for the key
+        """
+        try:
+            with open(self.path(MANIFEST), 'r') as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            manifest = None
+        if manifest is None or manifest.get('key') != self.key:
+            self.clear()
+            return None
+        return manifest['state']
+
+    def save(self, state):
+        """
+        Replace the saved progress, the files the state refers to must be written before
+        :param state: JSON serializable dictionary with the pass state
+        :return:
+        """
+        os.makedirs(self.root, exist_ok=True)
+        # Jobs are threads of one process, so temporary files are unique per call, not per process
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.root)
+        with os.fdopen(fd, 'w') as file:
+            json.dump({'key': self.key, 'state': state}, file)
+        os.replace(temp_path, self.path(MANIFEST))
+
+    def write_array(self, name, data):
+        """
+        Write an array the next state refers to
+        :param name: file name in the checkpoint folder
+        :param data: array
+        :return: file name
+        """
+        os.makedirs(self.root, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.root)
+        with os.fdopen(fd, 'wb') as file:
+            np.save(file, data, allow_pickle=False)
+        os.replace(temp_path, self.path(name))
+        return name
+
+    def read_array(self, name):
+        return np.load(self.path(name), allow_pickle=False)
+
+    def clear(self):
+        """
+        Remove the checkpoint with its files
+        :return:
+        """
+        shutil.rmtree(self.root, ignore_errors=True)
@@ -0,0 +1,307 @@
+import threading
+from collections import OrderedDict
+
+import cv2 as cv
+import numpy as np
+
+from models.opencv_model.buffers import give, take_view
+
+# Warped logos kept by the warp cache, enough for several surfaces and out of order frames of the pipeline
+WARP_CACHE_SIZE = 16
+# Unit square corners in the contour corners order
+UNIT_SQUARE = np.float32([(0, 0), (0, 1), (1, 1), (1, 0)])
+
+
+def warp_roi(matrix, inverse, logo_w, logo_h, frame_w, frame_h):
+    """
+    Find the frame rectangle the transformed logo can touch. Interpolation reaches
+    one logo pixel outside of the logo, so the logo rectangle is widened by one pixel
+    :param matrix: perspective transform matrix
+    :param inverse: inverse perspective transform matrix
+    :param logo_w: logo width
+    :param logo_h: logo height
+    :param frame_w: frame width
+    :param frame_h: frame height
+    :return: rectangle (x0, y0, x1, y1)
+    """
+    frame_corners = np.float64([(0, 0, 1), (frame_w, 0, 1), (frame_w, frame_h, 1), (0, frame_h, 1)]).T
+    horizon = inverse[2].dot(frame_corners)
+    if np.any(horizon <= 0) and np.any(horizon >= 0):
+        # Degenerate transform, the horizon line crosses the frame
+        return 0, 0, frame_w, frame_h
+
+    corners = np.float64([(-1, -1, 1), (logo_w, -1, 1), (logo_w, logo_h, 1), (-1, logo_h, 1)]).T
+    projected = matrix.dot(corners)
+    if np.any(projected[2] <= 0):
+        return 0, 0, frame_w, frame_h
+    xs = projected[0] / projected[2]
+    ys = projected[1] / projected[2]
+    x0 = min(max(0, int(np.floor(xs.min())) - 1), frame_w)
+    y0 = min(max(0, int(np.floor(ys.min())) - 1), frame_h)
+    x1 = max(min(frame_w, int(np.ceil(xs.max())) + 2), x0)
+    y1 = max(min(frame_h, int(np.ceil(ys.max())) + 2), y0)
+    return x0, y0, x1, y1
+
+
+def warp_logo(logo, inverse, frame_w, frame_h, roi):
+    """
+    Warp logo into the frame rectangle only. Sampling maps repeat the fixed-point
+    grid cv.warpPerspective uses for the full frame (blocks of 64 columns, 1/32 pixel
+    precision), so the result equals the same rectangle of the full-frame warp
+    :param logo: logo image
+    :param inverse: inverse perspective transform matrix
+    :param frame_w: frame width
+    :param frame_h: frame height
+    :param roi: frame rectangle (x0, y0, x1, y1)
+    :return: transformed logo of the rectangle size
+    """
+    x0, y0, x1, y1 = roi
+    m = inverse.ravel()
+    block_w = min(1024 // min(16, frame_h), frame_w)
+
+    xs = np.arange(x0, x1)
+    block_x = (xs // block_w * block_w).astype(np.float64)
+    block_dx = xs - block_x
+    ys = np.arange(y0, y1, dtype=np.float64)[:, None]
+
+    w = m[6] * block_x + m[7] * ys + m[8] + m[6] * block_dx
+    with np.errstate(divide='ignore'):
+        w = np.where(w != 0, 32 / w, 0)
+    fx = np.clip((m[0] * block_x + m[1] * ys + m[2] + m[0] * block_dx) * w, -2 ** 31, 2 ** 31 - 1)
+    fy = np.clip((m[3] * block_x + m[4] * ys + m[5] + m[3] * block_dx) * w, -2 ** 31, 2 ** 31 - 1)
+    x = np.rint(fx).astype(np.int64)
+    y = np.rint(fy).astype(np.int64)
+
+    xy = np.clip(np.dstack([x >> 5, y >> 5]), -32768, 32767).astype(np.int16)
+    alpha = ((y & 31) * 32 + (x & 31)).astype(np.uint16)
+    return cv.remap(logo, xy, alpha, cv.INTER_LINEAR, borderMode=cv.BORDER_CONSTANT, borderValue=0)
+
+
+def unit_homography(quad):
+    """
+    Perspective transform of the unit square into the contour. It does not depend on the logo, the transform
+    of a logo is composed from it and the logo scale, so a contour is solved once for all logos
+    :param quad: contour corners (top left, bottom left, bottom right, top right)
+    :return: perspective transform matrix and its inverse
+    """
+    matrix = cv.getPerspectiveTransform(UNIT_SQUARE, np.float32(quad))
+    # warpPerspective inverts the matrix the same way
+    return matrix, cv.invert(matrix, flags=cv.DECOMP_LU)[1]
+
+
+def transform_logo(logo, quad, frame_w, frame_h, homography=None):
+    """
+    Transform logo into the contour
+    :param logo: logo image, BGR or BGRA
+    :param quad: contour corners (top left, bottom left, bottom right, top right)
+    :param frame_w: frame width
+    :param frame_h: frame height
+    :param homography: unit_homography of the contour, computed if not given
+    :return: transformed logo (None if the contour is out of the frame) and its frame rectangle (x0, y0, x1, y1)
+    """
+    h, w = logo.shape[:2]
+    matrix, inverse = homography if homography is not None else unit_homography(quad)
+    # Logo corners are mapped to the unit square corners first
+    scale = np.float64([max(w - 1, 1), max(h - 1, 1), 1])
+    matrix = matrix / scale
+    inverse = inverse * scale[:, None]
+    roi = x0, y0, x1, y1 = warp_roi(matrix, inverse, w, h, frame_w, frame_h)
+    if x1 == x0 or y1 == y0:
+        return None, roi
+    return warp_logo(logo, inverse, frame_w, frame_h, roi), roi
+
+
+def contour_mask(quad, roi):
+    """
+    Filled contour mask of the rectangle size
+    :param quad: contour corners
+    :param roi: frame rectangle (x0, y0, x1, y1)
+    :return: uint8 mask, 255 inside the contour
+    """
+    x0, y0, x1, y1 = roi
+    mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+    cv.drawContours(mask, [np.int32(quad)], -1, 255, -1, offset=(-x0, -y0))
+    return mask
+
+
+def feather_weights(mask, feather):
+    """
+    Blending weights fading from 0 on the contour edge to 1 at feather pixels inside
+    :param mask: uint8 contour mask
+    :param feather: feathering width in pixels
+    :return: float32 weights
+    """
+    distance = cv.distanceTransform(mask, cv.DIST_L2, 3)
+    return np.minimum(distance / feather, 1)
+
+
+def blend_mask(warped_logo, roi, quad, feather=0):
+    """
+    Blending mask of the transformed logo, it depends on the contour only, so it is reused with the logo
+    :param warped_logo: transformed logo of the rectangle size
+    :param roi: frame rectangle (x0, y0, x1, y1)
+    :param quad: contour corners
+    :param feather: feathering width in pixels
+    :return: float32 weights (h, w, 1) with feather > 0, contiguous alpha channel (h, w) for BGRA logos,
+             bool contour mask (h, w, 1) for BGR logos
+    """
+    has_alpha = warped_logo.shape[2] == 4
+    if feather > 0:
+        weights = feather_weights(contour_mask(quad, roi), feather)
+        if has_alpha:
+            weights *= warped_logo[:, :, 3] / np.float32(255)
+        return weights[:, :, None]
+    if has_alpha:
+        return np.ascontiguousarray(warped_logo[:, :, 3])
+    return contour_mask(quad, roi)[:, :, None].astype(bool)
+
+
+def blend(frame, warped_logo, roi, mask, feather=0, pool=None):
+    """
+    Blend transformed logo into the frame rectangle in place by its blending mask
+    :param frame: video frame
+    :param warped_logo: transformed logo of the rectangle size, BGR or BGRA
+    :param roi: frame rectangle (x0, y0, x1, y1)
+    :param mask: blending mask made by blend_mask
+    :param feather: feathering width in pixels
+    :param pool: optional BufferPool for the intermediate images
+    :return: frame with inserted logo
+    """
+    x0, y0, x1, y1 = roi
+    frame_roi = frame[y0:y1, x0:x1]
+    bgr_logo = warped_logo[:, :, 0:3]
+    # Scratch images are views of frame-size buffers, so moving and scaling surfaces reuse the same buffers
+    rows, cols = frame_roi.shape[:2]
+
+    if feather > 0:
+        buffer, blended = take_view(pool, frame.shape, rows, cols, np.float32)
+        blended = np.subtract(bgr_logo, frame_roi, out=blended, dtype=np.float32)
+        np.multiply(blended, mask, out=blended)
+        np.add(blended, frame_roi, out=blended)
+        frame_roi[:] = np.rint(blended, out=blended)
+        give(pool, buffer)
+    elif mask.ndim == 2:
+        logo_buffer, logo_roi = take_view(pool, frame.shape, rows, cols)
+        frame_buffer, frame_part = take_view(pool, frame.shape, rows, cols)
+        mask_buffer, mask_inv = take_view(pool, frame.shape[:2], rows, cols)
+        if pool is not None:
+            # Masked operations keep the dst pixels outside of the mask, so pooled buffers are cleared first
+            logo_roi.fill(0)
+            frame_part.fill(0)
+        logo_roi = cv.bitwise_and(bgr_logo, bgr_logo, dst=logo_roi, mask=mask)
+        mask_inv = cv.bitwise_not(mask, dst=mask_inv)
+        frame_part = cv.bitwise_and(frame_roi, frame_roi, dst=frame_part, mask=mask_inv)
+        frame_roi[:] = cv.add(frame_part, logo_roi, dst=frame_part)
+        give(pool, logo_buffer, frame_buffer, mask_buffer)
+    else:
+        np.copyto(frame_roi, bgr_logo, where=mask)
+    return frame
+
+
+def composite(frame, warped_logo, roi, quad, feather=0):
+    """
+    Blend transformed logo into the frame rectangle in place.
+    BGRA logos are blended by their alpha channel, BGR logos are copied inside the contour.
+    With feather > 0 the logo edges fade into the frame along the contour
+    :param frame: video frame
+    :param warped_logo: transformed logo of the rectangle size
+    :param roi: frame rectangle (x0, y0, x1, y1)
+    :param quad: contour corners
+    :param feather: feathering width in pixels
+    :return: frame with inserted logo
+    """
+    return blend(frame, warped_logo, roi, blend_mask(warped_logo, roi, quad, feather), feather)
+
+
+class HomographyCache(object):
+    """
+    Least recently used cache of unit square transforms keyed by the contour corners. It is shared by the warp
+    caches of all logos, so a contour inserted with several logos in the same frame is solved once
+    """
+    def __init__(self, size=WARP_CACHE_SIZE):
+        """
+        :param size: maximum amount of cached transforms
+        """
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, quad):
+        """
+        :param quad: float32 contour corners (4, 2)
+        :return: unit_homography of the contour
+        """
+        key = quad.tobytes()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+
+        entry = unit_homography(quad)
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+class WarpCache(object):
+    """
+    Least recently used cache of transformed logos and their blending masks keyed by the contour corners.
+    Smoothed tracks have integer corners, so a surface that stays still repeats the same contour and only
+    the blending is left per frame. The cache is shared by the compositing threads
+    """
+    def __init__(self, logo, feather=0, size=WARP_CACHE_SIZE, homographies=None):
+        """
+        :param logo: logo image, BGR or BGRA
+        :param feather: feathering width in pixels
+        :param size: maximum amount of cached logos
+        :param homographies: HomographyCache shared with the warp caches of other logos, a new one if not given
+        """
+        self.logo = logo
+        self.feather = feather
+        self.size = size
+        self.homographies = homographies if homographies is not None else HomographyCache(size)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, quad, frame_w, frame_h):
+        """
+        Transformed logo of the contour, from the cache or warped and cached
+        :param quad: contour corners
+        :param frame_w: frame width
+        :param frame_h: frame height
+        :return: transformed logo (None if the contour is out of the frame), its frame rectangle and blending mask
+        """
+        quad = np.float32(quad).reshape(4, 2)
+        key = (quad.tobytes(), frame_w, frame_h)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        warped_logo, roi = transform_logo(self.logo, quad, frame_w, frame_h, self.homographies.get(quad))
+        mask = None
+        if warped_logo is not None:
+            mask = blend_mask(warped_logo, roi, quad, self.feather)
+            # The alpha channel is in the mask, a contiguous BGR logo is blended without copies
+            warped_logo = np.ascontiguousarray(warped_logo[:, :, 0:3])
+        entry = warped_logo, roi, mask
+        with self.lock:
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        """
+        :return: dictionary with cache hits and misses
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses}
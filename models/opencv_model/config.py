@@ -0,0 +1,154 @@
+from dataclasses import dataclass, fields, asdict, MISSING
+import yaml
+
+
+@dataclass(frozen=True)
+class ModelConfig(object):
+    """
+    Immutable model configuration. It is loaded and validated once per job
+    and shared by every frame the model processes
+    """
+    kernel: int
+    min_area_threshold: int
+    max_area_threshold: int
+    perimeter_threshold: float
+    corners_count: int
+    field_threshold: int
+    contour_threshold: float
+    dst_threshold: float
+    window: int
+    poly_order: int
+    detection_workers: int = 1
+    detection_scale: float = 1.0
+    detection_stride: int = 1
+    pipeline_queue_depth: int = 32
+    composite_workers: int = 4
+    feather: int = 0
+    tracker: str = 'kdtree'
+    max_gap: int = 5
+    output_mode: str = 'full'
+    output_codec: str = 'libx264'
+    output_preset: str = 'medium'
+    output_container: str = 'mkv'
+    preview_width: int = 480
+    preview_quality: int = 90
+    detection_cache_mb: int = 1024
+    detection_mode: str = 'full'
+    flow_interval: int = 10
+    flow_max_error: float = 1.0
+    scene_threshold: float = 0.25
+    checkpoint_interval: int = 1500
+    insertion_checkpoint_interval: int = 0
+
+    def __post_init__(self):
+        for field in fields(self):
+            value = getattr(self, field.name)
+            try:
+                # int() would truncate 2.5 and take True as 1, so only whole numbers are accepted for integers
+                if field.type is int and (isinstance(value, bool) or
+                                          isinstance(value, float) and not value.is_integer()):
+                    raise ValueError(value)
+                # Frozen dataclass, so coerced values are set through object
+                object.__setattr__(self, field.name, field.type(value))
+            except (TypeError, ValueError):
+                raise ValueError('Invalid model configuration: {} must be {}, got {!r}.'
+                                 .format(field.name, field.type.__name__, value))
+        self.__validate()
+
+    def __validate(self):
+        """
+        Check parameters consistency
+        :return:
+        """
+        errors = []
+        if self.kernel <= 0 or self.kernel % 2 == 0:
+            errors.append('kernel must be a positive odd number')
+        if self.min_area_threshold < 0 or self.max_area_threshold <= self.min_area_threshold:
+            errors.append('area thresholds must satisfy 0 <= min_area_threshold < max_area_threshold')
+        if not 0 < self.perimeter_threshold < 1:
+            errors.append('perimeter_threshold must be in (0, 1)')
+        if self.corners_count != 4:
+            errors.append('corners_count must be 4')
+        if self.field_threshold < 0:
+            errors.append('field_threshold must not be negative')
+        if self.contour_threshold < 0:
+            errors.append('contour_threshold must not be negative')
+        if self.dst_threshold <= 0:
+            errors.append('dst_threshold must be positive')
+        if self.window % 2 == 0 or self.window <= self.poly_order:
+            errors.append('window must be odd and greater than poly_order')
+        if self.poly_order < 0:
+            errors.append('poly_order must not be negative')
+        if self.detection_workers < 1:
+            errors.append('detection_workers must be at least 1')
+        if not 0 < self.detection_scale <= 1:
+            errors.append('detection_scale must be in (0, 1]')
+        if self.detection_stride < 1:
+            errors.append('detection_stride must be at least 1')
+        if self.pipeline_queue_depth < 1:
+            errors.append('pipeline_queue_depth must be at least 1')
+        if self.composite_workers < 1:
+            errors.append('composite_workers must be at least 1')
+        if self.feather < 0:
+            errors.append('feather must not be negative')
+        if self.tracker not in ('kdtree', 'chain'):
+            errors.append('tracker must be kdtree or chain')
+        if self.max_gap < 0:
+            errors.append('max_gap must not be negative')
+        if self.output_mode not in ('full', 'segments'):
+            errors.append('output_mode must be full or segments')
+        if not self.output_codec:
+            errors.append('output_codec must not be empty')
+        if not self.output_container.isalnum():
+            errors.append('output_container must be a file extension such as mkv or mp4')
+        if self.preview_width < 1:
+            errors.append('preview_width must be at least 1')
+        if not 0 <= self.preview_quality <= 100:
+            errors.append('preview_quality must be in [0, 100]')
+        if self.detection_cache_mb < 0:
+            errors.append('detection_cache_mb must not be negative')
+        if self.detection_mode not in ('full', 'flow'):
+            errors.append('detection_mode must be full or flow')
+        if self.flow_interval < 1:
+            errors.append('flow_interval must be at least 1')
+        if self.flow_max_error <= 0:
+            errors.append('flow_max_error must be positive')
+        if not 0 < self.scene_threshold <= 1:
+            errors.append('scene_threshold must be in (0, 1]')
+        # Ranges searched in parallel are sampled from their own seek frames, which some containers put a frame
+        # or two off, so a stride grid or a flow keyframe cadence would not match the ones of a serial search
+        if self.detection_workers > 1 and (self.detection_stride > 1 or self.detection_mode != 'full'):
+            errors.append('detection_workers above 1 requires detection_stride 1 and detection_mode full')
+        if self.checkpoint_interval < 0:
+            errors.append('checkpoint_interval must not be negative')
+        if self.insertion_checkpoint_interval < 0:
+            errors.append('insertion_checkpoint_interval must not be negative')
+        if errors:
+            raise ValueError('Invalid model configuration: {}.'.format('; '.join(errors)))
+
+    @classmethod
+    def from_dict(cls, values):
+        """
+        Build configuration from dictionary, unknown keys are ignored
+        :param values: dictionary with model parameters
+        :return: model configuration
+        """
+        names = {field.name for field in fields(cls)}
+        required = {field.name for field in fields(cls) if field.default is MISSING}
+        missing = [name for name in required if name not in values]
+        if missing:
+            raise ValueError('Invalid model configuration: missing {}.'.format(', '.join(sorted(missing))))
+        return cls(**{key: value for key, value in values.items() if key in names})
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read and validate configuration file
+        :param filename: path to yaml configuration file
+        :return: model configuration
+        """
+        with open(filename, 'r') as stream:
+            return cls.from_dict(yaml.safe_load(stream))
+
+    def to_dict(self):
+        return asdict(self)
@@ -0,0 +1,214 @@
+import cv2 as cv
+import numpy as np
+
+from models.opencv_model.buffers import give, take
+
+
+def scaled_gray(frame, scale=1.0, pool=None):
+    """
+    Grayscale frame for contours search
+    :param frame: video frame
+    :param scale: detection runs on the frame resized with this factor
+    :param pool: optional BufferPool for the resized and grayscale frames, the caller gives the result back
+    :return: grayscale frame
+    """
+    if scale != 1:
+        frame_h, frame_w = frame.shape[:2]
+        size = (int(round(frame_h * scale)), int(round(frame_w * scale)), frame.shape[2])
+        resized = cv.resize(frame, None, dst=take(pool, size), fx=scale, fy=scale, interpolation=cv.INTER_AREA)
+        gray = cv.cvtColor(resized, cv.COLOR_BGR2GRAY, dst=take(pool, resized.shape[:2]))
+        give(pool, resized)
+        return gray
+    return cv.cvtColor(frame, cv.COLOR_BGR2GRAY, dst=take(pool, frame.shape[:2]))
+
+
+def scaled_kernel(kernel, scale=1.0):
+    """
+    Blur kernel for the resized frame, thresholds are given for native resolution
+    :param kernel: native resolution kernel
+    :param scale: frame scale
+    :return: odd kernel size
+    """
+    if scale == 1:
+        return kernel
+    return max(1, int(round(kernel * scale))) | 1
+
+
+def threshold_contours(gray, kernel, pool=None):
+    """
+    External contours of the blurred, Otsu thresholded frame
+    :param gray: grayscale frame
+    :param kernel: blur kernel size
+    :param pool: optional BufferPool for the blurred and thresholded frames
+    :return: list of contours
+    """
+    blur_gray = cv.GaussianBlur(gray, (kernel, kernel), 0, dst=take(pool, gray.shape))
+    _, th = cv.threshold(blur_gray, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU, dst=take(pool, gray.shape))
+    _, contours, __ = cv.findContours(th, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_SIMPLE)
+    give(pool, blur_gray, th)
+    return contours
+
+
+def filter_contours(contours, min_area, max_area, corners_count, perimeter_threshold, scale=1.0, areas=None):
+    """
+    Convex polygons with the given amount of corners among the contours with area in the thresholds
+    :param contours: list of contours
+    :param min_area: minimal area threshold at native resolution
+    :param max_area: maximum area threshold at native resolution
+    :param corners_count: contour corners amount
+    :param perimeter_threshold: contour approximation threshold
+    :param scale: scale of the frame the contours were found in
+    :param areas: contours areas, computed if not given
+    :return: list of approximated polygons at native resolution
+    """
+    min_area *= scale ** 2
+    max_area *= scale ** 2
+    if areas is None:
+        areas = [cv.contourArea(cnt) for cnt in contours]
+
+    polygons = []
+    for cnt, area in zip(contours, areas):
+        if area < min_area or area > max_area:
+            continue
+        epsilon = perimeter_threshold * cv.arcLength(cnt, True)
+        approx = cv.approxPolyDP(cnt, epsilon, True)
+        if len(approx) == corners_count and cv.isContourConvex(approx):
+            if scale != 1:
+                approx = np.rint(approx / scale).astype(int)
+            polygons.append(approx.tolist())
+    return polygons
+
+
+def polygon_rows(frame_idx, polygons):
+    """
+    Detection rows of the frame polygons
+    :param frame_idx: frame index
+    :param polygons: list of approximated 4 corner polygons
+    :return: list of rows with frame index and contour corners
+    """
+    return [[frame_idx,
+             v[0][0][0], v[0][0][1], v[1][0][0], v[1][0][1],
+             v[2][0][0], v[2][0][1], v[3][0][0], v[3][0][1]] for v in polygons]
+
+
+def align_corners(reference, quad):
+    """
+    Cyclically shift quad corners to the order that best matches the reference quad
+    :param reference: array (4, 2) with reference corners
+    :param quad: array (4, 2) with corners to align
+    :return: aligned quad corners
+    """
+    shifts = [np.roll(quad, -k, axis=0) for k in range(4)]
+    costs = [np.square(shift - reference).sum() for shift in shifts]
+    return shifts[int(np.argmin(costs))]
+
+
+def match_quads(first, second, max_dst):
+    """
+    Greedy nearest centroid matching between two sets of quads
+    :param first: array (n, 4, 2) with corners
+    :param second: array (m, 4, 2) with corners
+    :param max_dst: maximum distance between matched centroids
+    :return: list of matched (first index, second index) pairs
+    """
+    if len(first) == 0 or len(second) == 0:
+        return []
+    dst = np.linalg.norm(first.mean(axis=1)[:, None, :] - second.mean(axis=1)[None, :, :], axis=2)
+    pairs = []
+    used_first, used_second = set(), set()
+    for flat_idx in np.argsort(dst, axis=None):
+        i, j = np.unravel_index(flat_idx, dst.shape)
+        if dst[i, j] >= max_dst:
+            break
+        if i in used_first or j in used_second:
+            continue
+        used_first.add(i)
+        used_second.add(j)
+        pairs.append((i, j))
+    return pairs
+
+
+def frame_groups(data):
+    """
+    Detections stream of a table
+    :param data: array (n, 9) with frame index and contour corners sorted by frame index
+    :return: generator of (frame index, array (k, 9) with the frame contours)
+    """
+    if len(data) == 0:
+        return
+    frames, starts = np.unique(data[:, 0], return_index=True)
+    stops = np.append(starts[1:], len(data))
+    for frame_idx, start, stop in zip(frames.tolist(), starts.tolist(), stops.tolist()):
+        yield frame_idx, data[start:stop]
+
+
+def interpolate_stream(detections, stride, dst_threshold):
+    """
+    Fill frames skipped by the detection stride in a detections stream. Quads of neighbouring
+    sampled frames are matched by centroid and the corners of the frames in between are linearly
+    interpolated, so only the previous sampled frame is kept in memory
+    :param detections: iterable of (frame index, array (k, 9)) in increasing frame order
+    :param stride: detection frame stride
+    :param dst_threshold: distance between contours centers of consecutive frames
+    :return: generator of (frame index, array (k, 9)) with the skipped frames filled
+    """
+    steps = np.arange(1, stride)[:, None, None] / stride
+    prev_idx, prev = None, None
+    for frame_idx, rows in detections:
+        if prev is not None:
+            yield prev_idx, prev
+            if stride > 1 and frame_idx - prev_idx == stride:
+                first = prev[:, 1:].reshape(-1, 4, 2).astype(np.float64)
+                second = rows[:, 1:].reshape(-1, 4, 2).astype(np.float64)
+                # (pairs, stride - 1, 8) corners of the skipped frames
+                corners = [np.rint(first[i] + (align_corners(first[i], second[j]) - first[i]) * steps).reshape(-1, 8)
+                           for i, j in match_quads(first, second, dst_threshold * stride)]
+                for k in range(stride - 1):
+                    if corners:
+                        filled = np.column_stack([np.full(len(corners), prev_idx + k + 1),
+                                                  np.array([pair[k] for pair in corners])])
+                        yield prev_idx + k + 1, filled.astype(rows.dtype)
+        prev_idx, prev = frame_idx, rows
+    if prev is not None:
+        yield prev_idx, prev
+
+
+def interpolate_skipped_frames(data, stride, dst_threshold):
+    """
+    Fill frames skipped by the detection stride in a detections table, see interpolate_stream
+    :param data: array (n, 9) with detected contours of sampled frames sorted by frame index
+    :param stride: detection frame stride
+    :param dst_threshold: distance between contours centers of consecutive frames
+    :return: array (m, 9) with one row per contour and frame
+    """
+    if stride <= 1 or len(data) == 0:
+        return data
+    return np.concatenate([rows for _, rows in interpolate_stream(frame_groups(data), stride, dst_threshold)])
+
+
+def corner_error(reference, candidate, dst_threshold):
+    """
+    Compare detections against reference (full resolution) detections
+    :param reference: array (n, 9) with reference contours sorted by frame index
+    :param candidate: array (m, 9) with contours to check sorted by frame index
+    :param dst_threshold: maximum distance between matched centroids
+    :return: dictionary with matched ratio, mean and maximum corner error in pixels
+    """
+    errors = []
+    reference_count = len(reference)
+    if reference_count != 0 and len(candidate) != 0:
+        ref_frames, cnd_frames = reference[:, 0], candidate[:, 0]
+        ref_quads = reference[:, 1:].reshape(-1, 4, 2).astype(np.float64)
+        cnd_quads = candidate[:, 1:].reshape(-1, 4, 2).astype(np.float64)
+        for frame_idx in np.unique(ref_frames):
+            ref = ref_quads[np.searchsorted(ref_frames, frame_idx):np.searchsorted(ref_frames, frame_idx, 'right')]
+            cnd = cnd_quads[np.searchsorted(cnd_frames, frame_idx):np.searchsorted(cnd_frames, frame_idx, 'right')]
+            for i, j in match_quads(ref, cnd, dst_threshold):
+                aligned = align_corners(ref[i], cnd[j])
+                errors.extend(np.linalg.norm(aligned - ref[i], axis=1))
+
+    errors = np.array(errors)
+    return {'reference_contours': reference_count,
+            'matched_ratio': len(errors) / 4 / reference_count if reference_count else 0.0,
+            'mean_error': float(errors.mean()) if len(errors) else 0.0,
+            'max_error': float(errors.max()) if len(errors) else 0.0}
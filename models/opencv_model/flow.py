@@ -0,0 +1,101 @@
+import cv2 as cv
+import numpy as np
+
+# Pyramidal Lucas-Kanade parameters
+LK_PARAMS = dict(winSize=(21, 21), maxLevel=3,
+                 criteria=(cv.TERM_CRITERIA_EPS | cv.TERM_CRITERIA_COUNT, 30, 0.01))
+# Flow is computed in the quads bounding box widened by this margin, it has to cover
+# the corners motion and the flow window at the coarsest pyramid level
+FLOW_MARGIN = 96
+# Frames are compared at this size to find scene changes
+THUMBNAIL_SIZE = (64, 36)
+
+
+class FlowTracker(object):
+    """
+    Carries quads of the last full detection from frame to frame with pyramidal
+    Lucas-Kanade optical flow. A full detection is requested every interval frames,
+    on a scene change, when there is nothing to carry and when the forward-backward
+    flow check of any corner fails
+    """
+    def __init__(self, interval, max_error, scene_threshold):
+        """
+        :param interval: maximum amount of frames between full detections
+        :param max_error: maximum forward-backward error of a corner in pixels
+        :param scene_threshold: mean absolute difference of consecutive frames, as a fraction of 255,
+                                that is treated as a scene change
+        """
+        self.interval = interval
+        self.max_error = max_error
+        self.scene_threshold = scene_threshold
+        self.frame = None
+        self.thumbnail = None
+        self.quads = np.zeros((0, 4, 2), dtype=np.float32)
+        self.last_detection = None
+
+    def __scene_changed(self, thumbnail):
+        if self.thumbnail is None:
+            return True
+        return cv.absdiff(thumbnail, self.thumbnail).mean() > self.scene_threshold * 255
+
+    def __flow(self, frame):
+        """
+        Move the quads to the next frame
+        :param frame: next video frame
+        :return: array (k, 4, 2) with moved quads or None if any corner is lost
+        """
+        frame_h, frame_w = frame.shape[:2]
+        x0, y0 = np.maximum(np.floor(self.quads.reshape(-1, 2).min(axis=0)) - FLOW_MARGIN, 0).astype(int)
+        x1, y1 = np.ceil(self.quads.reshape(-1, 2).max(axis=0) + FLOW_MARGIN).astype(int) + 1
+        x1, y1 = min(x1, frame_w), min(y1, frame_h)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        prev_gray = cv.cvtColor(self.frame[y0:y1, x0:x1], cv.COLOR_BGR2GRAY)
+        gray = cv.cvtColor(frame[y0:y1, x0:x1], cv.COLOR_BGR2GRAY)
+
+        offset = np.float32([x0, y0])
+        points = (self.quads.reshape(-1, 1, 2) - offset).astype(np.float32)
+        moved, status, _ = cv.calcOpticalFlowPyrLK(prev_gray, gray, points, None, **LK_PARAMS)
+        if moved is None:
+            return None
+        back, back_status, _ = cv.calcOpticalFlowPyrLK(gray, prev_gray, moved, None, **LK_PARAMS)
+        if back is None:
+            return None
+        error = np.abs(points - back).reshape(-1, 2).max(axis=1)
+        if not (status.all() and back_status.all() and (error < self.max_error).all()):
+            return None
+        quads = (moved + offset).reshape(-1, 4, 2)
+        if not all(cv.isContourConvex(quad) for quad in quads):
+            return None
+        return quads
+
+    def track(self, frame_idx, frame):
+        """
+        Quads of the next decoded frame
+        :param frame_idx: frame index
+        :param frame: video frame, it is referenced until the next call and must not be modified
+        :return: array (k, 4, 2) with tracked quads or None if the frame needs a full detection
+        """
+        thumbnail = cv.cvtColor(cv.resize(frame, THUMBNAIL_SIZE, interpolation=cv.INTER_LINEAR),
+                                cv.COLOR_BGR2GRAY)
+        due = (self.last_detection is None or frame_idx - self.last_detection >= self.interval
+               or self.__scene_changed(thumbnail))
+        quads = None
+        # Frames without quads to carry are searched in full, so new surfaces are not missed
+        if not due and len(self.quads) != 0:
+            quads = self.__flow(frame)
+        self.frame = frame
+        self.thumbnail = thumbnail
+        if quads is not None:
+            self.quads = quads
+        return quads
+
+    def reset(self, frame_idx, rows):
+        """
+        Start tracking the quads of a full detection
+        :param frame_idx: frame index
+        :param rows: list of rows with frame index and contour corners
+        :return:
+        """
+        self.quads = np.array(rows, dtype=np.float32).reshape(-1, 9)[:, 1:9].reshape(-1, 4, 2)
+        self.last_detection = frame_idx
@@ -0,0 +1,78 @@
+import numpy as np
+
+
+class InsertionPlan(object):
+    """
+    Frame indexed insertion plan. Keeps every contour to insert, sorted by frame,
+    with a dense offsets table, so contours of a frame are found in O(1)
+    """
+    def __init__(self, frames, quads, tracks, frames_count):
+        """
+        :param frames: array (n,) with frame indices
+        :param quads: array (n, 4, 2) with contour corners
+        :param tracks: array (n,) with track (instance) indices
+        :param frames_count: video frames amount
+        """
+        frames = np.asarray(frames, dtype=np.int32)
+        quads = np.asarray(quads, dtype=np.float32).reshape(-1, 4, 2)
+        tracks = np.asarray(tracks, dtype=np.int32)
+        order = np.argsort(frames, kind='stable')
+        frames, quads, tracks = frames[order], quads[order], tracks[order]
+        frames_count = max(int(frames_count), int(frames[-1]) + 1 if len(frames) else 0)
+        self.frames = frames
+        self.quads = quads
+        self.tracks = tracks
+        self.frames_count = frames_count
+        # Contours of frame i are rows offsets[i]:offsets[i + 1]
+        self.offsets = np.searchsorted(frames, np.arange(frames_count + 1))
+
+    @classmethod
+    def from_tracks(cls, tracks, frames_count, track_ids=None):
+        """
+        Build plan from stable contours
+        :param tracks: list of arrays (m, 9) with frame index and contour corners
+        :param frames_count: video frames amount
+        :param track_ids: track indices, list positions by default
+        :return: insertion plan
+        """
+        if track_ids is None:
+            track_ids = range(len(tracks))
+        tracks = [np.asarray(track).reshape(-1, 9) for track in tracks]
+        rows = np.concatenate(tracks) if tracks else np.zeros((0, 9))
+        ids = np.repeat(np.asarray(list(track_ids), dtype=np.int32), [len(track) for track in tracks])
+        return cls(rows[:, 0], rows[:, 1:], ids, frames_count)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame_idx):
+        return 0 <= frame_idx < self.frames_count and self.offsets[frame_idx + 1] > self.offsets[frame_idx]
+
+    def quads_for(self, frame_idx):
+        """
+        Contours of the frame
+        :param frame_idx: frame index
+        :return: array (k, 4, 2) with contour corners
+        """
+        if not 0 <= frame_idx < self.frames_count:
+            return self.quads[:0]
+        return self.quads[self.offsets[frame_idx]:self.offsets[frame_idx + 1]]
+
+    def tracks_for(self, frame_idx):
+        """
+        Track indices of the frame contours
+        :param frame_idx: frame index
+        :return: array (k,) with track indices
+        """
+        if not 0 <= frame_idx < self.frames_count:
+            return self.tracks[:0]
+        return self.tracks[self.offsets[frame_idx]:self.offsets[frame_idx + 1]]
+
+    def select(self, track_ids):
+        """
+        Plan with the chosen tracks only
+        :param track_ids: track indices to keep
+        :return: insertion plan
+        """
+        keep = np.isin(self.tracks, list(track_ids))
+        return InsertionPlan(self.frames[keep], self.quads[keep], self.tracks[keep], self.frames_count)
@@ -0,0 +1,99 @@
+import cv2 as cv
+import numpy as np
+
+# Upper bound of frames kept in memory, previews of the other frames are decoded again
+MAX_FRAMES = 256
+# Upper bound of memory of the frames kept in full size until a track is known to start there
+MAX_BYTES = 512 * 1024 ** 2
+
+
+def downscale(frame, width):
+    """
+    Resize the frame to the preview width, narrower frames are copied as they are
+    :param frame: video frame
+    :param width: preview width
+    :return: preview frame and its scale to the source frame
+    """
+    frame_w = frame.shape[1]
+    if frame_w <= width:
+        return frame.copy(), 1.0
+    scale = width / frame_w
+    height = max(1, int(round(frame.shape[0] * scale)))
+    return cv.resize(frame, (width, height), interpolation=cv.INTER_AREA), scale
+
+
+def write_preview(filename, frame, scale, row, ad_insertion, quality):
+    """
+    Insert the logo into the preview frame and write it as JPEG
+    :param filename: preview path
+    :param frame: preview frame, it is not modified
+    :param scale: preview scale to the source frame
+    :param row: frame index and contour corners of the source frame
+    :param ad_insertion: model with the logo
+    :param quality: JPEG quality
+    :return:
+    """
+    row = np.array(row, dtype=np.float64).reshape(1, -1)
+    row[:, 1:9] *= scale
+    frame = ad_insertion.insert_frame(frame.copy(), row[0, 0], row)
+    cv.imwrite(filename, frame, [cv.IMWRITE_JPEG_QUALITY, int(quality)])
+
+
+class PreviewFrames(object):
+    """
+    Decoded frames where a stable track may start. Frames are added while the video is decoded for
+    detection and dropped as soon as the tracker shows that no track starts there, so the video is
+    not read again for the previews. A frame is downscaled only once a track is known to start there
+    """
+    def __init__(self, width, limit=MAX_FRAMES, max_bytes=MAX_BYTES):
+        """
+        :param width: preview width
+        :param limit: maximum amount of frames kept in memory
+        :param max_bytes: maximum memory of the frames that are not downscaled yet
+        """
+        self.width = width
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.frames = {}
+        self.pending = {}
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.frames) + len(self.pending)
+
+    def add(self, frame_idx, frame):
+        """
+        Keep the decoded frame until the tracker shows whether a track starts there
+        :param frame_idx: frame index
+        :param frame: decoded frame, a kept frame must not be reused by the caller
+        :return: True if the frame is kept
+        """
+        if len(self) >= self.limit or self.bytes + frame.nbytes > self.max_bytes:
+            return False
+        self.pending[frame_idx] = frame
+        self.bytes += frame.nbytes
+        return True
+
+    def retain(self, last_frame, starts, *needed):
+        """
+        Downscale the frames up to last_frame where stable tracks start and drop the ones that are not needed
+        any more
+        :param last_frame: last frame handled by the tracker
+        :param starts: frame indices where stable tracks start
+        :param needed: other collections with frame indices to keep, e.g. where open tracks may start
+        :return:
+        """
+        for frame_idx in [frame_idx for frame_idx in self.pending if frame_idx <= last_frame]:
+            if frame_idx in starts:
+                frame = self.pending.pop(frame_idx)
+                self.frames[frame_idx] = downscale(frame, self.width)
+                self.bytes -= frame.nbytes
+            elif not any(frame_idx in frames for frames in needed):
+                self.bytes -= self.pending.pop(frame_idx).nbytes
+
+    def get(self, frame_idx):
+        """
+        :param frame_idx: frame index
+        :return: preview frame and its scale or None if the frame was not kept
+        """
+        return self.frames.get(frame_idx)
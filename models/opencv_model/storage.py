@@ -0,0 +1,116 @@
+import numpy as np
+
+from models.opencv_model.insertion_plan import InsertionPlan
+
+# Name of the track store in the job files folder. The file holds several npy records one after another, so it is
+# not an npy file np.load could read as a whole
+TRACKS_FILE = 'tracks.trk'
+
+
+def write_arrays(filename, arrays):
+    """
+    Write arrays one after another as plain npy records of one file
+    :param filename: file path
+    :param arrays: arrays to write
+    :return:
+    """
+    with open(filename, 'wb') as file:
+        for array in arrays:
+            np.save(file, np.ascontiguousarray(array), allow_pickle=False)
+
+
+def map_arrays(filename, count):
+    """
+    Open npy records written by write_arrays as read-only memory maps, nothing is read
+    from the records data until it is accessed
+    :param filename: file path
+    :param count: amount of records
+    :return: list of np.memmap arrays
+    """
+    arrays = []
+    with open(filename, 'rb') as file:
+        for _ in range(count):
+            version = np.lib.format.read_magic(file)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+            offset = file.tell()
+            size = int(np.prod(shape)) * dtype.itemsize
+            if size == 0:
+                arrays.append(np.zeros(shape, dtype))
+            else:
+                arrays.append(np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape,
+                                        order='F' if fortran_order else 'C'))
+            file.seek(offset + size)
+    return arrays
+
+
+class TrackStore(object):
+    """
+    Columnar on-disk store of stable tracks: int32 frame indices, float32 corners
+    and an offsets table of the tracks, so any track is read without loading the others
+    """
+    def __init__(self, frames_count, frames, corners, offsets):
+        """
+        :param frames_count: video frames amount
+        :param frames: array (n,) with frame indices of all tracks rows
+        :param corners: array (n, 8) with contour corners of all tracks rows
+        :param offsets: array (tracks + 1,), rows of track i are offsets[i]:offsets[i + 1]
+        """
+        self.frames_count = int(frames_count)
+        self.frames = frames
+        self.corners = corners
+        self.offsets = offsets
+
+    @classmethod
+    def save(cls, filename, tracks, frames_count):
+        """
+        Save stable tracks
+        :param filename: file path
+        :param tracks: list of arrays (m, 9) with frame index and contour corners
+        :param frames_count: video frames amount
+        :return:
+        """
+        tracks = [np.asarray(track).reshape(-1, 9) for track in tracks]
+        rows = np.concatenate(tracks) if tracks else np.zeros((0, 9))
+        offsets = np.concatenate([[0], np.cumsum([len(track) for track in tracks])]).astype(np.int64)
+        write_arrays(filename, (np.int64([frames_count]), rows[:, 0].astype(np.int32),
+                                rows[:, 1:].astype(np.float32), offsets))
+
+    @classmethod
+    def open(cls, filename):
+        """
+        Open saved tracks as memory maps
+        :param filename: file path
+        :return: track store
+        """
+        frames_count, frames, corners, offsets = map_arrays(filename, 4)
+        return cls(int(frames_count[0]), frames, corners, np.array(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def track(self, track_idx):
+        """
+        Rows of one track
+        :param track_idx: track index
+        :return: array (m,) with frame indices and array (m, 8) with contour corners
+        """
+        start, stop = self.offsets[track_idx], self.offsets[track_idx + 1]
+        return np.array(self.frames[start:stop]), np.array(self.corners[start:stop])
+
+    def plan(self, track_ids=None):
+        """
+        Insertion plan of the chosen tracks, only their rows are read from disk
+        :param track_ids: track indices to keep, all tracks by default
+        :return: insertion plan
+        """
+        if track_ids is None:
+            track_ids = range(len(self))
+        track_ids = sorted(i for i in set(track_ids) if 0 <= i < len(self))
+        rows = [self.track(i) for i in track_ids]
+        frames = np.concatenate([track[0] for track in rows]) if rows else np.zeros(0)
+        corners = np.concatenate([track[1] for track in rows]) if rows else np.zeros((0, 8))
+        ids = np.repeat(np.asarray(track_ids, dtype=np.int32), [len(track[0]) for track in rows])
+        return InsertionPlan(frames, corners, ids, self.frames_count)
@@ -0,0 +1,138 @@
+import dataclasses
+import os
+import tempfile
+
+import cv2 as cv
+import numpy as np
+
+from models.opencv_model.buffers import BufferPool
+from models.opencv_model.detection import (frame_groups, interpolate_stream, scaled_gray, scaled_kernel,
+                                           threshold_contours, filter_contours, polygon_rows)
+from models.opencv_model.tracking import build_linker
+
+# Parameters that decide which frames are decoded and how, so every swept configuration shares them
+SHARED_PARAMETERS = ('detection_scale', 'detection_stride', 'detection_mode', 'flow_interval',
+                     'flow_max_error', 'scene_threshold')
+
+
+def sweep_configs(base, overrides):
+    """
+    Configurations of the sweep
+    :param base: model configuration the overrides are applied to, in full detection mode
+    :param overrides: non-empty list of dictionaries with parameters to change
+    :return: list of validated model configurations
+    """
+    if base.detection_mode != 'full':
+        raise ValueError('Invalid sweep configuration: the sweep searches contours on every frame, '
+                         'detection_mode of the model configuration must be full.')
+    if not isinstance(overrides, list) or not overrides:
+        raise ValueError('Invalid sweep configuration: configs must be a non-empty list.')
+    names = {field.name for field in dataclasses.fields(base)}
+    configs = []
+    for values in overrides:
+        if not isinstance(values, dict):
+            raise ValueError('Invalid sweep configuration: {!r} must be a dictionary of parameters.'.format(values))
+        unknown = sorted(set(values) - names)
+        if unknown:
+            raise ValueError('Invalid sweep configuration: unknown {}.'.format(', '.join(unknown)))
+        shared = sorted(name for name in SHARED_PARAMETERS if name in values and values[name] != getattr(base, name))
+        if shared:
+            raise ValueError('Invalid sweep configuration: {} must be the same for all configurations.'
+                             .format(', '.join(shared)))
+        configs.append(dataclasses.replace(base, **values))
+    return configs
+
+
+class ParameterSweep(object):
+    """
+    Contours search with many configurations in one decoding pass. The grayscale frame is
+    shared by all configurations and the blurred, thresholded contours by the configurations
+    with the same kernel, only the contours filtering runs for every configuration. Detections of every
+    configuration are appended to its own file, so the memory does not grow with the video length
+    """
+    def __init__(self, configs, folder):
+        """
+        :param configs: model configurations with the same shared parameters
+        :param folder: folder for the detections files, they are removed by close
+        """
+        self.configs = configs
+        self.scale = configs[0].detection_scale if configs else 1.0
+        os.makedirs(folder, exist_ok=True)
+        self.paths = []
+        self.files = []
+        for _ in configs:
+            fd, path = tempfile.mkstemp(suffix='.rows', dir=folder)
+            self.paths.append(path)
+            self.files.append(os.fdopen(fd, 'wb'))
+        self.buffers = BufferPool()
+        self.kernels = {}
+        for i, config in enumerate(configs):
+            self.kernels.setdefault(scaled_kernel(config.kernel, self.scale), []).append(i)
+
+    def process_frame(self, frame, frame_idx):
+        """
+        Search contours of the frame with every configuration
+        :param frame: video frame
+        :param frame_idx: frame index
+        :return:
+        """
+        gray = scaled_gray(frame, self.scale, self.buffers)
+        for kernel, members in self.kernels.items():
+            contours = threshold_contours(gray, kernel, self.buffers)
+            areas = [cv.contourArea(cnt) for cnt in contours]
+            # Configurations that differ in track-level parameters only share the filtered rows too
+            filtered = {}
+            for i in members:
+                cfg = self.configs[i]
+                key = (cfg.min_area_threshold, cfg.max_area_threshold, cfg.corners_count, cfg.perimeter_threshold)
+                if key not in filtered:
+                    rows = polygon_rows(frame_idx, filter_contours(contours, *key, scale=self.scale, areas=areas))
+                    filtered[key] = np.array(rows, dtype=np.int64).tobytes()
+                self.files[i].write(filtered[key])
+        self.buffers.give(gray)
+
+    def finish(self):
+        """
+        Flush the detections files once the video is decoded
+        :return:
+        """
+        for file in self.files:
+            file.close()
+
+    def close(self):
+        """
+        Remove the detections files
+        :return:
+        """
+        self.finish()
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def detections(self, config_idx):
+        """
+        :param config_idx: configuration index
+        :return: array (n, 9) with frame index and contour corners, memory mapped from the detections file
+        """
+        path = self.paths[config_idx]
+        if os.path.getsize(path) == 0:
+            return np.zeros((0, 9), dtype=np.int64)
+        return np.memmap(path, dtype=np.int64, mode='r').reshape(-1, 9)
+
+    def tracks(self, config_idx, fps):
+        """
+        Stable tracks of the configuration, linked as AdInsertion.detect_surfaces does
+        :param config_idx: configuration index
+        :param fps: video frames per second
+        :return: list of arrays (m, 9) with stable tracks ordered by their first frame
+        """
+        cfg = self.configs[config_idx]
+        linker = build_linker(cfg.tracker, fps, cfg.field_threshold, cfg.contour_threshold,
+                              cfg.dst_threshold, cfg.max_gap)
+        tracks = []
+        for frame_idx, rows in interpolate_stream(frame_groups(self.detections(config_idx)),
+                                                  cfg.detection_stride, cfg.dst_threshold):
+            tracks.extend(linker.update(frame_idx, rows))
+        tracks.extend(linker.finish())
+        tracks.sort(key=lambda track: track[0, 0])
+        return tracks
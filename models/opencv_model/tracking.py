@@ -0,0 +1,346 @@
+import math
+
+import numpy as np
+from scipy.signal import savgol_filter
+from scipy.spatial import cKDTree
+
+# Below this amount of track and detection pairs a frame is matched without the KD-tree
+BRUTE_FORCE_PAIRS = 64
+
+
+def polygon_centroids(quads):
+    """
+    Integer centroids of all quads at once with the shoelace formula. The arithmetic
+    follows cv.moments for contours, so results are equal to int(m10 / m00), int(m01 / m00)
+    :param quads: array (n, 4, 2) with contour corners
+    :return: arrays (n,) with x and y centroids, degenerate quads get infinite centroids
+    """
+    x = quads[:, :, 0].astype(np.float64)
+    y = quads[:, :, 1].astype(np.float64)
+    x_prev = np.roll(x, 1, axis=1)
+    y_prev = np.roll(y, 1, axis=1)
+
+    cross = x_prev * y - x * y_prev
+    a00 = cross.sum(axis=1)
+    a10 = (cross * (x_prev + x)).sum(axis=1)
+    a01 = (cross * (y_prev + y)).sum(axis=1)
+
+    sign = np.where(a00 > 0, 1, -1)
+    m00 = a00 * (sign * 0.5)
+    m10 = a10 * (sign * (1 / 6))
+    m01 = a01 * (sign * (1 / 6))
+
+    valid = np.abs(a00) > np.finfo(np.float32).eps
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cx = np.where(valid, np.trunc(m10 / m00), np.inf)
+        cy = np.where(valid, np.trunc(m01 / m00), np.inf)
+    return cx, cy
+
+
+def link_chain(frames, cx, cy, dst_threshold):
+    """
+    Follow one contour chain through consecutive frames: starting from the first row,
+    take the first row of the next frame with centroid closer than dst threshold
+    :param frames: list with frame indices sorted
+    :param cx: list with centroids x
+    :param cy: list with centroids y
+    :param dst_threshold: distance between contours centers
+    :return: list of chained row positions, the first row is not included
+    """
+    chain = []
+    prev_frame, prev_cx, prev_cy = frames[0], cx[0], cy[0]
+    for i in range(1, len(frames)):
+        step = frames[i] - prev_frame
+        if step == 0:
+            continue
+        if step > 1:
+            # The chain is broken, later rows are even further
+            break
+        if math.sqrt((cx[i] - prev_cx) ** 2 + (cy[i] - prev_cy) ** 2) < dst_threshold:
+            chain.append(i)
+            prev_frame, prev_cx, prev_cy = frames[i], cx[i], cy[i]
+    return chain
+
+
+class Track(object):
+    """
+    Open track of the linker
+    """
+    def __init__(self, row, cx, cy):
+        self.rows = [row]
+        self.cx = cx
+        self.cy = cy
+        self.last_frame = int(row[0])
+
+    def append(self, row, cx, cy):
+        self.rows.append(row)
+        self.cx = cx
+        self.cy = cy
+        self.last_frame = int(row[0])
+
+    def to_array(self):
+        """
+        Track rows with frames missed inside the track filled by linear interpolation
+        between corners of the detections around the gap
+        :return: array (m, 9) with one row per frame
+        """
+        rows = np.array(self.rows)
+        frames = rows[:, 0]
+        gaps = np.flatnonzero(np.diff(frames) > 1)
+        if len(gaps) == 0:
+            return rows
+
+        first = rows[gaps, 1:9].reshape(-1, 4, 2).astype(np.float64)
+        second = rows[gaps + 1, 1:9].reshape(-1, 4, 2).astype(np.float64)
+        # Corners order may change between detections, align it as align_corners does
+        shifts = np.stack([np.roll(second, -k, axis=1) for k in range(4)])
+        best = np.square(shifts - first).sum(axis=(2, 3)).argmin(axis=0)
+        target = shifts[best, np.arange(len(gaps))]
+
+        steps = frames[gaps + 1] - frames[gaps]
+        gap_idx = np.repeat(np.arange(len(gaps)), steps - 1)
+        offsets = np.arange(len(gap_idx)) - np.repeat(np.cumsum(steps - 1) - (steps - 1), steps - 1) + 1
+        weights = (offsets / steps[gap_idx])[:, None, None]
+        corners = np.rint(first[gap_idx] + (target - first)[gap_idx] * weights).reshape(-1, 8)
+        filled = np.column_stack([frames[gaps][gap_idx] + offsets, corners]).astype(rows.dtype)
+
+        rows = np.concatenate([rows, filled])
+        return rows[np.argsort(rows[:, 0], kind='stable')]
+
+
+class TrackLinker(object):
+    """
+    Multi-surface track linker. Contours of every frame are matched to the open tracks
+    by centroid with a KD-tree, so several tracks live at once and short detection gaps
+    do not break them. Each frame costs O(k log k) in its detections amount
+    """
+    def __init__(self, dst_threshold, max_gap, min_length):
+        """
+        :param dst_threshold: distance between contours centers of consecutive frames
+        :param max_gap: maximum amount of frames without detection inside a track
+        :param min_length: minimum track length in frames
+        """
+        self.dst_threshold = dst_threshold
+        self.max_gap = max_gap
+        self.min_length = min_length
+        self.tracks = []
+
+    def __close(self, frame_idx):
+        """
+        Close tracks whose gap can no longer be bridged
+        :param frame_idx: current frame index
+        :return: list of finished stable tracks
+        """
+        finished = []
+        alive = []
+        for track in self.tracks:
+            if frame_idx - track.last_frame > self.max_gap + 1:
+                finished.append(track)
+            else:
+                alive.append(track)
+        self.tracks = alive
+        return self.__stable(finished)
+
+    def __stable(self, tracks):
+        # Filled track has one row per frame of its span
+        return [track.to_array() for track in tracks
+                if track.last_frame - int(track.rows[0][0]) + 1 >= self.min_length]
+
+    def __candidates(self, frame_idx, points):
+        """
+        Track and detection pairs closer than the distance allowed by the track gap
+        :param frame_idx: current frame index
+        :param points: list of detection centroids
+        :return: list of (distance, track position, detection position) sorted by distance
+        """
+        tracks = self.tracks
+        radius = [self.dst_threshold * (frame_idx - track.last_frame) for track in tracks]
+        if len(tracks) * len(points) <= BRUTE_FORCE_PAIRS:
+            neighbours = [range(len(points))] * len(tracks)
+        else:
+            positions = [(track.cx, track.cy) for track in tracks]
+            neighbours = cKDTree(points).query_ball_point(positions, r=max(radius))
+
+        pairs = []
+        for t, detections in enumerate(neighbours):
+            track = tracks[t]
+            for d in detections:
+                dist = math.hypot(points[d][0] - track.cx, points[d][1] - track.cy)
+                if dist < radius[t]:
+                    pairs.append((dist, t, d))
+        pairs.sort()
+        return pairs
+
+    def update(self, frame_idx, rows, centroids=None):
+        """
+        Link contours of the next frame, frames must come in increasing order
+        :param frame_idx: frame index
+        :param rows: array (k, 9) with frame index and contour corners
+        :param centroids: list of k (x, y) contour centroids, computed if not given
+        :return: list of arrays (m, 9) with tracks finished before this frame
+        """
+        finished = self.__close(frame_idx)
+        if len(rows) == 0:
+            return finished
+        if centroids is None:
+            cx, cy = polygon_centroids(rows[:, 1:9].reshape(-1, 4, 2))
+            centroids = list(zip(cx.tolist(), cy.tolist()))
+
+        valid = [d for d, point in enumerate(centroids) if math.isfinite(point[0])]
+        points = [centroids[d] for d in valid]
+        matched = [False] * len(points)
+
+        if self.tracks and points:
+            used_tracks = set()
+            for dist, t, d in self.__candidates(frame_idx, points):
+                if t in used_tracks or matched[d]:
+                    continue
+                used_tracks.add(t)
+                matched[d] = True
+                self.tracks[t].append(rows[valid[d]], points[d][0], points[d][1])
+
+        for d, point in enumerate(points):
+            if not matched[d]:
+                self.tracks.append(Track(rows[valid[d]], point[0], point[1]))
+        return finished
+
+    def finish(self):
+        """
+        Close all open tracks
+        :return: list of arrays (m, 9) with finished stable tracks
+        """
+        finished = self.__stable(self.tracks)
+        self.tracks = []
+        return finished
+
+    def first_frames(self):
+        """
+        Frames where the open tracks start
+        :return: set of frame indices
+        """
+        return {int(track.rows[0][0]) for track in self.tracks}
+
+
+class ChainLinker(object):
+    """
+    One contour chain per field. Rows of the current run of consecutive detected frames
+    are buffered and the run is chained as soon as a frame without detection closes it,
+    so memory depends on the run length only
+    """
+    def __init__(self, field_threshold, dst_threshold, min_length):
+        """
+        :param field_threshold: minimum field duration threshold
+        :param dst_threshold: distance between contours centers
+        :param min_length: minimum track length in frames
+        """
+        self.field_threshold = field_threshold
+        self.dst_threshold = dst_threshold
+        self.min_length = min_length
+        self.run = []
+
+    def __close(self):
+        """
+        Chain the buffered run
+        :return: list with the stable track of the run if any
+        """
+        run, self.run = self.run, []
+        if not run:
+            return []
+        first, last = int(run[0][0, 0]), int(run[-1][0, 0])
+        # A field at the video start must be strictly longer than the threshold
+        if last - first + 1 < self.field_threshold + (first == 0):
+            return []
+
+        data = np.concatenate(run)
+        cx, cy = polygon_centroids(data[:, 1:9].reshape(-1, 4, 2))
+        chain = link_chain(data[:, 0].tolist(), cx.tolist(), cy.tolist(), self.dst_threshold)
+        if len(chain) < self.min_length:
+            return []
+        return [data[np.array(chain, dtype=np.int64)]]
+
+    def update(self, frame_idx, rows):
+        """
+        Add contours of the next frame, frames must come in increasing order
+        :param frame_idx: frame index
+        :param rows: array (k, 9) with frame index and contour corners
+        :return: list of arrays (m, 9) with tracks finished before this frame
+        """
+        finished = []
+        if self.run and frame_idx != int(self.run[-1][0, 0]) + 1:
+            finished = self.__close()
+        if len(rows) != 0:
+            self.run.append(rows)
+        return finished
+
+    def finish(self):
+        """
+        Close the last run
+        :return: list of arrays (m, 9) with finished stable tracks
+        """
+        return self.__close()
+
+    def first_frames(self):
+        """
+        Frames where tracks of the buffered run may start, a chain can begin at any frame of the run
+        :return: range of frame indices
+        """
+        if not self.run:
+            return range(0)
+        return range(int(self.run[0][0, 0]), int(self.run[-1][0, 0]) + 1)
+
+
+def build_linker(tracker, fps, field_threshold, contours_threshold, dst_threshold, max_gap):
+    """
+    Incremental linker of the configured tracker
+    :param tracker: kdtree for multi-surface tracks, chain for one chain per field
+    :param fps: video frames per second
+    :param field_threshold: minimum field duration threshold, used by the chain tracker
+    :param contours_threshold: minimum contours duration threshold
+    :param dst_threshold: distance between contours centers
+    :param max_gap: maximum amount of frames without detection inside a kdtree track
+    :return: TrackLinker or ChainLinker
+    """
+    min_length = int(fps) * contours_threshold
+    if tracker == 'kdtree':
+        return TrackLinker(dst_threshold, max_gap, min_length)
+    return ChainLinker(field_threshold, dst_threshold, min_length)
+
+
+def orient_corners(track):
+    """
+    Canonical corners order of all track rows at once: top left, bottom left, bottom right, top right.
+    Corners are split into left and right pairs by x, ties resolved as in a per-row stable sort
+    :param track: array (m, 9) with frame index and contour corners
+    :return: array (m, 9) with ordered corners
+    """
+    quads = track[:, 1:9].reshape(-1, 4, 2)
+    order = np.argsort(quads[:, :, 0], axis=1, kind='stable')
+    quads = np.take_along_axis(quads, order[:, :, None], axis=1)
+
+    rows = np.arange(len(quads))
+    oriented = np.empty_like(quads)
+    for side, (top, bottom) in ((quads[:, :2], (0, 1)), (quads[:, 2:], (3, 2))):
+        # First of equal y values wins, like argmin and argmax do
+        top_idx = (side[:, 1, 1] < side[:, 0, 1]).astype(np.int64)
+        bottom_idx = (side[:, 1, 1] > side[:, 0, 1]).astype(np.int64)
+        oriented[:, top] = side[rows, top_idx]
+        oriented[:, bottom] = side[rows, bottom_idx]
+    return np.column_stack([track[:, :1], oriented.reshape(-1, 8)])
+
+
+def smooth_corners(track, window, poly_order):
+    """
+    Smooth all corner coordinates of the track with one Savitzky-Golay filter pass.
+    Tracks shorter than the window get the longest odd window that fits, and tracks
+    too short for the polynomial order are left as they are
+    :param track: array (m, 9) with frame index and contour corners
+    :param window: the length of filter window
+    :param poly_order: the order of the polynomial used to fit the samples
+    :return: array (m, 9) with smoothed corners
+    """
+    window = min(window, len(track) - (1 - len(track) % 2))
+    if window <= poly_order:
+        return track
+    smoothed = track.copy()
+    smoothed[:, 1:9] = savgol_filter(track[:, 1:9], window, poly_order, axis=0)
+    return smoothed
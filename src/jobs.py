@@ -0,0 +1,270 @@
+import json
+import os
+import tempfile
+import threading
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from ad_insertion_executor import ProcessingExecutor, InsertionExecutor, SweepExecutor
+from metrics import JobMetrics
+from models.opencv_model.config import ModelConfig
+from models.opencv_model.sweep import sweep_configs
+
+
+class Job(object):
+    """
+    Video processing and insertion of one video and logo pair, run in its own workspace folder
+    """
+    def __init__(self, video, logo, workspace):
+        """
+        :param video: video file name in the output folder
+        :param logo: logo file name in the output folder
+        :param workspace: job folder for intermediate files, instances, report and output video
+        """
+        self.id = uuid.uuid4().hex
+        self.video = video
+        self.logo = logo
+        self.workspace = workspace
+        self.step = 'processing'
+        self.status = 'queued'
+        self.stage = None
+        self.progress = 0.0
+        self.message = None
+        self.error = None
+        self.result = None
+        self.results = []
+        self.configs = None
+        self.outputs = None
+
+    def to_dict(self):
+        # Paths are given relative to the job workspace, the server folders are not exposed
+        return {'id': self.id,
+                'video': self.video,
+                'logo': self.logo,
+                'step': self.step,
+                'status': self.status,
+                'stage': self.stage,
+                'progress': round(self.progress, 3),
+                'message': self.message,
+                'error': self.error,
+                'instances': 'instances',
+                'result': Path(self.result).name if self.result else None,
+                'results': [Path(result).name for result in self.results]}
+
+    def save(self):
+        """
+        Write the job record to its workspace, so the job survives an application restart
+        :return:
+        """
+        record = self.to_dict()
+        record['configs'] = self.configs
+        record['outputs'] = self.outputs
+        path = self.workspace / 'job.json'
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=str(self.workspace))
+        with os.fdopen(fd, 'w') as file:
+            json.dump(record, file)
+        os.replace(temp_path, str(path))
+
+    @classmethod
+    def load(cls, workspace):
+        """
+        Read the job record of the workspace
+        :param workspace: job folder
+        :return: job
+        """
+        with open(str(workspace / 'job.json'), 'r') as file:
+            record = json.load(file)
+        job = cls(record['video'], record['logo'], workspace)
+        job.id = record['id']
+        for name in ('step', 'status', 'stage', 'progress', 'message', 'error', 'configs'):
+            setattr(job, name, record[name])
+        job.outputs = record.get('outputs')
+        job.result = str(workspace / record['result']) if record['result'] else None
+        job.results = [str(workspace / result) for result in record.get('results', [])]
+        return job
+
+
+class JobQueue(object):
+    """
+    Bounded pool of worker threads that runs jobs in the background
+    """
+    def __init__(self, root, conf_path, workers):
+        """
+        :param root: folder for jobs workspaces
+        :param conf_path: model configuration path
+        :param workers: maximum amount of jobs run at the same time
+        """
+        self.root = Path(root)
+        self.conf_path = conf_path
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def restore(self):
+        """
+        Load the jobs of previous runs. Jobs that were queued or running when the application stopped
+        are queued again, their steps resume from the last checkpoint. Called once by the serving process,
+        not on import, so the jobs are not run by every process that imports the application
+        :return:
+        """
+        if not self.root.is_dir():
+            return
+        for workspace in sorted(self.root.iterdir()):
+            if not (workspace / 'job.json').is_file():
+                continue
+            try:
+                job = Job.load(workspace)
+            except (OSError, ValueError, KeyError):
+                traceback.print_exc()
+                continue
+            self.jobs[job.id] = job
+            if job.status in ('queued', 'running'):
+                print('Job {} is resumed.'.format(job.id))
+                self.__queue(job)
+
+    def __queue(self, job):
+        """
+        Queue the current step of the job
+        :param job: job
+        :return:
+        """
+        job.status = 'queued'
+        job.save()
+        targets = {'processing': self.__process, 'insertion': self.__insert, 'sweep': self.__sweep}
+        self.pool.submit(self.__run, job, targets[job.step])
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def submit_processing(self, video, logo):
+        """
+        Queue video processing of a new job
+        :param video: video file name in the output folder
+        :param logo: logo file name in the output folder
+        :return: job
+        """
+        job = Job(video, logo, None)
+        job.workspace = self.root / job.id
+        job.workspace.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.__queue(job)
+        return job
+
+    def submit_sweep(self, video, configs):
+        """
+        Queue detection parameters sweep of a new job
+        :param video: video file name in the output folder
+        :param configs: list of dictionaries with parameters to change in the model configuration
+        :return: job
+        """
+        # Invalid configurations are rejected before the job is queued
+        sweep_configs(ModelConfig.load(self.conf_path), configs)
+        job = Job(video, None, None)
+        job.step = 'sweep'
+        job.configs = configs
+        job.workspace = self.root / job.id
+        job.workspace.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            self.jobs[job.id] = job
+            self.__queue(job)
+        return job
+
+    @staticmethod
+    def __check_outputs(outputs):
+        """
+        Validate output videos of an insertion
+        :param outputs: list of logo file names or dictionaries track index -> logo file name, or None
+        :return:
+        """
+        if outputs is not None and not isinstance(outputs, list):
+            raise ValueError('Invalid outputs: must be a list.')
+        for output in outputs or []:
+            if isinstance(output, dict):
+                if not output or not all(str(track).isdigit() and isinstance(logo, str)
+                                         for track, logo in output.items()):
+                    raise ValueError('Invalid output: {}, track indices must be integers and logos names.'
+                                     .format(output))
+            elif not isinstance(output, str):
+                raise ValueError('Invalid output: {}, must be a logo name or an assignment.'.format(output))
+
+    def submit_insertion(self, job_id, outputs=None):
+        """
+        Queue advertisement insertion of a processed job
+        :param job_id: job identifier
+        :param outputs: optional list of output videos, every output is a logo file name or a dictionary
+                        track index -> logo file name, one output with the job logo if not given
+        :return: job or None if there is no such job
+        """
+        self.__check_outputs(outputs)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            if job.step != 'processing' or job.status != 'done':
+                raise ValueError('Job {} is not ready for insertion.'.format(job_id))
+            job.step = 'insertion'
+            job.stage = None
+            job.progress = 0.0
+            job.message = None
+            job.outputs = outputs
+            self.__queue(job)
+        return job
+
+    def __run(self, job, target):
+        """
+        Run one step of the job and record its outcome
+        :param job: job
+        :param target: step function
+        :return:
+        """
+        with self.lock:
+            job.status = 'running'
+            job.save()
+        try:
+            message = target(job)
+        except Exception as e:
+            traceback.print_exc()
+            with self.lock:
+                job.status = 'failed'
+                job.error = '{}: {}'.format(type(e).__name__, e)
+                job.save()
+        else:
+            with self.lock:
+                job.status = 'done'
+                job.progress = 1.0
+                job.message = message
+                job.save()
+
+    @staticmethod
+    def __progress(job):
+        def report(stage, fraction):
+            job.stage = stage
+            job.progress = min(max(float(fraction), 0.0), 1.0)
+        return report
+
+    def __process(self, job):
+        executor = ProcessingExecutor(job.video, job.logo, self.conf_path,
+                                      workspace=job.workspace, progress=self.__progress(job),
+                                      metrics=JobMetrics(job.id))
+        return executor.process_video()
+
+    def __insert(self, job):
+        executor = InsertionExecutor(job.video, job.logo, self.conf_path,
+                                     workspace=job.workspace, progress=self.__progress(job),
+                                     metrics=JobMetrics(job.id), outputs=job.outputs)
+        message = executor.insert_ads()
+        job.result = executor.output_file
+        job.results = executor.output_files
+        return message
+
+    def __sweep(self, job):
+        executor = SweepExecutor(job.video, self.conf_path, job.configs,
+                                 workspace=job.workspace, progress=self.__progress(job),
+                                 metrics=JobMetrics(job.id))
+        message = executor.run_sweep()
+        job.result = executor.output_file
+        return message
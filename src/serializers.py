@@ -15,3 +15,27 @@ processing_serializer = api.model(
         'video': fields.String(required=True)
     }
 )
+sweep_serializer = api.model(
+    'Sweep',
+    {
+        'video': fields.String(required=True),
+        'configs': fields.List(fields.Raw, required=True)
+    }
+)
+job_serializer = api.model(
+    'Job',
+    {
+        'id': fields.String,
+        'video': fields.String,
+        'logo': fields.String,
+        'step': fields.String,
+        'status': fields.String,
+        'stage': fields.String,
+        'progress': fields.Float,
+        'message': fields.String,
+        'error': fields.String,
+        'instances': fields.String,
+        'result': fields.String,
+        'results': fields.List(fields.String)
+    }
+)
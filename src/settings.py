@@ -2,3 +2,7 @@ from pathlib import Path
 
 conf_path = Path('src/conf/configurations.yaml')
 default_conf_path = Path('src/conf/default_configurations.yaml')
+
+# Every job gets its own folder with intermediate files, instances and output video
+jobs_path = Path('output/jobs')
+job_workers = 2
@@ -1,15 +1,9 @@
-from flask import request, send_from_directory, session
-from flask_restx import marshal, Resource
-from werkzeug.utils import secure_filename
-
-from app import app, api
-from ad_insertion_executor import ProcessingExecutor, InsertionExecutor
-from flask import request
-from flask_restx import marshal, Resource
+from flask import Response, request, send_from_directory
+from flask_restx import abort, marshal, Resource
 
 from app import app, api
+from metrics import REGISTRY
 from src import serializers
-from ad_insertion_executor import ProcessingExecutor, InsertionExecutor
 
 
 @api.route('/conf')
@@ -34,20 +28,77 @@ class ProcessingResource(Resource):
 
     @api.expect(serializers.processing_serializer)
     def post(self):
-        """ Video Processing """
+        """ Video Processing, returns the job at once """
+
+        payload = request.get_json()
+        job = app.jobs.submit_processing(payload['video'], payload['logo'])
+        return marshal(job.to_dict(), serializers.job_serializer), 202
+
+
+@api.route('/sweep')
+class SweepResource(Resource):
+
+    @api.expect(serializers.sweep_serializer)
+    def post(self):
+        """ Detection Parameters Sweep in one decoding pass, returns the job at once """
 
         payload = request.get_json()
-        session['video'] = payload['video']
-        session['logo'] = payload['logo']
-        processing_executor = ProcessingExecutor(payload['video'], payload['logo'], app.conf_path)
-        message = processing_executor.process_video()
-        # message = process_video(payload['video'], payload['logo'], app.conf_path)
-        return message
+        try:
+            job = app.jobs.submit_sweep(payload['video'], payload.get('configs'))
+        except ValueError as e:
+            abort(400, str(e))
+        return marshal(job.to_dict(), serializers.job_serializer), 202
+
 
+def get_job(job_id):
+    job = app.jobs.get(job_id)
+    if job is None:
+        abort(404, 'Job {} is not found.'.format(job_id))
+    return job
+
+
+@api.route('/jobs/<string:job_id>')
+class JobResource(Resource):
     @staticmethod
-    def get() -> dict:
-        """ Advertisement Insertion """
-        insertion_executor = InsertionExecutor(session['video'], session['logo'], app.conf_path)
-        message = insertion_executor.insert_ads()
-        # message = insert_ads(session['video'], session['logo'], app.conf_path)
-        return message
+    def get(job_id) -> dict:
+        """ Job Status and Progress """
+
+        return marshal(get_job(job_id).to_dict(), serializers.job_serializer)
+
+
+@api.route('/jobs/<string:job_id>/insertion')
+class InsertionResource(Resource):
+    @staticmethod
+    def post(job_id):
+        """ Advertisement Insertion into one or several output videos, returns the job at once """
+
+        get_job(job_id)
+        payload = request.get_json(silent=True) or {}
+        try:
+            job = app.jobs.submit_insertion(job_id, payload.get('outputs'))
+        except ValueError as e:
+            abort(400, str(e))
+        return marshal(job.to_dict(), serializers.job_serializer), 202
+
+
+@api.route('/jobs/<string:job_id>/result')
+class ResultResource(Resource):
+    @staticmethod
+    def get(job_id):
+        """ Download Output Video or Sweep Report, the index query parameter chooses one of several outputs """
+
+        job = get_job(job_id)
+        if job.result is None:
+            abort(409, 'Job {} has no output file yet.'.format(job_id))
+        index = request.args.get('index', 0, type=int)
+        results = job.to_dict()['results'] or [job.to_dict()['result']]
+        if not 0 <= index < len(results):
+            abort(404, 'Job {} has no output {}.'.format(job_id, index))
+        return send_from_directory(str(job.workspace), results[index], as_attachment=True)
+
+
+@app.route('/metrics')
+def metrics():
+    """ Stage timings and counters in the Prometheus text format """
+
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,268 @@
+import json
+import os
+import subprocess
+
+import numpy as np
+
+FFMPEG = 'ffmpeg'
+FFPROBE = 'ffprobe'
+
+# Encoders that produce streams compatible with the source codec, so re-encoded
+# segments can be joined with stream copied ones
+ENCODERS = {'h264': 'libx264',
+            'hevc': 'libx265',
+            'mpeg4': 'mpeg4',
+            'mpeg2video': 'mpeg2video',
+            'mjpeg': 'mjpeg',
+            'vp8': 'libvpx',
+            'vp9': 'libvpx-vp9'}
+
+
+def preset_options(preset):
+    """
+    Encoder speed preset options
+    :param preset: preset name, empty for the encoder default
+    :return: list of ffmpeg output options
+    """
+    return ['-preset', preset] if preset else []
+
+
+# Colour description of the stream, ffprobe entries and the ffmpeg options that set them
+COLOR_OPTIONS = (('color_range', '-color_range'), ('color_space', '-colorspace'),
+                 ('color_transfer', '-color_trc'), ('color_primaries', '-color_primaries'),
+                 ('chroma_location', '-chroma_sample_location'))
+# Encoder profile names of the profiles reported by ffprobe
+PROFILES = {'libx264': {'constrained baseline': 'baseline', 'baseline': 'baseline', 'main': 'main',
+                        'high': 'high', 'high 10': 'high10', 'high 4:2:2': 'high422',
+                        'high 4:4:4 predictive': 'high444'},
+            'libx265': {'main': 'main', 'main 10': 'main10', 'main still picture': 'mainstillpicture'}}
+
+
+def probe_video(video):
+    """
+    Video stream parameters of the file
+    :param video: video path
+    :return: dictionary with codec_name, profile, level, pix_fmt, sample_aspect_ratio, the colour description
+             and start_time of the first video stream
+    """
+    entries = ['codec_name', 'profile', 'level', 'pix_fmt', 'sample_aspect_ratio', 'start_time'] + \
+        [name for name, _ in COLOR_OPTIONS]
+    output = subprocess.run([FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'stream=' + ','.join(entries), '-of', 'json', video],
+                            stdout=subprocess.PIPE, check=True).stdout
+    stream = json.loads(output.decode())['streams'][0]
+    start_time = stream.get('start_time', 'N/A')
+    result = {'codec_name': stream['codec_name'],
+              'profile': stream.get('profile'),
+              'level': stream.get('level'),
+              'pix_fmt': stream.get('pix_fmt', 'yuv420p'),
+              'sample_aspect_ratio': stream.get('sample_aspect_ratio', '0:1'),
+              'start_time': float(start_time) if start_time != 'N/A' else 0.0}
+    for name, _ in COLOR_OPTIONS:
+        result[name] = stream.get(name, 'unknown')
+    return result
+
+
+def stream_options(stream):
+    """
+    Encoder options that reproduce the profile, level, sample aspect ratio and colour description of the source stream,
+    so the stream headers of re-encoded segments match the source ones
+    :param stream: dictionary returned by probe_video
+    :return: list of ffmpeg output options
+    """
+    codec = ENCODERS.get(stream['codec_name'])
+    profile = PROFILES.get(codec, {}).get(str(stream.get('profile')).lower())
+    level = stream.get('level')
+    options = ['-profile:v', profile] if profile is not None else []
+    for name, option in COLOR_OPTIONS:
+        if stream.get(name, 'unknown') not in ('unknown', 'unspecified'):
+            options += [option, stream[name]]
+    if stream.get('sample_aspect_ratio', '0:1') not in ('0:1', 'N/A'):
+        options += ['-vf', 'setsar={}'.format(stream['sample_aspect_ratio'].replace(':', '/'))]
+    if isinstance(level, int) and level > 0:
+        # ffprobe reports H.264 levels multiplied by 10 and HEVC levels by 30
+        if codec == 'libx264':
+            options += ['-level:v', '{:.1f}'.format(level / 10)]
+        elif codec == 'libx265':
+            options += ['-x265-params', 'level-idc={:.1f}'.format(level / 30)]
+    return options
+
+
+def stream_extradata(video):
+    """
+    Codec extradata of the first video stream, the parameter sets the decoder of a stream copy is set up with
+    :param video: video path
+    :return: hex dump text, empty if the stream has no extradata
+    """
+    output = subprocess.run([FFPROBE, '-v', 'error', '-select_streams', 'v:0', '-show_data',
+                             '-show_entries', 'stream=extradata', '-of', 'json', video],
+                            stdout=subprocess.PIPE, check=True).stdout
+    streams = json.loads(output.decode()).get('streams', [])
+    return streams[0].get('extradata', '').strip() if streams else ''
+
+
+def read_frame(video, frame_idx, fps, width, height):
+    """
+    Decode one frame with ffmpeg. Input seeking starts decoding at the keyframe before the position and
+    drops the frames before it, so the frame is exact
+    :param video: video path
+    :param frame_idx: frame index
+    :param fps: video frames per second
+    :param width: frame width
+    :param height: frame height
+    :return: BGR image or None if the frame is not decoded
+    """
+    # Half a frame before the frame time, so a rounded timestamp of the frame is not dropped
+    position = max(0.0, (frame_idx - 0.5) / fps)
+    output = subprocess.run([FFMPEG, '-v', 'error', '-ss', '{:.6f}'.format(position), '-i', video,
+                             '-map', '0:v:0', '-frames:v', '1', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-'],
+                            stdout=subprocess.PIPE, check=True).stdout
+    if len(output) != width * height * 3:
+        return None
+    return np.frombuffer(output, dtype=np.uint8).reshape(height, width, 3)
+
+
+def keyframes(video, fps, start_time=0.0):
+    """
+    Keyframes of the first video stream, read from packet headers without decoding
+    :param video: video path
+    :param fps: video frames per second
+    :param start_time: timestamp of the first frame
+    :return: sorted array with keyframe indices and array with their decoding timestamps
+    """
+    output = subprocess.run([FFPROBE, '-v', 'error', '-select_streams', 'v:0',
+                             '-show_entries', 'packet=pts_time,dts_time,flags', '-of', 'json', video],
+                            stdout=subprocess.PIPE, check=True).stdout
+    packets = [packet for packet in json.loads(output.decode()).get('packets', [])
+               if packet.get('flags', '').startswith('K') and packet.get('pts_time', 'N/A') != 'N/A']
+    frames = np.rint((np.array([float(packet['pts_time']) for packet in packets]) - start_time) * fps)
+    dts = np.array([float(packet.get('dts_time', packet['pts_time'])) for packet in packets])
+    order = np.argsort(frames, kind='stable')
+    return frames[order].astype(np.int64), dts[order]
+
+
+def insertion_segments(frames, keyframes_idx, frames_count):
+    """
+    Frame ranges to re-encode: every frame with insertions is widened to its group of pictures,
+    from the keyframe at or before it to the next keyframe, and touching ranges are merged
+    :param frames: array with frame indices that have insertions
+    :param keyframes_idx: sorted array with keyframe indices
+    :param frames_count: video frames amount
+    :return: list of (first frame, stop frame) ranges
+    """
+    frames = np.unique(frames)
+    if len(frames) == 0:
+        return []
+    keyframes_idx = np.union1d(keyframes_idx, [0])
+    position = np.searchsorted(keyframes_idx, frames, 'right')
+    starts = keyframes_idx[position - 1]
+    stops = np.where(position < len(keyframes_idx),
+                     keyframes_idx[np.minimum(position, len(keyframes_idx) - 1)], frames_count)
+
+    segments = []
+    for start, stop in sorted(set(zip(starts.tolist(), stops.tolist()))):
+        if segments and start <= segments[-1][1]:
+            segments[-1][1] = max(segments[-1][1], stop)
+        else:
+            segments.append([start, stop])
+    return [(start, min(stop, frames_count)) for start, stop in segments]
+
+
+def concat_parts(video, parts, output, list_path):
+    """
+    Join stream copied ranges of the source and re-encoded segment files with the concat demuxer.
+    The video is taken from the parts, audio is copied from the source as it is
+    :param video: source video path
+    :param parts: list of (file path, inpoint, outpoint), in and out points are decoding timestamps
+                  of the range keyframes or None
+    :param output: output video path
+    :param list_path: path of the concat list file to write
+    :return:
+    """
+    lines = ['ffconcat version 1.0']
+    for path, inpoint, outpoint in parts:
+        lines.append("file '{}'".format(os.path.abspath(path).replace("'", "'\\''")))
+        if inpoint is not None:
+            lines.append('inpoint {:.6f}'.format(inpoint))
+        if outpoint is not None:
+            lines.append('outpoint {:.6f}'.format(outpoint))
+    with open(list_path, 'w') as list_file:
+        list_file.write('\n'.join(lines) + '\n')
+
+    subprocess.run([FFMPEG, '-y', '-v', 'error', '-f', 'concat', '-safe', '0', '-i', list_path, '-i', video,
+                    '-map', '0:v:0', '-map', '1:a?', '-c', 'copy', output], check=True)
+
+
+class FFmpegWriter(object):
+    """
+    Video writer that pipes raw BGR frames to an ffmpeg encoder subprocess. The subprocess
+    can also copy the audio of another file, so encoding and muxing take a single pass
+    """
+    def __init__(self, filename, width, height, fps, codec, pix_fmt='yuv420p', options=(), audio_source=None):
+        """
+        :param filename: output video path
+        :param width: frame width
+        :param height: frame height
+        :param fps: video frames per second
+        :param codec: ffmpeg encoder name
+        :param pix_fmt: output pixel format
+        :param options: extra ffmpeg output options
+        :param audio_source: file to copy audio streams from, no audio if not given
+        """
+        command = [FFMPEG, '-y', '-v', 'error',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(width, height), '-r', str(fps),
+                   '-i', '-']
+        if audio_source is not None:
+            command += ['-i', audio_source, '-map', '0:v:0', '-map', '1:a?', '-c:a', 'copy', '-shortest']
+        else:
+            command += ['-an']
+        command += ['-c:v', codec, '-pix_fmt', pix_fmt] + list(options) + [filename]
+        self.filename = filename
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        # The frame memory is piped as it is, without a bytes copy
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        """
+        Finish encoding
+        :return:
+        """
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise RuntimeError('ffmpeg failed to encode {}.'.format(self.filename))
+
+
+class FanoutWriter(object):
+    """
+    Writer of several outputs of the same source. A list of frames is written one frame per output,
+    a single frame, one without insertions, is written to every output
+    """
+    def __init__(self, writers):
+        """
+        :param writers: list of video writers, one per output
+        """
+        self.writers = writers
+
+    def write(self, frames):
+        if not isinstance(frames, list):
+            frames = [frames] * len(self.writers)
+        for writer, frame in zip(self.writers, frames):
+            writer.write(frame)
+
+    def release(self):
+        """
+        Finish encoding of every output, all writers are released even if one of them fails
+        :return:
+        """
+        errors = []
+        for writer in self.writers:
+            try:
+                writer.release()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]